@@ -0,0 +1,86 @@
+import unittest
+from unittest.mock import MagicMock, mock_open, patch
+
+from falcon import testing
+
+import _tests.test_unittest_setup  # noqa: F401
+
+with patch.dict('sys.modules', {'intents.collect_market_data': MagicMock()}), \
+        patch.dict('os.environ', {'javaPath': 'java', 'TWS_INSTALL_LOG': 'install.log'}), \
+        patch('os.listdir', return_value=['jdk']), \
+        patch('builtins.open', mock_open(read_data='IB Gateway 981')):
+    import main
+
+
+class TestRoutes(unittest.TestCase):
+
+    CONFIG = {'account': 'account', 'marketDataType': 2}
+    IBC_CONFIG = {'userid': 'userid', 'password': 'password'}
+
+    def setUp(self):
+        self.client = testing.TestClient(main.app)
+
+    def test_healthz(self):
+        with patch.object(main, 'environment') as environment:
+            actual = self.client.simulate_get('/healthz')
+            self.assertEqual(200, actual.status_code)
+            self.assertDictEqual({'status': 'ok'}, actual.json)
+            try:
+                environment.ibgw.isConnected.assert_not_called()
+            except AssertionError:
+                self.fail()
+
+    def test_readyz(self):
+        with patch.object(main, 'environment', config=self.CONFIG, ibgw=MagicMock(ibc_config=self.IBC_CONFIG)) as environment:
+            actual = self.client.simulate_get('/readyz')
+            self.assertEqual(200, actual.status_code)
+            self.assertDictEqual({'status': 'ready', 'credentials': True, 'config': True}, actual.json)
+            try:
+                environment.ibgw.isConnected.assert_not_called()
+            except AssertionError:
+                self.fail()
+
+        # gateway state is only reported for a persistent gateway
+        with patch.object(main, 'environment', config={**self.CONFIG, 'persistentGateway': True},
+                          ibgw=MagicMock(ibc_config=self.IBC_CONFIG, isConnected=MagicMock(return_value=False))):
+            actual = self.client.simulate_get('/readyz')
+            self.assertEqual(200, actual.status_code)
+            self.assertFalse(actual.json['gateway'])
+
+        with patch.object(main, 'environment', config={'account': 'account'}, ibgw=MagicMock(ibc_config={'userid': 'userid'})):
+            actual = self.client.simulate_get('/readyz')
+            self.assertEqual(503, actual.status_code)
+            self.assertDictEqual({'status': 'not ready', 'credentials': False, 'config': False}, actual.json)
+
+    def test_metrics(self):
+        with patch.object(main, 'Tracer', prometheus=MagicMock(return_value='# TYPE call_latency_seconds histogram\n')) as tracer:
+            actual = self.client.simulate_get('/metrics')
+            self.assertEqual(200, actual.status_code)
+            self.assertEqual('text/plain; version=0.0.4', actual.headers['content-type'])
+            self.assertEqual(tracer.prometheus.return_value, actual.text)
+
+
+    def test_store_profile(self):
+        intent_instance = MagicMock(_signature='signature')
+        profiler = MagicMock(to_dict=MagicMock(return_value={'samples': 1, 'collapsed': 'a;b 1'}))
+        with patch.object(main, 'environment', trading_mode='paper') as environment:
+            self.assertDictEqual(profiler.to_dict.return_value, main.Main._store_profile(intent_instance, profiler))
+            try:
+                environment.db.collection.assert_called_once_with('profiles')
+                document = environment.db.collection.return_value.document.return_value.set.call_args[0][0]
+                self.assertEqual('signature', document['signature'])
+                self.assertEqual('a;b 1', document['collapsed'])
+            except AssertionError:
+                self.fail()
+
+            # a failed write doesn't fail the request
+            environment.db.collection.return_value.document.return_value.set.side_effect = Exception
+            self.assertDictEqual(profiler.to_dict.return_value, main.Main._store_profile(intent_instance, profiler))
+            try:
+                environment.logging.error.assert_called_once()
+            except AssertionError:
+                self.fail()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta, timezone
+import unittest
+from unittest.mock import MagicMock, patch
+
+from intents.activity_export import ActivityExport
+
+
+class TestActivityExport(unittest.TestCase):
+
+    ACTIVITY = {
+        'consolidatedTrades': {'ABC': 3},
+        'contractIds': {'ABC': 1, 'DEF': 2},
+        'fx': {'USD': 0.9},
+        'holdings': {'s1': {'ABC': 1}},
+        'intent': 'Allocation',
+        'orders': {'ABC': {'order': {'action': 'SELL', 'orderType': 'MKT', 'totalQuantity': 3},
+                           'orderStatus': {'status': 'Filled', 'filled': 3, 'avgFillPrice': 12.5},
+                           'isActive': False}},
+        'signals': {'s1': {'ABC': -1, 'DEF': 0}},
+        'signature': 'signature',
+        'targetPositions': {'s1': {'ABC': -2, 'DEF': 0}},
+        'timestamp': datetime(2022, 1, 1, tzinfo=timezone.utc),
+        'tradingMode': 'paper'
+    }
+    CONFIG = {'activityExportTable': 'dataset.table'}
+    ENV = {'K_REVISION': 'k_revision'}
+
+    @patch('intents.intent.Environment', return_value=MagicMock(config=CONFIG, env=ENV))
+    def setUp(self, *_):
+        self.test_obj = ActivityExport()
+
+    @patch('intents.intent.Environment', return_value=MagicMock(config=CONFIG, env=ENV))
+    def test_init(self, *_):
+        self.assertFalse(self.test_obj._requires_gateway)
+        self.assertEqual('dataset.table', self.test_obj._table)
+        self.assertEqual('dataset.table', self.test_obj._activity_log['table'])
+        self.assertEqual('other.table', ActivityExport(table='other.table')._table)
+
+    def test_flatten(self):
+        base = {
+            'timestamp': '2022-01-01T00:00:00+00:00',
+            'activityId': 'id',
+            'tradingMode': 'paper',
+            'intent': 'Allocation',
+            'signature': 'signature'
+        }
+        expected = [
+            {**base, 'metric': 'signal', 'strategy': 's1', 'localSymbol': 'ABC', 'contractId': 1, 'value': -1},
+            {**base, 'metric': 'signal', 'strategy': 's1', 'localSymbol': 'DEF', 'contractId': 2, 'value': 0},
+            {**base, 'metric': 'holding', 'strategy': 's1', 'localSymbol': 'ABC', 'contractId': 1, 'value': 1},
+            {**base, 'metric': 'targetPosition', 'strategy': 's1', 'localSymbol': 'ABC', 'contractId': 1, 'value': -2},
+            {**base, 'metric': 'targetPosition', 'strategy': 's1', 'localSymbol': 'DEF', 'contractId': 2, 'value': 0},
+            {**base, 'metric': 'consolidatedTrade', 'localSymbol': 'ABC', 'contractId': 1, 'value': 3},
+            {**base, 'metric': 'fx', 'currency': 'USD', 'value': 0.9},
+            {**base, 'metric': 'order', 'localSymbol': 'ABC', 'contractId': 1, 'value': -3,
+             'orderType': 'MKT', 'orderStatus': 'Filled', 'filled': 3, 'avgFillPrice': 12.5}
+        ]
+        self.assertListEqual(expected, ActivityExport.flatten('id', self.ACTIVITY))
+
+        self.assertListEqual([], ActivityExport.flatten('id', {'timestamp': self.ACTIVITY['timestamp'], 'intent': 'Intent'}))
+        # trades aren't logged by strategy and contract by every intent (e.g. CashBalancer)
+        self.assertListEqual([], ActivityExport.flatten('id', {'timestamp': self.ACTIVITY['timestamp'], 'trades': {'EURUSD': 1000}}))
+
+    @patch('intents.activity_export.bigquery')
+    def test_core(self, bigquery):
+        since = datetime(2021, 12, 31, tzinfo=timezone.utc)
+        docs = [MagicMock(id=f'id{i}', to_dict=MagicMock(return_value=self.ACTIVITY)) for i in range(3)]
+
+        with patch.object(self.test_obj, 'BATCH_SIZE', 2):
+            with patch.object(self.test_obj, '_env',
+                              bq=MagicMock(),
+                              db=MagicMock(),
+                              logging=MagicMock(),
+                              query_bigquery=MagicMock(side_effect=[[{'timestamp': since}], [{'activityId': 'id0'}]])) as env:
+                query = env.db.collection.return_value.order_by.return_value.limit.return_value.where.return_value
+                query.stream.return_value = docs[:2]
+                query.start_after.return_value.stream.return_value = docs[2:]
+
+                self.test_obj._core()
+                # id0 has been exported already
+                self.assertEqual(2, self.test_obj._activity_log['exportedActivities'])
+                self.assertEqual(2 * len(ActivityExport.flatten('id', self.ACTIVITY)), self.test_obj._activity_log['exportedRows'])
+                try:
+                    env.bq.create_table.assert_called_once_with(bigquery.Table.return_value, exists_ok=True)
+                    env.db.collection.assert_called_once_with('activity')
+                    env.db.collection.return_value.order_by.assert_called_once_with('timestamp')
+                    env.query_bigquery.assert_called_with('SELECT DISTINCT activityId FROM `dataset.table` WHERE timestamp >= @since',
+                                                          query_parameters={'since': since - timedelta(minutes=60)}, return_type='list')
+                    env.db.collection.return_value.order_by.return_value.limit.return_value.where.assert_called_once_with(
+                        'timestamp', '>=', since - timedelta(minutes=60))
+                    query.start_after.assert_called_once_with(docs[1])
+                    self.assertEqual(2, env.bq.load_table_from_json.call_count)
+                    env.bq.load_table_from_json.assert_called_with([row for doc in docs[2:] for row in ActivityExport.flatten(doc.id, doc.to_dict())],
+                                                                   'dataset.table',
+                                                                   job_config=bigquery.LoadJobConfig.return_value)
+                except AssertionError:
+                    self.fail()
+
+        with patch.object(self.test_obj, '_table', None):
+            self.assertRaises(ValueError, self.test_obj._core)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,16 +26,14 @@ class TestAllocation(unittest.TestCase):
     STRATEGIES = {
         's1': MagicMock(return_value=MagicMock(
             id='s1',
-            contracts={'abc': MagicMock(contract=MagicMock(localSymbol='ABC'), local_symbol='ABC'),
-                       'def': MagicMock(contract=MagicMock(localSymbol='DEF'), local_symbol='DEF')},
+            contracts=MagicMock(local_symbols={'abc': 'ABC', 'def': 'DEF'}, contract_ids={'ABC': 'abc', 'DEF': 'def'}),
             fx={'a': 123, 'b': 456},
             holdings={'abc': 0.1, 'def': 0.2},
             signals={'abc': 1, 'def': 2},
             target_positions={'abc': 100, 'def': 200})),
         's2': MagicMock(return_value=MagicMock(
             id='s2',
-            contracts={'abc': MagicMock(contract=MagicMock(localSymbol='ABC'), local_symbol='ABC'),
-                       'def': MagicMock(contract=MagicMock(localSymbol='DEF'), local_symbol='DEF')},
+            contracts=MagicMock(local_symbols={'abc': 'ABC', 'def': 'DEF'}, contract_ids={'ABC': 'abc', 'DEF': 'def'}),
             fx={'a': 123, 'b': 456},
             holdings={'abc': 0.3, 'def': 0.4},
             signals={'abc': 3, 'def': 4},
@@ -65,6 +63,7 @@ class TestAllocation(unittest.TestCase):
             'signature': 'fa895ca25cae973bf2fe428fe863fac7',
             'tradingMode': self.TRADING_MODE,
             'dryRun': dry_run,
+            'executionMode': 'market',
             'orderProperties': order_properties,
             'strategies': strategies
         }
@@ -81,24 +80,20 @@ class TestAllocation(unittest.TestCase):
         self.assertDictEqual(order_properties, allocation._order_properties)
         self.assertDictEqual(self.STRATEGIES, allocation._strategies)
 
+        allocation = Allocation(executionMode='limit')
+        self.assertEqual('limit', allocation._execution_mode)
+
+    @patch('intents.allocation.IdempotencyKeys', return_value=MagicMock(exists=MagicMock(return_value=True)))
     @patch('intents.allocation.TagValue', return_value='tag_value')
     @patch('intents.allocation.MarketOrder')
     @patch('intents.allocation.Trade', return_value=MagicMock(consolidate_trades=MagicMock(),
                                                               place_orders=MagicMock(return_value='orders'),
-                                                              trades={'abc': {'contract': MagicMock(local_symbol='ABC'),
-                                                                              'quantity': 100},
-                                                                      'def': {'contract': MagicMock(local_symbol='DEF'),
-                                                                              'quantity': -10}}))
-    def test_core(self, trade, market_order, tag_value):
+                                                              orders=['order'],
+                                                              trades={'abc': MagicMock(contract=MagicMock(local_symbol='ABC'), quantity=100),
+                                                                      'def': MagicMock(contract=MagicMock(local_symbol='DEF'), quantity=-10)}))
+    def test_core(self, trade, market_order, tag_value, idempotency_keys):
         with patch.object(self.test_obj, '_env',
                           config=self.CONFIG,
-                          db=MagicMock(collection=MagicMock(return_value=MagicMock(
-                              where=MagicMock(return_value=MagicMock(
-                                  where=MagicMock(return_value=MagicMock(
-                                      where=MagicMock(return_value=MagicMock(
-                                          order_by=MagicMock(return_value=MagicMock(
-                                              order_by=MagicMock(return_value=MagicMock(
-                                                  get=MagicMock(return_value=[123])))))))))))))),
                           env=self.ENV,
                           get_account_values=MagicMock(return_value={'NetLiquidation': {'CHF': 12345}})) as env:
             with patch.object(self.test_obj, '_strategies', self.STRATEGIES) as strategies:
@@ -129,6 +124,7 @@ class TestAllocation(unittest.TestCase):
                                                                             },
                                                                             order_properties={**self.test_obj._order_properties, 'tif': 'DAY'})
                     tag_value.assert_called_once_with('adaptivePriority', self.CONFIG['adaptivePriority'])
+                    idempotency_keys.assert_not_called()
                 except AssertionError:
                     self.fail()
 
@@ -144,11 +140,39 @@ class TestAllocation(unittest.TestCase):
             env.get_account_values.reset_mock()
             self.test_obj._core()
             try:
-                env.db.collection.assert_called_once_with('activity')
+                idempotency_keys.return_value.exists.assert_called_once_with(self.test_obj._signature, 5)
                 env.get_account_values.assert_not_called()
             except AssertionError:
                 self.fail()
 
+            idempotency_keys.return_value.exists.return_value = False
+            with patch.object(self.test_obj, '_strategies', self.STRATEGIES):
+                self.test_obj._core()
+            try:
+                idempotency_keys.return_value.add.assert_called_once_with(self.test_obj._signature, 5, intent='Allocation')
+            except AssertionError:
+                self.fail()
+
+            # no orders placed, so that the scheduler's retry isn't skipped
+            idempotency_keys.return_value.add.reset_mock()
+            for action in ['blocked', 'error']:
+                env.config = {**self.CONFIG, 'retryCheckMinutes': 5, 'marginCheck': 'block'}
+                trade.return_value.check_margin.return_value = {'action': action}
+                with patch.object(self.test_obj, '_strategies', self.STRATEGIES):
+                    self.test_obj._core()
+                try:
+                    self.assertEqual(action, self.test_obj._activity_log['marginCheck']['action'])
+                    idempotency_keys.return_value.add.assert_not_called()
+                except AssertionError:
+                    self.fail()
+            env.config = {**self.CONFIG, 'retryCheckMinutes': 5}
+            with patch.object(trade.return_value, 'orders', []), patch.object(self.test_obj, '_strategies', self.STRATEGIES):
+                self.test_obj._core()
+            try:
+                idempotency_keys.return_value.add.assert_not_called()
+            except AssertionError:
+                self.fail()
+
             with patch.object(self.test_obj, '_dry_run', True):
                 trade.reset_mock()
                 self.test_obj._core()
@@ -29,27 +29,30 @@ class TestCloseAll(unittest.TestCase):
         self.assertEqual(dry_run, close_all._dry_run)
         self.assertDictEqual(order_properties, close_all._order_properties)
 
+    @patch('intents.intent.Environment', return_value=MagicMock(env=ENV, config={'executionMode': 'limit'}))
+    def test_init_execution_mode(self, *_):
+        self.assertEqual('limit', CloseAll()._execution_mode)
+        self.assertEqual('market', CloseAll(executionMode='market')._execution_mode)
+
     @patch('intents.close_all.MarketOrder')
     @patch('intents.close_all.Trade', return_value=MagicMock(consolidate_trades=MagicMock(),
                                                              place_orders=MagicMock(return_value='orders'),
-                                                             trades={'abc': {'contract': MagicMock(local_symbol='ABC'), 'quantity': 100},
-                                                                     'def': {'contract': MagicMock(local_symbol='DEF'), 'quantity': -10}}))
-    def test_core(self, trade, market_order):
-        strategy_side_effect = [MagicMock(contracts={'abc': MagicMock(contract=MagicMock(localSymbol='ABC'), local_symbol='ABC'), 'def': MagicMock(contract=MagicMock(localSymbol='DEF'), local_symbol='DEF')},
+                                                             trades={'abc': MagicMock(contract=MagicMock(local_symbol='ABC'), quantity=100),
+                                                                     'def': MagicMock(contract=MagicMock(local_symbol='DEF'), quantity=-10)}))
+    @patch.object(CloseAll, '_cancel_open_orders')
+    def test_core(self, cancel_open_orders, trade, market_order):
+        strategy_side_effect = [MagicMock(contracts=MagicMock(local_symbols={'abc': 'ABC', 'def': 'DEF'}, contract_ids={'ABC': 'abc', 'DEF': 'def'}),
                                           holdings={'abc': 0.1, 'def': 0.2},
                                           trades={'abc': -0.1, 'def': -0.2}),
-                                MagicMock(contracts={'def': MagicMock(contract=MagicMock(localSymbol='DEF'), local_symbol='DEF'), 'ghi': MagicMock(contract=MagicMock(localSymbol='GHI'), local_symbol='GHI')},
+                                MagicMock(contracts=MagicMock(local_symbols={'def': 'DEF', 'ghi': 'GHI'}, contract_ids={'DEF': 'def', 'GHI': 'ghi'}),
                                           holdings={'def': -0.3, 'ghi': 0.4},
                                           trades={'def': 0.3, 'ghi': -0.4})]
         type(strategy_side_effect[0]).id = PropertyMock(return_value='s1')
         type(strategy_side_effect[1]).id = PropertyMock(return_value='s2')
 
         with patch.object(self.test_obj, '_env',
-                          db=MagicMock(document=MagicMock(return_value=MagicMock(delete=MagicMock())),
-                                       collection=MagicMock(return_value=MagicMock(get=MagicMock(return_value=[MagicMock(id=f's{i + 1}') for i in range(2)])))),
-                          ibgw=MagicMock(orders=MagicMock(return_value=[MagicMock(permId=f'o{i}') for i in range(3)]),
-                                         cancelOrder=MagicMock(),
-                                         portfolio=MagicMock(return_value=[MagicMock(contract=MagicMock(conId='abc'), position=-100),
+                          db=MagicMock(collection=MagicMock(return_value=MagicMock(get=MagicMock(return_value=[MagicMock(id=f's{i + 1}') for i in range(2)])))),
+                          ibgw=MagicMock(portfolio=MagicMock(return_value=[MagicMock(contract=MagicMock(conId='abc'), position=-100),
                                                                            MagicMock(contract=MagicMock(conId='def'), position=10)])),
                           logging=MagicMock(warning=MagicMock())) as env:
             with patch('intents.close_all.Strategy', side_effect=strategy_side_effect) as strategy:
@@ -64,9 +67,7 @@ class TestCloseAll(unittest.TestCase):
                 self.test_obj._core()
                 self.assertDictEqual(expected_log, self.test_obj._activity_log)
                 try:
-                    env.ibgw.cancelOrder.assert_has_calls([call(m) for m in env.ibgw.orders.return_value])
-                    env.db.document.assert_has_calls([call(f'positions/{self.test_obj._env.trading_mode}/openOrders/o{i}') for i in range(3)])
-                    self.assertEqual(3, env.db.document.return_value.delete.call_count)
+                    cancel_open_orders.assert_called_once()
                     env.db.collection.assert_called_once_with(f'positions/{self.test_obj._env.trading_mode}/holdings')
                     strategy.assert_has_calls([call(k.id) for k in env.db.collection.return_value.get.return_value])
                     trade.return_value.consolidate_trades.assert_called_once()
@@ -75,8 +76,8 @@ class TestCloseAll(unittest.TestCase):
                     self.fail()
 
             with patch('intents.close_all.Strategy', side_effect=strategy_side_effect):
-                with patch('intents.close_all.Trade', return_value=MagicMock(trades={'abc': {'contract': MagicMock(local_symbol='ABC'), 'quantity': -100},
-                                                                                     'def': {'contract': MagicMock(local_symbol='DEF'), 'quantity': 10}})):
+                with patch('intents.close_all.Trade', return_value=MagicMock(trades={'abc': MagicMock(contract=MagicMock(local_symbol='ABC'), quantity=-100),
+                                                                                     'def': MagicMock(contract=MagicMock(local_symbol='DEF'), quantity=10)})):
                     self.test_obj._core()
                     try:
                         portfolio = {item.contract.conId: item.position for item in env.ibgw.portfolio()}
@@ -86,17 +87,69 @@ class TestCloseAll(unittest.TestCase):
 
             with patch('intents.close_all.Strategy', side_effect=strategy_side_effect):
                 with patch.object(self.test_obj, '_dry_run', True):
-                    env.db.reset_mock()
-                    env.ibgw.reset_mock()
+                    cancel_open_orders.reset_mock()
                     trade.reset_mock()
                     self.test_obj._core()
                     try:
-                        env.ibgw.cancelOrder.assert_not_called()
-                        env.db.document.return_value.delete.assert_not_called()
+                        cancel_open_orders.assert_not_called()
                         trade.return_value.place_orders.assert_not_called()
                     except AssertionError:
                         self.fail()
 
+    @patch('intents.close_all.monotonic', side_effect=[0, 1, 2, 20, 31])
+    def test_cancel_open_orders(self, *_):
+        def open_trade(perm_id, *statuses):
+            order_status = MagicMock(status='Submitted')
+            is_done = MagicMock(side_effect=lambda: order_status.status in ['Cancelled', 'Filled'])
+            trade = MagicMock(order=MagicMock(permId=perm_id), orderStatus=order_status, isDone=is_done)
+            trade.statuses = iter(statuses)
+            return trade
+
+        open_trades = [open_trade(1, 'Cancelled'), open_trade(2, 'Submitted', 'Filled'), open_trade(3, 'Cancelled')]
+
+        def wait_on_update(**_):
+            for t in open_trades:
+                t.orderStatus.status = next(t.statuses, t.orderStatus.status)
+            return True
+
+        docs = [MagicMock(get=MagicMock(return_value=perm_id)) for perm_id in [1, 2, 3, None]]
+        with patch.object(self.test_obj, '_env', config={'account': 'account'}, logging=MagicMock(),
+                          db=MagicMock(), ibgw=MagicMock(openTrades=MagicMock(return_value=open_trades),
+                                                         waitOnUpdate=MagicMock(side_effect=wait_on_update))) as env:
+            env.db.collection.return_value.where.return_value.get.return_value = docs
+            with patch.object(self.test_obj, 'BATCH_SIZE', 1):
+                self.test_obj._cancel_open_orders()
+            self.assertListEqual([1, 3], self.test_obj._activity_log['cancelledOrders'])
+            try:
+                env.ibgw.reqGlobalCancel.assert_called_once()
+                self.assertEqual(2, env.ibgw.waitOnUpdate.call_count)
+                env.db.collection.assert_called_once_with(f'positions/{self.test_obj._env.trading_mode}/openOrders')
+                env.db.collection.return_value.where.assert_called_once_with('acctNumber', '==', 'account')
+                env.db.batch.return_value.delete.assert_has_calls([call(docs[0].reference), call(docs[2].reference)])
+                self.assertEqual(2, env.db.batch.return_value.commit.call_count)
+                env.logging.warning.assert_not_called()
+            except AssertionError:
+                self.fail()
+
+            # timeout
+            env.reset_mock()
+            open_trades[:] = [open_trade(4)]
+            self.test_obj._cancel_open_orders()
+            self.assertListEqual([], self.test_obj._activity_log['cancelledOrders'])
+            try:
+                env.logging.warning.assert_called_once()
+            except AssertionError:
+                self.fail()
+
+            # nothing to cancel
+            env.reset_mock()
+            env.ibgw.openTrades.return_value = []
+            self.test_obj._cancel_open_orders()
+            try:
+                env.ibgw.reqGlobalCancel.assert_not_called()
+            except AssertionError:
+                self.fail()
+
 
 if __name__ == '__main__':
     unittest.main()
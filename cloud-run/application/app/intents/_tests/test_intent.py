@@ -44,28 +44,25 @@ class TestIntent(unittest.TestCase):
             actual = self.test_obj._core()
             self.assertDictEqual(expected, actual)
 
+    @patch('intents.intent.ActivityLogWriter', return_value=MagicMock(enqueue=MagicMock(side_effect=[None, Exception])))
     @patch('intents.intent.datetime', utcnow=MagicMock(return_value=datetime(1977, 9, 27, 19, 15)))
-    def test_log_activity(self, dt):
-        with patch.object(self.test_obj, '_env',
-                          db=MagicMock(collection=MagicMock(return_value=MagicMock(document=MagicMock(return_value=MagicMock(set=MagicMock(side_effect=[None, Exception])))))),
-                          logging=MagicMock()) as env:
+    def test_log_activity(self, dt, activity_log_writer):
+        with patch.object(self.test_obj, '_env', logging=MagicMock()):
             with patch.object(self.test_obj, '_activity_log', {}):
                 self.test_obj._log_activity()
                 try:
-                    env.db.collection.assert_not_called()
+                    activity_log_writer.assert_not_called()
                 except AssertionError:
                     self.fail()
 
         activity_log = {'abc': 123, 'def': 'ghi'}
 
-        with patch.object(self.test_obj, '_env',
-                          db=MagicMock(collection=MagicMock(return_value=MagicMock(document=MagicMock(return_value=MagicMock(set=MagicMock(side_effect=[None, Exception])))))),
-                          logging=MagicMock()) as env:
+        with patch.object(self.test_obj, '_env', logging=MagicMock()) as env:
             with patch.object(self.test_obj, '_activity_log', activity_log):
                 self.test_obj._log_activity()
                 self.assertDictEqual({**activity_log, 'timestamp': dt.utcnow.return_value}, self.test_obj._activity_log)
                 try:
-                    env.db.collection.return_value.document.return_value.set.assert_called_once_with(self.test_obj._activity_log)
+                    activity_log_writer.return_value.enqueue.assert_called_once_with(self.test_obj._activity_log)
                 except AssertionError:
                     self.fail()
 
@@ -90,6 +87,7 @@ class TestIntent(unittest.TestCase):
         with patch.object(self.test_obj, '_env', config=self.CONFIG, ibgw=MagicMock(), logging=MagicMock()) as env:
             actual = self.test_obj.run()
             self.assertDictEqual({'abc': 123}, actual)
+            self.assertDictEqual({}, self.test_obj._activity_log['spans'])
             try:
                 env.ibgw.start_and_connect.assert_called_once()
                 env.ibgw.reqMarketDataType.assert_called_once_with(self.CONFIG['marketDataType'])
@@ -112,6 +110,29 @@ class TestIntent(unittest.TestCase):
             self.assertEqual(3, log_activity.call_count)
             self.assertEqual(3, env.ibgw.stop_and_terminate.call_count)
 
+        with patch.object(self.test_obj, '_core'):
+            with patch.object(self.test_obj, '_env', config={**self.CONFIG, 'persistentGateway': True},
+                              ibgw=MagicMock(isConnected=MagicMock(side_effect=[False, True])), logging=MagicMock()) as env, \
+                    patch('intents.intent.FillHandler') as fill_handler:
+                self.test_obj.run()
+                self.test_obj.run()
+                try:
+                    fill_handler.attach.assert_called_with(env.ibgw)
+                    env.ibgw.start_and_connect.assert_called_once()
+                    env.ibgw.reqMarketDataType.assert_called_once_with(self.CONFIG['marketDataType'])
+                    env.ibgw.stop_and_terminate.assert_not_called()
+                except AssertionError:
+                    self.fail()
+
+            with patch.object(self.test_obj, '_requires_gateway', False):
+                with patch.object(self.test_obj, '_env', config=self.CONFIG, ibgw=MagicMock(), logging=MagicMock()) as env:
+                    self.test_obj.run()
+                    try:
+                        env.ibgw.start_and_connect.assert_not_called()
+                        env.ibgw.stop_and_terminate.assert_not_called()
+                    except AssertionError:
+                        self.fail()
+
 
 if __name__ == '__main__':
     unittest.main()
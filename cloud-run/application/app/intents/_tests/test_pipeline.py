@@ -0,0 +1,60 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from intents.pipeline import Pipeline
+
+
+class TestPipeline(unittest.TestCase):
+
+    ENV = {'K_REVISION': 'k_revision'}
+    INTENTS = {
+        'a': MagicMock(return_value=MagicMock(_signature='sig_a', _core=MagicMock(return_value={'abc': 123}),
+                                              _activity_log={'agent': 'k_revision', 'intent': 'A', 'dryRun': True})),
+        'b': MagicMock(return_value=MagicMock(_signature='sig_b', _core=MagicMock(return_value=None),
+                                              _activity_log={'agent': 'k_revision', 'intent': 'B', 'orders': {}}))
+    }
+
+    @patch('intents.intent.Environment', return_value=MagicMock(env=ENV))
+    @patch.object(Pipeline, 'INTENTS', INTENTS)
+    def setUp(self, *_):
+        self.test_obj = Pipeline(intents=[{'intent': 'b'}, {'intent': 'a', 'kwargs': {'dryRun': True}}])
+
+    @patch('intents.intent.Environment', return_value=MagicMock(env=ENV))
+    @patch.object(Pipeline, 'INTENTS', INTENTS)
+    def test_init(self, *_):
+        self.assertListEqual(['b', 'a'], self.test_obj._activity_log['intents'])
+        self.assertListEqual([('b', self.INTENTS['b'].return_value), ('a', self.INTENTS['a'].return_value)], self.test_obj._steps)
+        try:
+            self.INTENTS['a'].assert_called_with(dryRun=True)
+            self.INTENTS['b'].assert_called_with()
+        except AssertionError:
+            self.fail()
+
+        self.assertRaises(KeyError, Pipeline, intents=[{'intent': 'a'}, {'intent': 'c'}])
+
+    def test_core(self):
+        with patch.object(self.test_obj, '_env', logging=MagicMock()):
+            self.test_obj._core()
+            steps = self.test_obj._activity_log['steps']
+            self.assertListEqual(['b', 'a'], [s['intent'] for s in steps])
+            self.assertListEqual(['sig_b', 'sig_a'], [s['signature'] for s in steps])
+            self.assertDictEqual({'orders': {}}, steps[0]['activity'])
+            self.assertNotIn('result', steps[0])
+            self.assertDictEqual({'dryRun': True}, steps[1]['activity'])
+            self.assertDictEqual({'abc': 123}, steps[1]['result'])
+            self.assertTrue(all(isinstance(s['seconds'], float) for s in steps))
+
+            self.INTENTS['b'].return_value._core.side_effect = ValueError('error')
+            self.INTENTS['a'].return_value._core.reset_mock()
+            self.assertRaises(ValueError, self.test_obj._core)
+            self.assertEqual('ValueError: error', self.test_obj._activity_log['steps'][0]['exception'])
+            self.assertEqual(1, len(self.test_obj._activity_log['steps']))
+            try:
+                self.INTENTS['a'].return_value._core.assert_not_called()
+            except AssertionError:
+                self.fail()
+            self.INTENTS['b'].return_value._core.side_effect = None
+
+
+if __name__ == '__main__':
+    unittest.main()
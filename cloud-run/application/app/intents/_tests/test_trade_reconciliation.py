@@ -1,7 +1,7 @@
+from datetime import datetime, timezone
 import unittest
-from unittest.mock import call, MagicMock, patch
+from unittest.mock import ANY, call, MagicMock, patch
 
-from intents.trade_reconciliation import DELETE_FIELD
 from intents.trade_reconciliation import TradeReconciliation
 
 
@@ -26,37 +26,90 @@ class TestTradeReconciliation(unittest.TestCase):
                                                                                   orderStatus=MagicMock(
                                                                                       nonDefaults=MagicMock(return_value=f'os{i}')), log=f'log{i}')
                                                                         for i in range(2)]),
-                                         fills=MagicMock(return_value=[MagicMock(contract=MagicMock(conId=f'c{i}',
+                                         reqExecutions=MagicMock(return_value=[MagicMock(contract=MagicMock(conId=f'c{i}',
                                                                                                     nonDefaults=MagicMock(return_value=f'c{i}')),
-                                                                                 execution=MagicMock(permId=f'p{i}',
+                                                                                 execution=MagicMock(execId=f'x{i}',
+                                                                                                     permId=f'p{i}',
                                                                                                      orderId=f'o{i}',
+                                                                                                     time=datetime(2022, 1, 3, 15, i, tzinfo=timezone.utc),
                                                                                                      side='SLD',
                                                                                                      cumQty=(i + 1) * 100,
                                                                                                      nonDefaults=MagicMock(return_value=f'e{i}')))
                                                                        for i in range(2)]),
                                          portfolio=MagicMock(return_value=[MagicMock(contract=MagicMock(conId=i), position=(i + 1) * 200) for i in range(2)]),
                                          reqContractDetails=MagicMock(return_value=MagicMock(contract=MagicMock(localSymbol='abc'))))) as env:
-            document_side_effect = [MagicMock(get=MagicMock(return_value=MagicMock(to_dict=MagicMock(return_value={'c0': 100, 'c1': -200}), exists=True))),
-                                    MagicMock(get=MagicMock(return_value=MagicMock(to_dict=MagicMock(return_value={'c0': 100, 'c1': -200}), exists=False)))]
-            env.db.document.side_effect = document_side_effect
-            collection_side_effect = [MagicMock(where=MagicMock(return_value=MagicMock(get=MagicMock(return_value=(MagicMock(reference='order_doc', to_dict=MagicMock(return_value={'source': {'s0': 100, 's1': -200}})), ))))) for _ in range(2)] +\
-                                     [MagicMock(list_documents=MagicMock(return_value=[MagicMock(get=MagicMock(return_value=MagicMock(to_dict=MagicMock(return_value={i: (i + 1) * 100 for i in range(2)})))) for _ in range(2)]))]
+            open_orders = [MagicMock(name=f'order{i}') for i in range(2)]
+            collection_side_effect = [MagicMock(where=MagicMock(return_value=MagicMock(get=MagicMock(return_value=open_orders)))),
+                                      MagicMock(list_documents=MagicMock(return_value=[MagicMock(get=MagicMock(return_value=MagicMock(to_dict=MagicMock(return_value={i: (i + 1) * 100 for i in range(2)})))) for _ in range(2)]))]
             env.db.collection.side_effect = collection_side_effect
+            env.config = {'account': 'account'}
+            checkpoint_time = datetime(2022, 1, 3, 14, tzinfo=timezone.utc)
+            env.db.document.return_value.get.return_value.to_dict.return_value = {'time': checkpoint_time, 'execIds': ['x']}
 
-            self.test_obj._core()
-            try:
-                env.db.collection.assert_has_calls([call(f'positions/{self.test_obj._env.trading_mode}/openOrders'),
-                                                    call(f'positions/{self.test_obj._env.trading_mode}/openOrders'),
-                                                    call(f'positions/{self.test_obj._env.trading_mode}/holdings')])
-                for i, c in enumerate(collection_side_effect[:2]):
-                    c.where.assert_called_with('permId', '==', env.ibgw.fills.return_value[i].execution.permId)
-                env.db.document.assert_has_calls([call(f'positions/{self.test_obj._env.trading_mode}/holdings/s{i}') for i in range(2)])
-                env.db.transaction.return_value.__enter__.return_value.update.assert_called_once_with(document_side_effect[0], {'c0': 200 or DELETE_FIELD})
-                env.db.transaction.return_value.__enter__.return_value.set.assert_called_once_with(document_side_effect[1], {'c0': -100 or DELETE_FIELD})
-                env.db.transaction.return_value.__enter__.return_value.delete.assert_has_calls([call('order_doc') for _ in range(2)])
-            except AssertionError:
-                self.fail()
+            with patch('intents.trade_reconciliation.FillHandler') as fill_handler, \
+                    patch('intents.trade_reconciliation._advance_checkpoint') as advance_checkpoint:
+                fill_handler.return_value.find_open_order.side_effect = [open_orders[0], None]
+                fill_handler.return_value.complete_order.return_value = True
+                self.test_obj._core()
+                self.assertListEqual([{'contract': 'c0', 'execution': 'e0'}], self.test_obj._activity_log['fills'])
+                try:
+                    env.db.collection.assert_has_calls([call(f'positions/{self.test_obj._env.trading_mode}/openOrders'),
+                                                        call(f'positions/{self.test_obj._env.trading_mode}/holdings')])
+                    collection_side_effect[0].where.assert_called_once_with('acctNumber', '==', 'account')
+                    env.db.document.assert_called_once_with(f'positions/{self.test_obj._env.trading_mode}/checkpoints/executions')
+                    self.assertEqual('account', env.ibgw.reqExecutions.call_args[0][0].acctCode)
+                    self.assertEqual('20220103-14:00:00', env.ibgw.reqExecutions.call_args[0][0].time)
+                    fills = env.ibgw.reqExecutions.return_value
+                    fill_handler.return_value.find_open_order.assert_has_calls([
+                        call(fills[0].execution, 'c0', ANY), call(fills[1].execution, 'c1', ANY)
+                    ])
+                    fill_handler.return_value.complete_order.assert_called_once_with(open_orders[0], fills[0])
+                    # a completed order isn't matched again
+                    self.assertListEqual([open_orders[1]], fill_handler.return_value.find_open_order.call_args_list[1][0][2])
+                    advance_checkpoint.assert_called_once_with(env.db.transaction.return_value, env.db.document.return_value,
+                                                               {'time': datetime(2022, 1, 3, 15, 1, tzinfo=timezone.utc), 'execIds': ['x1']})
+                except AssertionError:
+                    self.fail()
 
+    def test_core_without_new_executions(self):
+        with patch.object(self.test_obj, '_env',
+                          db=MagicMock(),
+                          ibgw=MagicMock(trades=MagicMock(return_value=[]),
+                                         reqExecutions=MagicMock(return_value=[]),
+                                         portfolio=MagicMock(return_value=[]))) as env:
+            env.config = {'account': 'account'}
+            env.db.document.return_value.get.return_value.to_dict.return_value = None
+            env.db.collection.return_value.list_documents.return_value = []
+
+            with patch('intents.trade_reconciliation._advance_checkpoint') as advance_checkpoint:
+                self.test_obj._core()
+                self.assertListEqual([], self.test_obj._activity_log['fills'])
+                try:
+                    self.assertEqual('', env.ibgw.reqExecutions.call_args[0][0].time)
+                    # neither open orders are queried nor the checkpoint is moved
+                    env.db.collection.assert_called_once_with(f'positions/{self.test_obj._env.trading_mode}/holdings')
+                    advance_checkpoint.assert_not_called()
+                except AssertionError:
+                    self.fail()
+
+    def test_get_new_fills(self):
+        time = datetime(2022, 1, 3, 15, tzinfo=timezone.utc)
+        fills = [MagicMock(execution=MagicMock(execId=f'x{i}', time=time.replace(minute=2 - i))) for i in range(3)]
+        with patch.object(self.test_obj, '_env', ibgw=MagicMock(reqExecutions=MagicMock(return_value=fills))) as env:
+            env.config = {'account': 'account'}
+            actual = self.test_obj._get_new_fills({'time': time, 'execIds': ['x2']})
+            self.assertListEqual([fills[1], fills[0]], actual)
+
+    def test_next_checkpoint(self):
+        time = datetime(2022, 1, 3, 15, tzinfo=timezone.utc)
+        fills = [MagicMock(execution=MagicMock(execId=f'x{i}', time=time)) for i in range(2)]
+        # same time as before: the execution IDs are merged
+        actual = self.test_obj._next_checkpoint({'time': time, 'execIds': ['x']}, fills)
+        self.assertDictEqual({'time': time, 'execIds': ['x', 'x0', 'x1']}, actual)
+        # later time: only the latest executions are kept
+        actual = self.test_obj._next_checkpoint({'time': time.replace(minute=1), 'execIds': ['x']},
+                                                fills + [MagicMock(execution=MagicMock(execId='x2', time=time.replace(minute=2)))])
+        self.assertDictEqual({'time': time.replace(minute=2), 'execIds': ['x2']}, actual)
 
 if __name__ == '__main__':
     unittest.main()
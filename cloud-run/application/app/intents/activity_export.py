@@ -0,0 +1,168 @@
+from datetime import timedelta
+
+from google.cloud import bigquery
+
+from intents.intent import Intent
+
+
+class ActivityExport(Intent):
+    """
+    Exports the activity log incrementally from Firestore into a BigQuery table,
+    flattened to one row per metric, strategy and contract. The table is partitioned
+    by day and clustered by metric and strategy.
+
+    As activities are written asynchronously, one can be committed after a later one
+    has been exported already. Each export therefore re-reads an overlap window before
+    the last exported timestamp and skips the activities already in the table.
+    """
+
+    BATCH_SIZE = 500
+    METRICS = {
+        # activity log field (by strategy and contract): metric name
+        'signals': 'signal',
+        'holdings': 'holding',
+        'targetPositions': 'targetPosition'
+    }
+    OVERLAP_MINUTES = 60
+    SCHEMA = [
+        bigquery.SchemaField('timestamp', 'TIMESTAMP', mode='REQUIRED'),
+        bigquery.SchemaField('activityId', 'STRING'),
+        bigquery.SchemaField('tradingMode', 'STRING'),
+        bigquery.SchemaField('intent', 'STRING'),
+        bigquery.SchemaField('signature', 'STRING'),
+        bigquery.SchemaField('metric', 'STRING'),
+        bigquery.SchemaField('strategy', 'STRING'),
+        bigquery.SchemaField('localSymbol', 'STRING'),
+        bigquery.SchemaField('contractId', 'INT64'),
+        bigquery.SchemaField('currency', 'STRING'),
+        bigquery.SchemaField('value', 'FLOAT64'),
+        bigquery.SchemaField('orderType', 'STRING'),
+        bigquery.SchemaField('orderStatus', 'STRING'),
+        bigquery.SchemaField('filled', 'FLOAT64'),
+        bigquery.SchemaField('avgFillPrice', 'FLOAT64')
+    ]
+    _requires_gateway = False
+    _table = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        self._table = kwargs.get('table', self._env.config.get('activityExportTable'))
+        self._activity_log.update(table=self._table)
+
+    def _core(self):
+        if self._table is None:
+            raise ValueError('No BigQuery table configured for the activity export')
+
+        self._create_table()
+        since, exported_ids = self._get_last_timestamp(), set()
+        if since is not None:
+            since -= timedelta(minutes=self.OVERLAP_MINUTES)
+            exported_ids = self._get_exported_ids(since)
+        self._env.logging.info('Exporting activity since %s...', since)
+
+        exported, rows = 0, 0
+        query = self._env.db.collection('activity').order_by('timestamp').limit(self.BATCH_SIZE)
+        if since is not None:
+            query = query.where('timestamp', '>=', since)
+        while len(docs := list(query.stream())):
+            new_docs = [doc for doc in docs if doc.id not in exported_ids]
+            batch = [row for doc in new_docs for row in self.flatten(doc.id, doc.to_dict())]
+            if len(batch):
+                job_config = bigquery.LoadJobConfig(schema=self.SCHEMA,
+                                                    write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+                self._env.bq.load_table_from_json(batch, self._table, job_config=job_config).result()
+            exported += len(new_docs)
+            rows += len(batch)
+            if len(docs) < self.BATCH_SIZE:
+                break
+            query = query.start_after(docs[-1])
+
+        self._activity_log.update(exportedActivities=exported, exportedRows=rows)
+        self._env.logging.info(f'Exported {rows} rows from {exported} activity documents to {self._table}')
+
+    def _create_table(self):
+        """
+        Creates the partitioned export table if it doesn't exist yet.
+        """
+        table = bigquery.Table(self._table, schema=self.SCHEMA)
+        table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY, field='timestamp')
+        table.clustering_fields = ['metric', 'strategy']
+        self._env.bq.create_table(table, exists_ok=True)
+
+    def _get_last_timestamp(self):
+        """
+        Gets the timestamp of the most recent activity exported so far.
+
+        :return: timestamp (datetime or None)
+        """
+        result = self._env.query_bigquery(f'SELECT MAX(timestamp) AS timestamp FROM `{self._table}`', return_type='list')
+        return result[0]['timestamp'] if len(result) else None
+
+    def _get_exported_ids(self, since):
+        """
+        Gets the IDs of the activities exported since a timestamp.
+
+        :param since: timestamp (datetime)
+        :return: Firestore document IDs (set)
+        """
+        result = self._env.query_bigquery(f'SELECT DISTINCT activityId FROM `{self._table}` WHERE timestamp >= @since',
+                                          query_parameters={'since': since}, return_type='list')
+        return {row['activityId'] for row in result}
+
+    @classmethod
+    def flatten(cls, activity_id, activity):
+        """
+        Flattens an activity document into rows.
+
+        :param activity_id: Firestore document ID (str)
+        :param activity: activity document (dict)
+        :return: rows (list of dict)
+        """
+        contract_ids = activity.get('contractIds', {})
+        base = {
+            'timestamp': activity['timestamp'].isoformat(),
+            'activityId': activity_id,
+            'tradingMode': activity.get('tradingMode'),
+            'intent': activity.get('intent'),
+            'signature': activity.get('signature')
+        }
+
+        rows = [
+            {**base, 'metric': metric, 'strategy': strategy, 'localSymbol': symbol, 'contractId': contract_ids.get(symbol), 'value': value}
+            for field, metric in cls.METRICS.items()
+            for strategy, values in (activity.get(field) or {}).items()
+            for symbol, value in values.items()
+        ]
+        rows += [
+            {**base, 'metric': 'consolidatedTrade', 'localSymbol': symbol, 'contractId': contract_ids.get(symbol), 'value': value}
+            for symbol, value in (activity.get('consolidatedTrades') or {}).items()
+        ]
+        rows += [
+            {**base, 'metric': 'fx', 'currency': currency, 'value': value}
+            for currency, value in (activity.get('fx') or {}).items()
+        ]
+        rows += [
+            {
+                **base,
+                'metric': 'order',
+                'localSymbol': symbol,
+                'contractId': contract_ids.get(symbol),
+                'value': (1 if order.get('order', {}).get('action') == 'BUY' else -1) * order.get('order', {}).get('totalQuantity', 0),
+                'orderType': order.get('order', {}).get('orderType'),
+                'orderStatus': order.get('orderStatus', {}).get('status'),
+                'filled': order.get('orderStatus', {}).get('filled'),
+                'avgFillPrice': order.get('orderStatus', {}).get('avgFillPrice')
+            } for symbol, order in (activity.get('orders') or {}).items()
+            if isinstance(order, dict)
+        ]
+        return rows
+
+
+if __name__ == '__main__':
+    from lib.environment import Environment
+
+    env = Environment()
+    activity_export = ActivityExport()
+    activity_export._core()
+    print(activity_export._activity_log)
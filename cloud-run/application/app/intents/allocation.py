@@ -1,9 +1,9 @@
-from datetime import datetime, timedelta
-
 import dateparser
 from ib_insync import MarketOrder, TagValue
 
 from intents.intent import Intent
+from lib.execution import LimitExecution
+from lib.idempotency import IdempotencyKeys
 from lib.trading import Trade
 from strategies import STRATEGIES
 
@@ -11,6 +11,7 @@ from strategies import STRATEGIES
 class Allocation(Intent):
 
     _dry_run = False
+    _execution_mode = 'market'
     _order_properties = {}
     _strategies = {}
 
@@ -18,12 +19,13 @@ class Allocation(Intent):
         super().__init__(**kwargs)
 
         self._dry_run = kwargs.get('dryRun', self._dry_run) if kwargs is not None else self._dry_run
+        self._execution_mode = kwargs.get('executionMode', self._env.config.get('executionMode', self._execution_mode))
         self._order_properties = kwargs.get('orderProperties', self._order_properties) if kwargs is not None else self._order_properties
         strategies = kwargs.get('strategies', [])
         if any([s not in STRATEGIES.keys() for s in strategies]):
             raise KeyError(f"Unknown strategies: {','.join([s for s in strategies if s not in STRATEGIES.keys()])}")
         self._strategies = {s: STRATEGIES[s] for s in strategies}
-        self._activity_log.update(dryRun=self._dry_run, orderProperties=self._order_properties, strategies=strategies)
+        self._activity_log.update(dryRun=self._dry_run, executionMode=self._execution_mode, orderProperties=self._order_properties, strategies=strategies)
 
     def _core(self):
         if (overall_exposure := self._env.config['exposure']['overall']) == 0:
@@ -32,13 +34,7 @@ class Allocation(Intent):
 
         if self._env.config['retryCheckMinutes']:
             # check if agent has created an order before (prevent trade repetition)
-            query = self._env.db.collection('activity') \
-                .where('tradingMode', '==', self._env.trading_mode) \
-                .where('signature', '==', self._signature) \
-                .where('timestamp', '>', datetime.utcnow() - timedelta(minutes=self._env.config['retryCheckMinutes'])) \
-                .order_by('timestamp') \
-                .order_by('orders')
-            if len(list(query.get())):
+            if IdempotencyKeys().exists(self._signature, self._env.config['retryCheckMinutes']):
                 self._env.logging.warning('Agent has run before.')
                 return
 
@@ -60,18 +56,29 @@ class Allocation(Intent):
                     self._env.logging.error(f'{exc.__class__.__name__} running strategy {k}: {exc}')
         # log activity
         self._activity_log.update(**{
-            'signals': {s.id: {s.contracts[k].local_symbol: v for k, v in s.signals.items()} for s in strategies},
-            'holdings': {s.id: {s.contracts[k].local_symbol: v for k, v in s.holdings.items()} for s in strategies},
-            'targetPositions': {s.id: {s.contracts[k].local_symbol: v for k, v in s.target_positions.items()} for s in strategies},
+            'signals': {s.id: {s.contracts.local_symbols[k]: v for k, v in s.signals.items()} for s in strategies},
+            'holdings': {s.id: {s.contracts.local_symbols[k]: v for k, v in s.holdings.items()} for s in strategies},
+            'targetPositions': {s.id: {s.contracts.local_symbols[k]: v for k, v in s.target_positions.items()} for s in strategies},
             'fx': {k: v for s in strategies for k, v in s.fx.items()},
-            'contractIds': {v.contract.localSymbol: k for s in strategies for k, v in s.contracts.items()}
+            'contractIds': {k: v for s in strategies for k, v in s.contracts.contract_ids.items()}
         })
 
         # consolidate trades over strategies, remembering to which strategies a trade belongs
         trades = Trade(strategies)
         trades.consolidate_trades()
-        self._activity_log.update(consolidatedTrades={v['contract'].local_symbol: v['quantity'] for v in trades.trades.values()})
-        self._env.logging.info(f"Consolidated trades: {self._activity_log['consolidatedTrades']}")
+        self._activity_log.update(consolidatedTrades={v.contract.local_symbol: v.quantity for v in trades.trades.values()})
+        self._env.logging.info('Consolidated trades: %s', self._activity_log['consolidatedTrades'])
+        if self._env.config.get('calendarSpreadRolls'):
+            # roll futures with a single combo order each
+            trades.combine_rolls()
+            self._activity_log.update(calendarSpreads={v.local_symbol: v.quantity for v in trades.calendar_spreads.values()})
+            self._env.logging.info('Calendar spreads: %s', self._activity_log['calendarSpreads'])
+        margin_check_action = None
+        if (margin_check := self._env.config.get('marginCheck')) in ('block', 'scale'):
+            # what-if orders for all trades at once, blocking or scaling down trades beyond the margin limit
+            self._activity_log.update(marginCheck=trades.check_margin(self._env.config.get('maxMarginUtilisation', 1.),
+                                                                      scale=margin_check == 'scale'))
+            margin_check_action = self._activity_log['marginCheck']['action']
 
         if not self._dry_run:
             # parse goodAfterTime
@@ -79,14 +86,26 @@ class Allocation(Intent):
                 self._order_properties.update(goodAfterTime=dateparser.parse(self._order_properties['goodAfterTime']).strftime('%Y%m%d %H:%M:%S %Z'))
 
             # place orders
-            orders = trades.place_orders(MarketOrder,
-                                         order_params={
-                                             'algoStrategy': 'Adaptive',
-                                             'algoParams': [TagValue('adaptivePriority', self._env.config['adaptivePriority'])]
-                                         },
-                                         order_properties={**self._order_properties, 'tif': 'DAY'})
+            order_params = {
+                'algoStrategy': 'Adaptive',
+                'algoParams': [TagValue('adaptivePriority', self._env.config['adaptivePriority'])]
+            }
+            if self._execution_mode == 'limit':
+                execution = LimitExecution(trades,
+                                           self._env.config.get('limitPriceDistance', 0),
+                                           self._env.config.get('limitRepriceAttempts', LimitExecution.REPRICE_ATTEMPTS),
+                                           self._env.config.get('limitRepriceSeconds', LimitExecution.REPRICE_SECONDS))
+                orders = execution.place_orders(order_params, order_properties={**self._order_properties, 'tif': 'DAY'})
+                self._activity_log.update(execution=execution.report())
+            else:
+                orders = trades.place_orders(MarketOrder,
+                                             order_params=order_params,
+                                             order_properties={**self._order_properties, 'tif': 'DAY'})
             self._activity_log.update(orders=orders)
-            self._env.logging.info(f"Orders placed: {self._activity_log['orders']}")
+            self._env.logging.info('Orders placed: %s', self._activity_log['orders'])
+            # a retry is only a duplicate if orders have been placed (not e.g. after a failed margin check)
+            if self._env.config['retryCheckMinutes'] and len(trades.orders) and margin_check_action not in ('blocked', 'error'):
+                IdempotencyKeys().add(self._signature, self._env.config['retryCheckMinutes'], intent=self.__class__.__name__)
 
 
 if __name__ == '__main__':
@@ -32,19 +32,20 @@ class CashBalancer(Intent):
         }
         self._activity_log.update(trades=trades)
         if len(trades):
-            self._env.logging.info(f'Trades to reset cash balances: {trades}')
+            self._env.logging.info('Trades to reset cash balances: %s', trades)
         else:
             self._env.logging.info('No cash balances above the threshold')
 
         if not self._dry_run and len(trades):
             # place orders
-            perm_ids = []
-            for k, v in trades.items():
-                order = self._env.ibgw.placeOrder(Forex(pair=k, exchange='FXCONV'),
-                                                  MarketOrder('BUY' if v > 0 else 'SELL', abs(v)))
-                # give the IB Gateway a couple of seconds to digest orders and to raise possible errors
-                self._env.ibgw.sleep(2)
-                perm_ids.append(order.order.permId)
+            placed = [
+                self._env.ibgw.placeOrder(Forex(pair=k, exchange='FXCONV'),
+                                          MarketOrder('BUY' if v > 0 else 'SELL', abs(v)))
+                for k, v in trades.items()
+            ]
+            # give the IB Gateway a couple of seconds to digest orders and to raise possible errors
+            self._env.ibgw.sleep(2)
+            perm_ids = [order.order.permId for order in placed]
             orders = {
                 t.contract.pair(): {
                     'order': {
@@ -60,7 +61,7 @@ class CashBalancer(Intent):
                 } for t in self._env.ibgw.trades() if t.orderStatus.permId in perm_ids
             }
             self._activity_log.update(orders=orders)
-            self._env.logging.info(f"Orders placed: {self._activity_log['orders']}")
+            self._env.logging.info('Orders placed: %s', self._activity_log['orders'])
 
 
 if __name__ == '__main__':
@@ -1,62 +1,98 @@
+from time import monotonic
+
 from ib_insync import MarketOrder
 
 from intents.intent import Intent
+from lib.execution import LimitExecution
 from lib.trading import Trade
 from strategies.strategy import Strategy
 
 
 class CloseAll(Intent):
 
+    BATCH_SIZE = 500  # max. writes per Firestore batch
+    CANCEL_TIMEOUT = 10
     _dry_run = False
+    _execution_mode = 'market'
     _order_properties = {}
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
         self._dry_run = kwargs.get('dryRun', self._dry_run) if kwargs is not None else self._dry_run
+        self._execution_mode = kwargs.get('executionMode', self._env.config.get('executionMode', self._execution_mode))
         self._order_properties = kwargs.get('orderProperties', self._order_properties) if kwargs is not None else self._order_properties
-        self._activity_log.update(dryRun=self._dry_run, orderProperties=self._order_properties)
+        self._activity_log.update(dryRun=self._dry_run, executionMode=self._execution_mode, orderProperties=self._order_properties)
 
     def _core(self):
         self._env.logging.info('Cancelling open orders...')
         if not self._dry_run:
-            for o in self._env.ibgw.orders():
-                self._env.ibgw.cancelOrder(o)
-                self._env.db.document(f'positions/{self._env.trading_mode}/openOrders/{o.permId}').delete()
-                self._env.logging.info(f'Cancelled {o.permId}, deleted /positions/{self._env.trading_mode}/openOrders/{o.permId}')
+            self._cancel_open_orders()
 
         self._env.logging.info('Closing all positions...')
         strategies = [Strategy(doc.id)
                       for doc in self._env.db.collection(f'positions/{self._env.trading_mode}/holdings').get()]
         self._activity_log.update(**{
-            'holdings': {s.id: {s.contracts[k].local_symbol: v for k, v in s.holdings.items()} for s in strategies},
-            'contractIds': {v.contract.localSymbol: k for s in strategies for k, v in s.contracts.items()},
-            'trades': {s.id: {s.contracts[k].local_symbol: v for k, v in s.trades.items()} for s in strategies}
+            'holdings': {s.id: {s.contracts.local_symbols[k]: v for k, v in s.holdings.items()} for s in strategies},
+            'contractIds': {k: v for s in strategies for k, v in s.contracts.contract_ids.items()},
+            'trades': {s.id: {s.contracts.local_symbols[k]: v for k, v in s.trades.items()} for s in strategies}
         })
-        self._env.logging.info(f"Trades: {self._activity_log['trades']}")
+        self._env.logging.info('Trades: %s', self._activity_log['trades'])
 
         trades = Trade(strategies)
         trades.consolidate_trades()
-        self._activity_log.update(consolidatedTrades={v['contract'].local_symbol: v['quantity']
+        self._activity_log.update(consolidatedTrades={v.contract.local_symbol: v.quantity
                                                       for v in trades.trades.values()})
-        self._env.logging.info(f"Consolidated trades: {self._activity_log['consolidatedTrades']}")
+        self._env.logging.info('Consolidated trades: %s', self._activity_log['consolidatedTrades'])
         # double-check w/ IB potfolio
         portfolio = {item.contract.conId: item.position for item in self._env.ibgw.portfolio()}
-        if {k: -v for k, v in portfolio.items()} != {k: v['quantity'] for k, v in trades.trades.items()}:
+        if {k: -v for k, v in portfolio.items()} != {k: v.quantity for k, v in trades.trades.items()}:
             self._env.logging.warning(f"Consolidated trade and IB portfolio don't match - portfolio: {portfolio}")
 
         if not self._dry_run:
             # place orders
-            # order_params = {
-            #     k: {
-            #         'lmtPrice': round(market_prices[k] * (1 + (1 if v['quantity'] > 0 else -1) * self._config['limitPriceDistance'])
-            #                           / min_ticks[k]) * min_ticks[k]
-            #     }
-            #     for k, v in trades.trades.items()
-            # }
-            self._activity_log.update(orders=trades.place_orders(MarketOrder,
-                                                                 order_properties=self._order_properties))
-            self._env.logging.info(f"Orders placed: {self._activity_log['orders']}")
+            if self._execution_mode == 'limit':
+                execution = LimitExecution(trades,
+                                           self._env.config.get('limitPriceDistance', 0),
+                                           self._env.config.get('limitRepriceAttempts', LimitExecution.REPRICE_ATTEMPTS),
+                                           self._env.config.get('limitRepriceSeconds', LimitExecution.REPRICE_SECONDS))
+                self._activity_log.update(orders=execution.place_orders(order_properties=self._order_properties),
+                                          execution=execution.report())
+            else:
+                self._activity_log.update(orders=trades.place_orders(MarketOrder,
+                                                                     order_properties=self._order_properties))
+            self._env.logging.info('Orders placed: %s', self._activity_log['orders'])
+
+    def _cancel_open_orders(self):
+        """
+        Cancels all open orders at once and removes the cancelled ones from openOrders.
+        """
+        open_trades = self._env.ibgw.openTrades()
+        if not len(open_trades):
+            self._activity_log.update(cancelledOrders=[])
+            return
+
+        self._env.ibgw.reqGlobalCancel()
+        # wait for the cancellation confirmations
+        deadline = monotonic() + self.CANCEL_TIMEOUT
+        while not all(t.isDone() for t in open_trades) and (remaining := deadline - monotonic()) > 0:
+            self._env.ibgw.waitOnUpdate(timeout=remaining)
+        cancelled = {t.order.permId for t in open_trades if t.orderStatus.status in ['Cancelled', 'ApiCancelled']}
+        if len(pending := [t.order.permId for t in open_trades if not t.isDone()]):
+            self._env.logging.warning('No cancellation confirmation for %s', pending)
+        self._activity_log.update(cancelledOrders=sorted(cancelled))
+
+        # one query for the account's open orders, then batched deletes
+        docs = [doc for doc in self._env.db.collection(f'positions/{self._env.trading_mode}/openOrders')
+                .where('acctNumber', '==', self._env.config['account']).get()
+                if doc.get('permId') in cancelled]
+        for i in range(0, len(docs), self.BATCH_SIZE):
+            batch = self._env.db.batch()
+            for doc in docs[i:i + self.BATCH_SIZE]:
+                batch.delete(doc.reference)
+            batch.commit()
+        self._env.logging.info('Cancelled %d orders, deleted %d documents from /positions/%s/openOrders',
+                               len(cancelled), len(docs), self._env.trading_mode)
 
 
 if __name__ == '__main__':
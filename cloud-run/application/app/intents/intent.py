@@ -2,12 +2,16 @@ import json
 from datetime import datetime
 from hashlib import md5
 
+from lib.activity_log import ActivityLogWriter
 from lib.environment import Environment
+from lib.fills import FillHandler
+from lib.tracing import Tracer
 
 
 class Intent:
 
     _activity_log = {}
+    _requires_gateway = True
 
     def __init__(self, **kwargs):
         self._env = Environment()
@@ -33,7 +37,8 @@ class Intent:
         if len(self._activity_log):
             try:
                 self._activity_log.update(timestamp=datetime.utcnow())
-                self._env.db.collection('activity').document().set(self._activity_log)
+                # written asynchronously so that the response doesn't wait for Firestore
+                ActivityLogWriter().enqueue({**self._activity_log})
             except Exception as e:
                 self._env.logging.error(e)
                 self._env.logging.info(self._activity_log)
@@ -41,10 +46,17 @@ class Intent:
     def run(self):
         retval = {}
         exc = None
+        # keep the gateway session open between requests if configured
+        persistent = self._env.config.get('persistentGateway', False)
+        Tracer.begin(self.__class__.__name__)
         try:
-            self._env.ibgw.start_and_connect()
-            # https://interactivebrokers.github.io/tws-api/market_data_type.html
-            self._env.ibgw.reqMarketDataType(self._env.config['marketDataType'])
+            if self._requires_gateway and not (persistent and self._env.ibgw.isConnected()):
+                self._env.ibgw.start_and_connect()
+                # https://interactivebrokers.github.io/tws-api/market_data_type.html
+                self._env.ibgw.reqMarketDataType(self._env.config['marketDataType'])
+            if self._requires_gateway and persistent:
+                # apply fills to holdings for as long as the session lives (received during IB calls only)
+                FillHandler.attach(self._env.ibgw)
             retval = self._core()
         except Exception as e:
             error_str = f'{e.__class__.__name__}: {e}'
@@ -52,7 +64,10 @@ class Intent:
             self._activity_log.update(exception=error_str)
             exc = e
         finally:
-            self._env.ibgw.stop_and_terminate()
+            if self._requires_gateway and not persistent:
+                self._env.ibgw.stop_and_terminate()
+            # time spent in IB, Firestore and BigQuery calls
+            self._activity_log.update(spans=Tracer.end())
             if self._env.env['K_REVISION'] != 'localhost':
                 self._log_activity()
             if exc is not None:
@@ -0,0 +1,61 @@
+from time import perf_counter
+
+from intents.intent import Intent
+
+
+class Pipeline(Intent):
+    """
+    Runs several intents back to back within a single gateway session, recording
+    the activity and timing of each step in one activity log entry.
+    """
+
+    INTENTS = {}  # registered in main.py
+    STEP_LOG_EXCLUDE = ['agent', 'config', 'intent', 'signature', 'tradingMode']
+    _steps = []
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        steps = kwargs.get('intents', [])
+        if any([s.get('intent') not in self.INTENTS.keys() for s in steps]):
+            raise KeyError(f"Unknown intents: {','.join([str(s.get('intent')) for s in steps if s.get('intent') not in self.INTENTS.keys()])}")
+        # instantiate all steps upfront so that invalid arguments fail before the gateway is started
+        self._steps = [(s['intent'], self.INTENTS[s['intent']](**s.get('kwargs', {}))) for s in steps]
+        self._activity_log.update(intents=[name for name, _ in self._steps])
+
+    def _core(self):
+        steps = []
+        self._activity_log.update(steps=steps)
+        for name, intent in self._steps:
+            self._env.logging.info(f'Running pipeline step {name}...')
+            step = {'intent': name, 'signature': intent._signature}
+            steps.append(step)
+            start = perf_counter()
+            try:
+                if (result := intent._core()) is not None:
+                    step.update(result=result)
+            except Exception as e:
+                step.update(exception=f'{e.__class__.__name__}: {e}')
+                raise e
+            finally:
+                step.update(activity={k: v for k, v in intent._activity_log.items() if k not in self.STEP_LOG_EXCLUDE},
+                            seconds=round(perf_counter() - start, 3))
+                self._env.logging.info(f"Pipeline step {name} took {step['seconds']}s")
+
+
+if __name__ == '__main__':
+    from intents.summary import Summary
+    from intents.trade_reconciliation import TradeReconciliation
+    from lib.environment import Environment
+
+    env = Environment()
+    env.ibgw.connect(port=4001)
+    try:
+        Pipeline.INTENTS = {'summary': Summary, 'trade-reconciliation': TradeReconciliation}
+        pipeline = Pipeline(intents=[{'intent': 'trade-reconciliation'}, {'intent': 'summary'}])
+        pipeline._core()
+        print(pipeline._activity_log)
+    except Exception as e:
+        raise e
+    finally:
+        env.ibgw.disconnect()
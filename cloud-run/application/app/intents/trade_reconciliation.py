@@ -1,14 +1,66 @@
-from google.cloud.firestore_v1 import DELETE_FIELD
-from ib_insync import Contract, util
+from google.cloud.firestore_v1 import transactional
+from ib_insync import Contract, ExecutionFilter, util
 
 from intents.intent import Intent
+from lib.fills import FillHandler
+
+
+@transactional
+def _advance_checkpoint(transaction, checkpoint_doc, checkpoint):
+    """
+    Advances the execution checkpoint, unless a concurrent run has moved it further already.
+
+    :param transaction: Firestore transaction (Transaction)
+    :param checkpoint_doc: checkpoint document (DocumentReference)
+    :param checkpoint: new checkpoint (dict)
+    :return: whether the checkpoint was advanced (bool)
+    """
+    current = checkpoint_doc.get(transaction=transaction).to_dict() or {}
+    if current.get('time') is not None and current['time'] > checkpoint['time']:
+        return False
+    if current.get('time') == checkpoint['time']:
+        checkpoint = {**checkpoint, 'execIds': sorted(set(current.get('execIds', [])) | set(checkpoint['execIds']))}
+    transaction.set(checkpoint_doc, checkpoint)
+    return True
 
 
 class TradeReconciliation(Intent):
 
+    EXECUTION_TIME_FORMAT = '%Y%m%d-%H:%M:%S'
+
     def __init__(self):
         super().__init__()
 
+    def _get_new_fills(self, checkpoint):
+        """
+        Requests the executions since the checkpoint and drops the ones processed already.
+
+        :param checkpoint: time and execution IDs processed at that time (dict)
+        :return: new fills in chronological order (list of ib_insync Fill objects)
+        """
+        # IB filters by whole seconds (UTC), so the executions at the checkpoint time are returned again
+        since = checkpoint.get('time')
+        execution_filter = ExecutionFilter(acctCode=self._env.config['account'],
+                                           time=since.strftime(self.EXECUTION_TIME_FORMAT) if since is not None else '')
+        processed = set(checkpoint.get('execIds', []))
+        fills = [f for f in self._env.ibgw.reqExecutions(execution_filter) if f.execution.execId not in processed]
+        return sorted(fills, key=lambda f: f.execution.time)
+
+    @staticmethod
+    def _next_checkpoint(checkpoint, fills):
+        """
+        Derives the checkpoint after processing fills.
+
+        :param checkpoint: current checkpoint (dict)
+        :param fills: processed fills (list of ib_insync Fill objects)
+        :return: new checkpoint (dict)
+        """
+        time = max(f.execution.time for f in fills)
+        exec_ids = {f.execution.execId for f in fills if f.execution.time == time}
+        if checkpoint.get('time') == time:
+            exec_ids |= set(checkpoint.get('execIds', []))
+        return {'time': time, 'execIds': sorted(exec_ids)}
+
     def _core(self):
         self._env.logging.info('Running trade reconciliation...')
 
@@ -21,48 +73,31 @@ class TradeReconciliation(Intent):
             } for t in self._env.ibgw.trades()
         ])
 
-        # reconcile trades
+        # reconcile trades (this picks up fills that the fill handler hasn't received, e.g. between requests)
+        checkpoint_doc = self._env.db.document(f'positions/{self._env.trading_mode}/checkpoints/executions')
+        checkpoint = checkpoint_doc.get().to_dict() or {}
+        new_fills = self._get_new_fills(checkpoint)
+        self._env.logging.info('%d new executions since %s', len(new_fills), checkpoint.get('time'))
+        fill_handler = FillHandler()
+        open_orders = list(self._env.db.collection(f'positions/{self._env.trading_mode}/openOrders')
+                           .where('acctNumber', '==', self._env.config['account']).get()) if len(new_fills) else []
         fills = []
-        for fill in self._env.ibgw.fills():
+        for fill in new_fills:
             # logging.debug(util.tree(fill.nonDefaults()))
-            contract_id = fill.contract.conId
-            query = self._env.db.collection(f'positions/{self._env.trading_mode}/openOrders')\
-                .where('permId', '==', fill.execution.permId)
-            res = list(query.get())
-            if len(res):
-                order_doc = res[0].reference
-                order = res[0].to_dict()
-            else:
-                # retry with orderId and contractId
-                query = self._env.db.collection(f'positions/{self._env.trading_mode}/openOrders')\
-                    .where('orderId', '==', fill.execution.orderId)\
-                    .where('contractId', '==', contract_id)
-                res = list(query.get())
-                if len(res):
-                    order_doc = res[0].reference
-                    order = res[0].to_dict()
-                else:
-                    continue
-
+            order_doc = fill_handler.find_open_order(fill.execution, fill.contract.conId, open_orders)
             # update holdings if fully executed
-            side = 1 if fill.execution.side == 'BOT' else -1
-            if len(order) and side * fill.execution.cumQty == sum(order['source'].values()):
+            if order_doc is not None and fill_handler.complete_order(order_doc, fill):
+                open_orders.remove(order_doc)
                 fills.append({
                     'contract': fill.contract.nonDefaults(),
                     'execution': util.tree(fill.execution.nonDefaults())
                 })
-
-                for strategy, quantity in order['source'].items():
-                    holdings_doc = self._env.db.document(f'positions/{self._env.trading_mode}/holdings/{strategy}')
-                    holdings = holdings_doc.get().to_dict() or {}
-                    position = holdings.get(str(contract_id), 0)
-
-                    with self._env.db.transaction() as tx:
-                        action = tx.update if holdings_doc.get().exists else tx.set
-                        action(holdings_doc, {str(contract_id): position + quantity or DELETE_FIELD})
-                        tx.delete(order_doc)
         self._activity_log.update(fills=fills)
-        self._env.logging.info(f'Fills: {fills}')
+        self._env.logging.info('Fills: %s', fills)
+        if len(new_fills):
+            checkpoint = self._next_checkpoint(checkpoint, new_fills)
+            _advance_checkpoint(self._env.db.transaction(), checkpoint_doc, checkpoint)
+            self._activity_log.update(checkpoint=checkpoint['time'].isoformat())
 
         # double-check with IB portfolio
         self._env.logging.info('Comparing Firestore holdings with IB portfolio...')
@@ -79,8 +114,10 @@ class TradeReconciliation(Intent):
                     holdings_consolidated[k] += v
                 else:
                     holdings_consolidated[k] = v
+        # contract details are only needed for holdings not in the portfolio
+        local_symbols = {item.contract.conId: item.contract.localSymbol for item in ib_portfolio}
         self._activity_log.update(consolidatedHoldings={
-            self._env.ibgw.reqContractDetails(Contract(conId=k))[0].contract.localSymbol: v
+            local_symbols.get(k) or self._env.ibgw.reqContractDetails(Contract(conId=k))[0].contract.localSymbol: v
             for k, v in holdings_consolidated.items()
         })
         if portfolio != holdings_consolidated:
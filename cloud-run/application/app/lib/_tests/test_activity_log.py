@@ -0,0 +1,159 @@
+from datetime import datetime
+from google.api_core.exceptions import ServiceUnavailable
+from queue import Queue
+import unittest
+from unittest.mock import call, MagicMock, patch
+
+from lib.activity_log import ActivityLogWriter
+from lib.activity_log import md5
+
+
+class TestActivityLogWriter(unittest.TestCase):
+
+    CONFIG = {'a': 1, 'b': 'c'}
+    CONFIG_HASH = md5(b'{"a": 1, "b": "c"}').hexdigest()
+
+    @patch('lib.activity_log.Environment')
+    def setUp(self, *_):
+        self.test_obj = ActivityLogWriter()
+        self.test_obj._config_hashes = set()
+        self.test_obj._queue = Queue()
+
+    @patch('lib.activity_log.Thread')
+    def test_enqueue(self, thread):
+        with patch.object(ActivityLogWriter, '_thread', None):
+            self.test_obj.enqueue({'abc': 123})
+            self.test_obj.enqueue({'def': 456}, 'profiles')
+            self.assertEqual(('activity', {'abc': 123}), self.test_obj._queue.get_nowait())
+            self.assertEqual(('profiles', {'def': 456}), self.test_obj._queue.get_nowait())
+            try:
+                thread.assert_called_once_with(target=self.test_obj._run, name='activity-log-writer', daemon=True)
+                thread.return_value.start.assert_called_once()
+            except AssertionError:
+                self.fail()
+
+    @patch('lib.activity_log.atexit')
+    @patch('lib.activity_log.Thread')
+    def test_enqueue_restart(self, thread, atexit):
+        # a restarted thread doesn't register the flush at exit again
+        thread.return_value.is_alive.return_value = False
+        with patch.object(ActivityLogWriter, '_thread', None), patch.object(ActivityLogWriter, '_atexit_registered', False):
+            self.test_obj.enqueue({'abc': 123})
+            self.test_obj.enqueue({'def': 456})
+            self.assertEqual(2, thread.return_value.start.call_count)
+            try:
+                atexit.register.assert_called_once_with(self.test_obj.flush)
+            except AssertionError:
+                self.fail()
+
+    def test_dedup_config(self):
+        batch = MagicMock()
+        with patch.object(self.test_obj, '_env', db=MagicMock()) as env:
+            self.assertDictEqual({'abc': 123}, self.test_obj._dedup_config({'abc': 123}, batch, set()))
+
+            config_hashes = set()
+            actual = self.test_obj._dedup_config({'abc': 123, 'config': self.CONFIG}, batch, config_hashes)
+            self.assertDictEqual({'abc': 123, 'configHash': self.CONFIG_HASH}, actual)
+            self.assertSetEqual({self.CONFIG_HASH}, config_hashes)
+            self.test_obj._dedup_config({'abc': 123, 'config': self.CONFIG}, batch, config_hashes)
+            try:
+                env.db.collection.assert_called_once_with('activityConfigs')
+                env.db.collection.return_value.document.assert_called_once_with(self.CONFIG_HASH)
+                batch.set.assert_called_once_with(env.db.collection.return_value.document.return_value, self.CONFIG)
+            except AssertionError:
+                self.fail()
+
+    def test_write(self):
+        timestamp = datetime(1977, 9, 27, 19, 15)
+        items = [('activity', {'intent': 'Intent', 'config': self.CONFIG, 'timestamp': timestamp}),
+                 ('activity', {'intent': 'Intent', 'config': self.CONFIG, 'timestamp': timestamp})]
+
+        with patch.object(self.test_obj, '_env', config={}, db=MagicMock(), bq=MagicMock()) as env:
+            self.test_obj._write(items)
+            self.assertSetEqual({self.CONFIG_HASH}, self.test_obj._config_hashes)
+            try:
+                env.db.batch.assert_called_once()
+                env.db.collection.assert_has_calls([call('activityConfigs'), call('activity'), call('activity')], any_order=True)
+                self.assertEqual(3, env.db.batch.return_value.set.call_count)
+                env.db.batch.return_value.set.assert_called_with(env.db.collection.return_value.document.return_value,
+                                                                 {'intent': 'Intent', 'timestamp': timestamp, 'configHash': self.CONFIG_HASH})
+                env.db.batch.return_value.commit.assert_called_once()
+                env.bq.insert_rows_json.assert_not_called()
+            except AssertionError:
+                self.fail()
+
+        with patch.object(self.test_obj, '_env', config={'activityLogBigQueryTable': 'dataset.table'}, db=MagicMock(), bq=MagicMock(insert_rows_json=MagicMock(return_value=[]))) as env:
+            self.test_obj._write(items[:1])
+            try:
+                self.assertEqual(1, env.db.batch.return_value.set.call_count)
+                env.bq.insert_rows_json.assert_called_once_with('dataset.table', [{
+                    'timestamp': timestamp.isoformat(),
+                    'tradingMode': None,
+                    'intent': 'Intent',
+                    'signature': None,
+                    'configHash': self.CONFIG_HASH,
+                    'entry': f'{{"intent": "Intent", "timestamp": "{timestamp}", "configHash": "{self.CONFIG_HASH}"}}'
+                }])
+            except AssertionError:
+                self.fail()
+
+        # a permanent error falls back to writing the entries one by one
+        with patch.object(self.test_obj, '_env', config={}, db=MagicMock(batch=MagicMock(side_effect=Exception)), logging=MagicMock()) as env:
+            self.test_obj._write(items)
+            try:
+                self.assertEqual(3, env.db.batch.call_count)
+                env.logging.warning.assert_called_once()
+                self.assertEqual(2, env.logging.error.call_count)
+                env.logging.info.assert_has_calls([call(i[1]) for i in items])
+            except AssertionError:
+                self.fail()
+
+        # only the bad entry is dropped
+        bad = ('activity', {'intent': 'Bad'})
+        with patch.object(self.test_obj, '_env', config={}, db=MagicMock(), logging=MagicMock()) as env:
+            env.db.batch.return_value.commit.side_effect = [ValueError, None, ValueError]
+            self.test_obj._write([items[0], bad])
+            try:
+                self.assertEqual(3, env.db.batch.return_value.commit.call_count)
+                env.logging.error.assert_called_once()
+                env.logging.info.assert_called_once_with(bad[1])
+            except AssertionError:
+                self.fail()
+
+    @patch('lib.activity_log.sleep')
+    def test_commit(self, sleep):
+        items = [('activity', {'intent': 'Intent'})]
+        with patch.object(self.test_obj, '_env', db=MagicMock(), logging=MagicMock()) as env:
+            env.db.batch.return_value.commit.side_effect = [ServiceUnavailable('unavailable'), None]
+            self.assertListEqual(items, self.test_obj._commit(items))
+            try:
+                self.assertEqual(2, env.db.batch.call_count)
+                sleep.assert_called_once_with(self.test_obj.RETRY_WAIT)
+            except AssertionError:
+                self.fail()
+
+        # transient errors are raised after the last retry, and the entries aren't written one by one
+        with patch.object(self.test_obj, '_env', config={}, db=MagicMock(), logging=MagicMock()) as env:
+            env.db.batch.return_value.commit.side_effect = ServiceUnavailable('unavailable')
+            self.test_obj._write(items * 2)
+            try:
+                self.assertEqual(self.test_obj.RETRIES + 1, env.db.batch.call_count)
+                env.logging.error.assert_called_once()
+                self.assertEqual(2, env.logging.info.call_count)
+            except AssertionError:
+                self.fail()
+
+    def test_run_and_flush(self):
+        with patch.object(self.test_obj, '_write', side_effect=[None, StopIteration]) as write:
+            with patch.object(self.test_obj, 'BATCH_WAIT', 0.01):
+                for i in range(3):
+                    self.test_obj._queue.put(('activity', {'i': i}))
+                with patch.object(self.test_obj, 'BATCH_SIZE', 2):
+                    self.assertRaises(StopIteration, self.test_obj._run)
+                self.assertListEqual([call([('activity', {'i': 0}), ('activity', {'i': 1})]), call([('activity', {'i': 2})])],
+                                     write.call_args_list)
+                self.assertEqual(0, self.test_obj._queue.unfinished_tasks)
+
+
+if __name__ == '__main__':
+    unittest.main()
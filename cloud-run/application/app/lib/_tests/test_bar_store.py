@@ -0,0 +1,114 @@
+from datetime import datetime
+import numpy as np
+from tempfile import TemporaryDirectory
+from threading import Thread
+import unittest
+from unittest.mock import MagicMock, patch
+
+from lib.bar_store import BarStore
+
+
+class TestBarStore(unittest.TestCase):
+
+    KEY = 'ABC_1day'
+
+    @patch('lib.bar_store.Environment', return_value=MagicMock(config={}))
+    def setUp(self, *_):
+        self.tmp_dir = TemporaryDirectory()
+        self.test_obj = BarStore(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @staticmethod
+    def bars(days, close):
+        timestamps = np.array([f'2022-01-{d:02d}' for d in days], dtype='datetime64[ns]')
+        return timestamps, [[c, c, c, c, 100] for c in close]
+
+    def test_key(self):
+        self.assertEqual('ABC_1day', BarStore.key('ABC', '1 day'))
+        self.assertEqual('123_5mins', BarStore.key(123, '5 mins'))
+
+    @patch('lib.bar_store.Environment', return_value=MagicMock(config={'barStorePath': 'path'}))
+    def test_init(self, *_):
+        self.assertEqual('path', BarStore()._root)
+
+    def test_merge_and_slice(self):
+        timestamps, values = self.test_obj.load(self.KEY)
+        self.assertEqual(0, len(timestamps))
+        self.assertTupleEqual((0, 5), values.shape)
+
+        self.assertEqual(3, self.test_obj.merge(self.KEY, *self.bars([3, 4, 5], [1, 2, 3])))
+        # append
+        self.assertEqual(5, self.test_obj.merge(self.KEY, *self.bars([6, 7], [4, 5])))
+        # overlapping and earlier bars, new values take precedence
+        self.assertEqual(6, self.test_obj.merge(self.KEY, *self.bars([5, 2], [30, 0])))
+
+        timestamps, values = self.test_obj.load(self.KEY)
+        self.assertIsInstance(values, np.memmap)
+        self.assertListEqual(list(self.bars([2, 3, 4, 5, 6, 7], [])[0]), list(timestamps))
+        self.assertListEqual([0, 1, 2, 30, 4, 5], values[:, 3].tolist())
+
+        timestamps, values = self.test_obj.slice(self.KEY, datetime(2022, 1, 3), np.datetime64('2022-01-06'))
+        self.assertEqual(3, len(timestamps))
+        # views of the memory map
+        self.assertIsInstance(values, np.memmap)
+        self.assertListEqual([1, 2, 30], values[:, 3].tolist())
+
+        timestamps, close = self.test_obj.column(self.KEY, start=datetime(2022, 1, 6))
+        self.assertListEqual([4, 5], close.tolist())
+        _, volume = self.test_obj.column(self.KEY, 'volume')
+        self.assertListEqual([100] * 6, volume.tolist())
+
+        # appending from the last stored bar replaces it
+        self.assertEqual(7, self.test_obj.merge(self.KEY, *self.bars([7, 8], [50, 6])))
+        self.assertListEqual([0, 1, 2, 30, 4, 50, 6], self.test_obj.column(self.KEY)[1].tolist())
+
+    def test_merge_concurrently(self):
+        threads = [Thread(target=self.test_obj.merge, args=(self.KEY, *self.bars([d], [d]))) for d in range(1, 21)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertListEqual([*range(1, 21)], self.test_obj.column(self.KEY)[1].tolist())
+
+    def test_covers(self):
+        self.assertFalse(self.test_obj.covers(self.KEY))
+        self.test_obj.merge(self.KEY, *self.bars([3, 4], [1, 2]))
+        self.assertTrue(self.test_obj.covers(self.KEY))
+        self.assertTrue(self.test_obj.covers(self.KEY, datetime(2022, 1, 4)))
+        self.assertFalse(self.test_obj.covers(self.KEY, datetime(2022, 1, 5)))
+
+    def test_sync(self):
+        rows = [
+            {'timestamp': 1641168000000000, 'open': 1, 'high': 2, 'low': 0, 'close': 1.5, 'volume': 10},
+            {'timestamp': 1641254400000000, 'open': 2, 'high': 3, 'low': 1, 'close': 2.5, 'volume': 20}
+        ]
+        with patch.object(self.test_obj, '_env', config={'barStoreTable': 'dataset.table'}, logging=MagicMock(),
+                          query_bigquery=MagicMock(side_effect=[rows, []])) as env:
+            self.assertEqual(2, self.test_obj.sync(self.KEY))
+            self.assertEqual(0, self.test_obj.sync(self.KEY))
+            self.assertIn('timestamp >= TIMESTAMP_MICROS(@since)', env.query_bigquery.call_args_list[0][0][0])
+            timestamps, values = self.test_obj.load(self.KEY)
+            self.assertListEqual([np.datetime64('2022-01-03', 'ns'), np.datetime64('2022-01-04', 'ns')], list(timestamps))
+            self.assertListEqual([2, 3, 1, 2.5, 20], values[1].tolist())
+            try:
+                self.assertIn('`dataset.table`', env.query_bigquery.call_args_list[0][0][0])
+                self.assertDictEqual({'key': self.KEY, 'since': 0}, env.query_bigquery.call_args_list[0][0][1])
+                self.assertDictEqual({'key': self.KEY, 'since': rows[1]['timestamp']}, env.query_bigquery.call_args_list[1][0][1])
+            except AssertionError:
+                self.fail()
+
+    def test_sync_in_background(self):
+        with patch.object(self.test_obj, 'sync', side_effect=[1, Exception('error')]) as sync, \
+                patch.object(self.test_obj, '_env', logging=MagicMock()) as env:
+            self.test_obj.sync_in_background('a', 'b', table='dataset.table').join()
+            try:
+                sync.assert_called_with('b', 'dataset.table')
+                env.logging.warning.assert_called_once()
+            except AssertionError:
+                self.fail()
+
+
+if __name__ == '__main__':
+    unittest.main()
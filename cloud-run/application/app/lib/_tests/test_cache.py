@@ -0,0 +1,48 @@
+import os
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+from lib.cache import DiskCache
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.test_obj = DiskCache(self.tmp_dir.name, max_bytes=1300)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_key(self):
+        self.assertEqual(DiskCache.key('query', {'a': 1, 'b': 2}), DiskCache.key('query', {'b': 2, 'a': 1}))
+        self.assertNotEqual(DiskCache.key('query', {'a': 1}), DiskCache.key('query', {'a': 2}))
+
+    def test_get_set(self):
+        self.assertIsNone(self.test_obj.get('key'))
+        self.test_obj.set('key', [{'a': 1}], 60)
+        self.assertListEqual([{'a': 1}], self.test_obj.get('key'))
+
+        with patch('lib.cache.time', return_value=0):
+            self.test_obj.set('key', 'value', 60)
+        self.assertIsNone(self.test_obj.get('key'))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, 'key.pkl')))
+
+        self.test_obj.delete('key')
+
+    def test_evict(self):
+        for i in range(3):
+            self.test_obj.set(f'key{i}', 'x' * 400, 60)
+            os.utime(os.path.join(self.tmp_dir.name, f'key{i}.pkl'), (i, i))
+        # recently used entries are kept
+        self.test_obj.get('key0')
+        self.test_obj.set('key3', 'x' * 100, 60)
+        self.assertIsNone(self.test_obj.get('key1'))
+        self.assertIsNotNone(self.test_obj.get('key0'))
+        self.assertIsNotNone(self.test_obj.get('key2'))
+        self.assertEqual('x' * 100, self.test_obj.get('key3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
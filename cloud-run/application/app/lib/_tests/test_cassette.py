@@ -0,0 +1,132 @@
+from eventkit import Event
+from ib_insync import MarketOrder, OrderStatus, Stock, Trade
+import os
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import MagicMock, patch
+
+from lib.cassette import Cassette
+
+
+class TestCassette(unittest.TestCase):
+
+    CONTRACT = Stock('ABC', 'SMART', 'USD')
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'cassette.pkl.gz')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @patch('lib.cassette.atexit')
+    def test_record_and_replay(self, atexit):
+        ibgw = MagicMock()
+        ibgw.reqContractDetails.side_effect = [['details']]
+        ibgw.accountValues.side_effect = [[], ['value']]
+        ibgw.reqTickers.side_effect = ValueError('error')
+        stop_and_terminate = ibgw.stop_and_terminate
+
+        cassette = Cassette(self.path, 'record')
+        cassette.attach(ibgw)
+        self.assertListEqual(['details'], ibgw.reqContractDetails(self.CONTRACT))
+        self.assertListEqual([], ibgw.accountValues('account'))
+        self.assertListEqual(['value'], ibgw.accountValues('account'))
+        self.assertRaises(ValueError, ibgw.reqTickers, self.CONTRACT)
+        ibgw.stop_and_terminate()
+        self.assertTrue(os.path.exists(self.path))
+        try:
+            stop_and_terminate.assert_called_once()
+            atexit.register.assert_called_once_with(cassette.save)
+        except AssertionError:
+            self.fail()
+
+        ibgw = MagicMock()
+        sleep = ibgw.sleep
+        cassette = Cassette(self.path, time_scale=0.5)
+        cassette.attach(ibgw)
+        self.assertTrue(ibgw.isConnected())
+        self.assertIsNone(ibgw.start_and_connect())
+        self.assertListEqual(['details'], ibgw.reqContractDetails(Stock('ABC', 'SMART', 'USD')))
+        self.assertListEqual([], ibgw.accountValues('account'))
+        self.assertListEqual(['value'], ibgw.accountValues('account'))
+        # the last result is served again when polling
+        self.assertListEqual(['value'], ibgw.accountValues('account'))
+        self.assertRaises(ValueError, ibgw.reqTickers, self.CONTRACT)
+        self.assertRaises(KeyError, ibgw.reqContractDetails, Stock('DEF', 'SMART', 'USD'))
+        ibgw.sleep(2)
+        try:
+            sleep.assert_called_with(1.)
+            self.assertEqual(6, sleep.call_count)
+        except AssertionError:
+            self.fail()
+
+    @patch('lib.cassette.atexit')
+    def test_record_and_replay_orders(self, _):
+        def place_order(_, order):
+            # the order ID is assigned by the call
+            order.orderId = 1
+            ibgw.orderStatusEvent.emit('submitted')
+            return 'trade'
+
+        ibgw = MagicMock(orderStatusEvent=Event('orderStatusEvent'), execDetailsEvent=Event('execDetailsEvent'))
+        ibgw.placeOrder.side_effect = place_order
+        ibgw.reqCurrentTime.return_value = 'time'
+        cassette = Cassette(self.path, 'record')
+        cassette.attach(ibgw)
+        self.assertEqual('trade', ibgw.placeOrder(self.CONTRACT, MarketOrder('BUY', 1)))
+        ibgw.execDetailsEvent.emit('trade', 'fill')
+        ibgw.reqCurrentTime()
+        cassette.save()
+
+        ibgw = MagicMock()
+        cassette = Cassette(self.path)
+        cassette.attach(ibgw)
+        self.assertEqual('trade', ibgw.placeOrder(self.CONTRACT, MarketOrder('BUY', 1)))
+        try:
+            # emitted during the call, the fill after it
+            ibgw.orderStatusEvent.emit.assert_called_once_with('submitted')
+            ibgw.execDetailsEvent.emit.assert_not_called()
+        except AssertionError:
+            self.fail()
+        ibgw.sleep(1)
+        try:
+            ibgw.execDetailsEvent.emit.assert_called_once_with('trade', 'fill')
+        except AssertionError:
+            self.fail()
+        self.assertEqual('time', ibgw.reqCurrentTime())
+
+    @patch('lib.cassette.atexit')
+    def test_record_result_state(self, _):
+        trade = Trade(contract=self.CONTRACT, order=MarketOrder('BUY', 1), orderStatus=OrderStatus(status='Submitted'))
+        ibgw = MagicMock()
+        ibgw.placeOrder.return_value = trade
+        cassette = Cassette(self.path, 'record')
+        cassette.attach(ibgw)
+        self.assertIs(trade, ibgw.placeOrder(self.CONTRACT, MarketOrder('BUY', 1)))
+        # filled after the call
+        trade.orderStatus.status = 'Filled'
+        cassette.save()
+
+        ibgw = MagicMock()
+        Cassette(self.path).attach(ibgw)
+        self.assertEqual('Submitted', ibgw.placeOrder(self.CONTRACT, MarketOrder('BUY', 1)).orderStatus.status)
+
+    def test_replay_full_speed(self):
+        Cassette(self.path, 'record').save()
+        ibgw = MagicMock()
+        sleep = ibgw.sleep
+        Cassette(self.path).attach(ibgw)
+        ibgw.sleep(2)
+        try:
+            sleep.assert_not_called()
+        except AssertionError:
+            self.fail()
+
+    def test_init(self):
+        self.assertRaises(ValueError, Cassette, self.path, 'abc')
+        self.assertRaises(FileNotFoundError, Cassette, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -53,6 +53,7 @@ class TestEnvironment(unittest.TestCase):
 
         with patch.object(self.test_obj._Environment__instance, '_ibgw',
                           accountValues=MagicMock(side_effect=[[],
+                                                               [],
                                                                [],
                                                                [AccountValue(account='ABC', tag='NetLiquidation', value='123456', currency='CHF', modelCode=''),
                                                                 AccountValue(account='ABC', tag='CashBalance', value='123.45', currency='BASE',modelCode=''),
@@ -75,6 +76,18 @@ class TestEnvironment(unittest.TestCase):
                 except AssertionError:
                     self.fail()
 
+                # no waiting if account values are available already
+                p.reset_mock()
+                p.accountValues.side_effect = None
+                p.accountValues.return_value = [AccountValue(account='ABC', tag='NetLiquidation', value='123456', currency='CHF', modelCode='')]
+                actual = self.test_obj.get_account_values(account, rows=['NetLiquidation'])
+                self.assertDictEqual({'NetLiquidation': {'CHF': 123456.0}}, actual)
+                try:
+                    p.accountValues.assert_called_once_with(account)
+                    p.sleep.assert_not_called()
+                except AssertionError:
+                    self.fail()
+
 
 if __name__ == '__main__':
     unittest.main()
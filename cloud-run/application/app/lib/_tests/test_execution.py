@@ -0,0 +1,100 @@
+from datetime import datetime
+from ib_insync import MarketOrder
+import unittest
+from unittest.mock import MagicMock, patch
+
+from lib.execution import InstrumentSet, LimitExecution
+from lib.trading import Instrument, InstrumentRecord
+
+
+class TestLimitExecution(unittest.TestCase):
+
+    @patch('lib.execution.Environment')
+    def setUp(self, *_):
+        self.instrument = MagicMock(spec=Instrument, local_symbol='ABC', contract=MagicMock(conId=1),
+                                    tickers=MagicMock(midpoint=MagicMock(return_value=100.13), close=99),
+                                    record=InstrumentRecord(1, 'ABC', min_tick=0.25))
+        self.trade = MagicMock(trades={1: MagicMock(contract=self.instrument, quantity=2)})
+        self.test_obj = LimitExecution(self.trade, 0.01, reprice_attempts=2, reprice_seconds=5)
+
+    def test_round_to_tick(self):
+        self.assertEqual(4500.25, LimitExecution.round_to_tick(4500.49, 0.25, 'BUY'))
+        self.assertEqual(4500.5, LimitExecution.round_to_tick(4500.26, 0.25, 'SELL'))
+        self.assertEqual(0.3, LimitExecution.round_to_tick(0.3, 0.1, 'SELL'))
+        self.assertEqual(1.00055, LimitExecution.round_to_tick(1.00057, 0.00005, 'BUY'))
+
+    def test_reference_price(self):
+        self.assertEqual(100.13, LimitExecution.reference_price(self.instrument.tickers))
+        self.assertEqual(99, LimitExecution.reference_price(MagicMock(midpoint=MagicMock(return_value=float('nan')), close=99)))
+        self.assertIsNone(LimitExecution.reference_price(MagicMock(midpoint=MagicMock(return_value=float('nan')), close=float('nan'))))
+        self.assertIsNone(LimitExecution.reference_price(None))
+
+    def test_limit_price(self):
+        # 100.13 * 1.01 = 101.1313, rounded down for a buy
+        self.assertEqual(101., self.test_obj.limit_price(self.instrument, 2))
+        # 100.13 * 0.99 = 99.1287, rounded up for a sell
+        self.assertEqual(99.25, self.test_obj.limit_price(self.instrument, -2))
+        self.instrument.record = InstrumentRecord(1, 'ABC')
+        self.assertIsNone(self.test_obj.limit_price(self.instrument, 2))
+
+    @patch.object(LimitExecution, 'reprice')
+    def test_place_orders(self, reprice):
+        other = MagicMock(spec=Instrument, local_symbol='DEF', tickers=None, contract=MagicMock(conId=2))
+        self.trade.trades[2] = MagicMock(contract=other, quantity=-1)
+        with patch.object(InstrumentSet, 'get_tickers') as get_tickers:
+            actual = self.test_obj.place_orders({'key': 'param_value'}, {'key': 'property_value'})
+            self.assertEqual(self.trade.place_orders.return_value, actual)
+            try:
+                # the contract without ticker snapshot is requested, and placed as a market order without price
+                get_tickers.assert_called_once()
+                self.trade.place_orders.assert_called_once_with(
+                    MarketOrder, {'key': 'param_value'},
+                    {'key': 'property_value'}, None, limit_prices={1: 101.})
+                reprice.assert_called_once()
+            except AssertionError:
+                self.fail()
+        self.assertDictEqual({1: 100.13}, self.test_obj._arrival_prices)
+
+    def test_reprice(self):
+        self.test_obj._arrival_prices = {1: 100.13}
+        order = MagicMock(order=MagicMock(orderType='LMT', action='BUY', lmtPrice=101.),
+                          contract=MagicMock(conId=1), isActive=MagicMock(side_effect=[True, True, False]))
+        self.trade.orders = [order]
+        with patch.object(InstrumentSet, 'get_tickers'), patch.object(self.test_obj, '_env') as env:
+            self.instrument.tickers.midpoint.side_effect = [100.13, 101.5]
+            self.test_obj.reprice()
+            self.assertEqual(102.5, order.order.lmtPrice)
+            self.assertDictEqual({1: 1}, self.test_obj._reprices)
+            try:
+                # unchanged price in the first attempt, modified in the second
+                env.ibgw.placeOrder.assert_called_once_with(order.contract, order.order)
+                self.assertEqual(2, env.ibgw.sleep.call_count)
+            except AssertionError:
+                self.fail()
+
+    def test_report(self):
+        self.test_obj._arrival_prices = {1: 100.}
+        self.test_obj._reprices = {1: 2}
+        self.trade.orders = [
+            MagicMock(order=MagicMock(action='BUY', lmtPrice=101.), contract=MagicMock(conId=1),
+                      orderStatus=MagicMock(filled=2, avgFillPrice=100.5),
+                      log=[MagicMock(time=datetime(2022, 1, 3, 15, 0, 0))],
+                      fills=[MagicMock(time=datetime(2022, 1, 3, 15, 0, 3))]),
+            MagicMock(contract=MagicMock(conId=2))
+        ]
+        self.assertDictEqual({
+            'ABC': {
+                'arrivalPrice': 100.,
+                'limitPrice': 101.,
+                'filled': 2,
+                'avgFillPrice': 100.5,
+                'slippage': 0.5,
+                'slippageTicks': 2.,
+                'latencySeconds': 3.,
+                'reprices': 2
+            }
+        }, self.test_obj.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+from google.api_core.exceptions import Conflict
+import unittest
+from unittest.mock import call, MagicMock, patch
+
+from lib.fills import _complete_order, DELETE_FIELD, FillHandler
+
+
+class TestFillHandler(unittest.TestCase):
+
+    TRADING_MODE = 'paper'
+
+    @patch('lib.fills.Environment')
+    def setUp(self, *_):
+        self.test_obj = FillHandler()
+        self.fill = MagicMock(contract=MagicMock(conId=123),
+                              execution=MagicMock(execId='e1', permId=1, orderId=2, side='SLD', cumQty=3))
+
+    @patch('lib.fills.Environment')
+    def test_attach(self, *_):
+        ibgw = MagicMock()
+        with patch.object(FillHandler, '_attached', None):
+            handler = FillHandler.attach(ibgw)
+            self.assertIs(handler, FillHandler.attach(ibgw))
+            try:
+                ibgw.execDetailsEvent.connect.assert_called_once_with(handler.on_exec_details)
+                ibgw.commissionReportEvent.connect.assert_called_once_with(handler.on_commission_report)
+            except AssertionError:
+                self.fail()
+
+    def test_find_open_order(self):
+        docs = [MagicMock(get=MagicMock(side_effect=lambda k, d=d: d[k]))
+                for d in [{'permId': 0, 'orderId': 2, 'contractId': 123}, {'permId': 1, 'orderId': 5, 'contractId': 456}]]
+        self.assertEqual(docs[1], self.test_obj.find_open_order(self.fill.execution, 123, docs))
+        self.assertEqual(docs[0], self.test_obj.find_open_order(MagicMock(permId=9, orderId=2), 123, docs))
+        self.assertIsNone(self.test_obj.find_open_order(MagicMock(permId=9, orderId=2), 456, docs))
+
+        with patch.object(self.test_obj, '_env', trading_mode=self.TRADING_MODE) as env:
+            collection = env.db.collection.return_value
+            collection.where.return_value.get.return_value = []
+            collection.where.return_value.where.return_value.get.return_value = ['doc']
+            self.assertEqual('doc', self.test_obj.find_open_order(self.fill.execution, 123))
+            try:
+                env.db.collection.assert_called_with(f'positions/{self.TRADING_MODE}/openOrders')
+                collection.where.assert_has_calls([call('permId', '==', 1), call('orderId', '==', 2)], any_order=True)
+                collection.where.return_value.where.assert_called_once_with('contractId', '==', 123)
+            except AssertionError:
+                self.fail()
+
+            collection.where.return_value.where.return_value.get.return_value = []
+            self.assertIsNone(self.test_obj.find_open_order(self.fill.execution, 123))
+
+    def test__complete_order(self):
+        tx = MagicMock()
+        order_ref = MagicMock(get=MagicMock(return_value=MagicMock(to_dict=MagicMock(return_value={'source': {'s1': -1, 's2': -2}}))))
+        holdings_docs = [MagicMock(get=MagicMock(return_value=MagicMock(exists=True, to_dict=MagicMock(return_value={'123': 1})))),
+                         MagicMock(get=MagicMock(return_value=MagicMock(exists=False, to_dict=MagicMock(return_value=None))))]
+        db = MagicMock(document=MagicMock(side_effect=holdings_docs))
+        execution_doc = MagicMock(get=MagicMock(return_value=MagicMock(exists=False)))
+        self.assertDictEqual({'source': {'s1': -1, 's2': -2}},
+                             _complete_order.to_wrap(tx, db, self.TRADING_MODE, order_ref, self.fill, execution_doc, {'permId': 1}))
+        try:
+            # everything is read within the transaction
+            order_ref.get.assert_called_once_with(transaction=tx)
+            execution_doc.get.assert_called_once_with(transaction=tx)
+            for doc in holdings_docs:
+                doc.get.assert_called_once_with(transaction=tx)
+            db.document.assert_has_calls([call(f'positions/{self.TRADING_MODE}/holdings/s1'),
+                                          call(f'positions/{self.TRADING_MODE}/holdings/s2')])
+            tx.set.assert_has_calls([call(execution_doc, {'permId': 1}), call(holdings_docs[1], {'123': -2})])
+            tx.update.assert_called_once_with(holdings_docs[0], {'123': DELETE_FIELD})
+            tx.delete.assert_called_once_with(order_ref)
+        except AssertionError:
+            self.fail()
+
+        # partially filled: only the execution is recorded
+        tx.reset_mock()
+        self.fill.execution.cumQty = 2
+        self.assertIsNone(_complete_order.to_wrap(tx, db, self.TRADING_MODE, order_ref, self.fill, execution_doc, {'permId': 1}))
+        try:
+            tx.set.assert_called_once_with(execution_doc, {'permId': 1})
+            tx.update.assert_not_called()
+            tx.delete.assert_not_called()
+        except AssertionError:
+            self.fail()
+
+        # applied (and deleted) by a concurrent run already
+        tx.reset_mock()
+        self.fill.execution.cumQty = 3
+        order_ref.get.return_value.to_dict.return_value = None
+        self.assertIsNone(_complete_order.to_wrap(tx, db, self.TRADING_MODE, order_ref, self.fill))
+        try:
+            tx.set.assert_not_called()
+            tx.delete.assert_not_called()
+        except AssertionError:
+            self.fail()
+
+        # execution handled already
+        execution_doc.get.return_value.exists = True
+        self.assertRaises(Conflict, _complete_order.to_wrap, tx, db, self.TRADING_MODE, order_ref, self.fill, execution_doc, {})
+
+    def test__complete_order_calendar_spread(self):
+        tx = MagicMock()
+        order_ref = MagicMock(get=MagicMock(return_value=MagicMock(to_dict=MagicMock(return_value={'source': {'s1': 2}, 'legs': {'123': 1, '456': -1}}))))
+        holdings_doc = MagicMock(get=MagicMock(return_value=MagicMock(exists=True, to_dict=MagicMock(return_value={'456': 2}))))
+        db = MagicMock(document=MagicMock(return_value=holdings_doc))
+
+        # execution of a leg
+        fill = MagicMock(contract=MagicMock(conId=123, secType='FUT'), execution=MagicMock(side='BOT', cumQty=2))
+        self.assertIsNone(_complete_order.to_wrap(tx, db, self.TRADING_MODE, order_ref, fill))
+
+        fill = MagicMock(contract=MagicMock(conId=0, secType='BAG'), execution=MagicMock(side='BOT', cumQty=2))
+        self.assertIsNotNone(_complete_order.to_wrap(tx, db, self.TRADING_MODE, order_ref, fill))
+        try:
+            tx.update.assert_called_once_with(holdings_doc, {'123': 2, '456': DELETE_FIELD})
+            tx.delete.assert_called_once_with(order_ref)
+        except AssertionError:
+            self.fail()
+
+    def test_complete_order(self):
+        order_doc = MagicMock()
+        with patch.object(self.test_obj, '_env', trading_mode=self.TRADING_MODE) as env, \
+                patch('lib.fills._complete_order', return_value={'source': {'s1': -1}}) as complete_order:
+            self.assertTrue(self.test_obj.complete_order(order_doc, self.fill))
+            try:
+                complete_order.assert_called_once_with(env.db.transaction.return_value, env.db, self.TRADING_MODE,
+                                                       order_doc.reference, self.fill, None, None)
+                env.logging.info.assert_called_once()
+            except AssertionError:
+                self.fail()
+
+            complete_order.reset_mock()
+            self.assertTrue(self.test_obj.complete_order(order_doc, self.fill, {'permId': 1}))
+            try:
+                env.db.document.assert_called_once_with(f'positions/{self.TRADING_MODE}/executions/e1')
+                complete_order.assert_called_once_with(env.db.transaction.return_value, env.db, self.TRADING_MODE,
+                                                       order_doc.reference, self.fill, env.db.document.return_value, {'permId': 1})
+            except AssertionError:
+                self.fail()
+
+            complete_order.return_value = None
+            self.assertFalse(self.test_obj.complete_order(order_doc, self.fill))
+
+    def test_on_exec_details(self):
+        with patch.object(self.test_obj, '_env', trading_mode=self.TRADING_MODE) as env, \
+                patch.object(self.test_obj, 'find_open_order', side_effect=['order_doc', None, Exception('error')]) as find_open_order, \
+                patch.object(self.test_obj, 'complete_order') as complete_order:
+            self.test_obj.on_exec_details('trade', self.fill)
+            try:
+                find_open_order.assert_called_once_with(self.fill.execution, 123)
+                # recorded in the same transaction as the holdings
+                complete_order.assert_called_once()
+                self.assertEqual(('order_doc', self.fill), complete_order.call_args[0][:2])
+                self.assertEqual(1, complete_order.call_args[0][2]['permId'])
+                env.db.document.return_value.create.assert_not_called()
+            except AssertionError:
+                self.fail()
+
+            # no open order
+            self.test_obj.on_exec_details('trade', self.fill)
+            try:
+                self.assertEqual(1, complete_order.call_count)
+                env.db.document.assert_called_once_with(f'positions/{self.TRADING_MODE}/executions/e1')
+                self.assertEqual(1, env.db.document.return_value.create.call_args[0][0]['permId'])
+            except AssertionError:
+                self.fail()
+
+            # errors are logged, not raised into the event loop
+            self.test_obj.on_exec_details('trade', self.fill)
+            try:
+                env.logging.error.assert_called_once()
+            except AssertionError:
+                self.fail()
+
+            # handled already
+            find_open_order.side_effect = ['order_doc', None]
+            complete_order.side_effect = Conflict('exists')
+            env.db.document.return_value.create.side_effect = Conflict('exists')
+            self.test_obj.on_exec_details('trade', self.fill)
+            self.test_obj.on_exec_details('trade', self.fill)
+            try:
+                self.assertEqual(2, env.logging.debug.call_count)
+                env.logging.error.assert_called_once()
+            except AssertionError:
+                self.fail()
+
+    def test_on_commission_report(self):
+        report = MagicMock(commission=1.5, currency='USD', realizedPNL=10)
+        with patch.object(self.test_obj, '_env', trading_mode=self.TRADING_MODE) as env:
+            self.test_obj.on_commission_report('trade', self.fill, report)
+            try:
+                env.db.document.return_value.set.assert_called_once_with(
+                    {'commission': 1.5, 'commissionCurrency': 'USD', 'realizedPNL': 10}, merge=True)
+            except AssertionError:
+                self.fail()
+
+            env.db.document.return_value.set.side_effect = Exception('error')
+            self.test_obj.on_commission_report('trade', self.fill, report)
+            try:
+                env.logging.error.assert_called_once()
+            except AssertionError:
+                self.fail()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,8 @@
-from google.cloud.bigquery import ArrayQueryParameter, ScalarQueryParameter
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from google.cloud.bigquery import ArrayQueryParameter, QueryJobConfig, ScalarQueryParameter, StructQueryParameter
 from pandas import DataFrame
+import pyarrow as pa
 import unittest
 from unittest.mock import MagicMock, patch
 
@@ -33,13 +36,17 @@ class TestGcpModule(unittest.TestCase):
         data = [[1, 2, 3], [4, 5, 6]]
 
         with patch.object(GcpModule._bq, 'query',
-                          MagicMock(return_value=MagicMock(result=MagicMock(return_value=[MagicMock(items=MagicMock(return_value=[(f'col{i + 1}', v) for i, v in enumerate(row)])) for row in data]),
+                          MagicMock(return_value=MagicMock(result=MagicMock(return_value=MagicMock(total_rows=2, to_arrow=MagicMock(
+                                                               return_value=pa.table({f'col{i + 1}': v for i, v in enumerate(list(map(list, zip(*data))))})))),
+                                                           to_arrow=MagicMock(return_value=pa.table({f'col{i + 1}': v for i, v in enumerate(list(map(list, zip(*data))))})),
                                                            to_dataframe=MagicMock(return_value=DataFrame({f'col{i + 1}': v for i, v in enumerate(list(map(list, zip(*data))))}))))) as p:
             actual = func('query_str', job_config=query_job_config, return_type='list')
             expected = [{'col1': 1, 'col2': 2, 'col3': 3}, {'col1': 4, 'col2': 5, 'col3': 6}]
             self.assertEqual(expected, actual)
             try:
                 p.assert_called_with('query_str', job_config=query_job_config)
+                # small results don't need a Storage Read API session
+                p.return_value.result.return_value.to_arrow.assert_called_with(create_bqstorage_client=False)
             except AssertionError as e:
                 self.fail(e)
 
@@ -57,6 +64,13 @@ class TestGcpModule(unittest.TestCase):
             except AssertionError as e:
                 self.fail(e)
 
+            actual = func('query_str', job_config=query_job_config, return_type='arrow')
+            self.assertEqual(p.return_value.to_arrow.return_value, actual)
+            try:
+                p.return_value.to_arrow.assert_called_with(create_bqstorage_client=True)
+            except AssertionError as e:
+                self.fail(e)
+
             df = DataFrame({'col1': [1, 4], 'col2': [2, 5], 'col3': [3, 6]})
             expected = df
             actual = func('query_str', job_config=query_job_config, return_type='DataFrame')
@@ -78,6 +92,100 @@ class TestGcpModule(unittest.TestCase):
             p.return_value.side_effect = Exception
             self.assertRaises(Exception, func)
 
+    @patch('lib.gcp.bigquery.job.QueryJobConfig', config='something', query_parameters=[])
+    def test_query_bigquery_parameters(self, query_job_config):
+        timestamp = datetime(2022, 1, 3, 12, tzinfo=timezone.utc)
+        with patch.object(GcpModule._bq, 'query', MagicMock(return_value=MagicMock(total_bytes_processed=123))) as p, \
+                patch.object(GcpModule, '_logging') as logging:
+            self.test_obj.query_bigquery('query_str', {
+                'date': date(2022, 1, 3),
+                'datetime': datetime(2022, 1, 3, 12),
+                'timestamp': timestamp,
+                'numeric': Decimal('1.23'),
+                'bytes': b'abc',
+                'dates': [date(2022, 1, 3), date(2022, 1, 4)],
+                'struct': {'a': 1, 'b': 'b'},
+                'structs': [{'a': 1, 'ts': timestamp}, {'a': 2, 'ts': timestamp}],
+                'unsupported': {'a': None}
+            }, job_config=query_job_config, return_type='arrow', estimate_bytes=True)
+            expected = [
+                ScalarQueryParameter('date', 'DATE', date(2022, 1, 3)),
+                ScalarQueryParameter('datetime', 'DATETIME', datetime(2022, 1, 3, 12)),
+                ScalarQueryParameter('timestamp', 'TIMESTAMP', timestamp),
+                ScalarQueryParameter('numeric', 'NUMERIC', Decimal('1.23')),
+                ScalarQueryParameter('bytes', 'BYTES', b'abc'),
+                ArrayQueryParameter('dates', 'DATE', [date(2022, 1, 3), date(2022, 1, 4)]),
+                StructQueryParameter('struct', ScalarQueryParameter('a', 'INT64', 1), ScalarQueryParameter('b', 'STRING', 'b')),
+                ArrayQueryParameter('structs', 'STRUCT', [
+                    StructQueryParameter(None, ScalarQueryParameter('a', 'INT64', a), ScalarQueryParameter('ts', 'TIMESTAMP', timestamp))
+                    for a in [1, 2]
+                ])
+            ]
+            self.assertListEqual(expected, query_job_config.query_parameters)
+            try:
+                logging.warning.assert_called_once()
+                # dry run first
+                self.assertEqual(2, p.call_count)
+                self.assertIsNot(query_job_config, p.call_args_list[0][1]['job_config'])
+                logging.debug.assert_any_call('BigQuery query will process 123 bytes')
+            except AssertionError as e:
+                self.fail(e)
+
+            # no dry run by default
+            self.test_obj.query_bigquery('query_str', job_config=query_job_config, return_type='arrow')
+            self.assertEqual(3, p.call_count)
+
+    def test_query_bigquery_cache(self):
+        with patch.object(GcpModule, '_cache', get=MagicMock(side_effect=[None, ['cached']]), key=MagicMock(return_value='key')) as cache, \
+                patch.object(GcpModule._bq, 'query', MagicMock(return_value=MagicMock(result=MagicMock(return_value=MagicMock(
+                    total_rows=1, to_arrow=MagicMock(return_value=pa.table({'a': [1]}))))))) as p:
+            self.assertListEqual([{'a': 1}], self.test_obj.query_bigquery('query_str', {'b': 2}, return_type='list', cache_ttl=60))
+            self.assertListEqual(['cached'], self.test_obj.query_bigquery('query_str', {'b': 2}, return_type='list', cache_ttl=60))
+            self.test_obj.query_bigquery('query_str', return_type='list')
+            try:
+                cache.key.assert_called_with('query_str', {'b': 2}, {}, 'list', {})
+                cache.set.assert_called_once_with('key', [{'a': 1}], 60)
+                self.assertEqual(2, cache.get.call_count)
+                self.assertEqual(2, p.call_count)
+            except AssertionError as e:
+                self.fail(e)
+
+
+    def test_query_bigquery_dry_run_config(self):
+        job_config = QueryJobConfig(default_dataset='project.dataset')
+        with patch.object(GcpModule._bq, 'query', MagicMock(return_value=MagicMock(total_bytes_processed=123))) as p:
+            self.test_obj.query_bigquery('query_str', {'a': 1}, job_config=job_config, return_type='arrow', estimate_bytes=True)
+            dry_run_config = p.call_args_list[0][1]['job_config']
+            # the dry run keeps the rest of the config and leaves the original untouched
+            self.assertTrue(dry_run_config.dry_run)
+            self.assertFalse(dry_run_config.use_query_cache)
+            self.assertEqual(job_config.default_dataset, dry_run_config.default_dataset)
+            self.assertListEqual(job_config.query_parameters, dry_run_config.query_parameters)
+            self.assertFalse(job_config.dry_run)
+            self.assertIs(job_config, p.call_args_list[1][1]['job_config'])
+
+    def test_query_bigquery_list(self):
+        with patch.object(GcpModule._bq, 'query') as p:
+            rows = p.return_value.result.return_value
+            rows.total_rows = GcpModule.BQSTORAGE_MIN_ROWS
+            rows.to_arrow.return_value = pa.table({'a': [1, 2], 'b': ['x', None]})
+            self.assertListEqual([{'a': 1, 'b': 'x'}, {'a': 2, 'b': None}], self.test_obj.query_bigquery('query_str', return_type='list'))
+            try:
+                rows.to_arrow.assert_called_once_with(create_bqstorage_client=True)
+            except AssertionError as e:
+                self.fail(e)
+
+            rows.to_arrow.return_value = pa.table({'a': pa.array([], pa.int64())})
+            self.assertListEqual([], self.test_obj.query_bigquery('query_str', return_type='list'))
+
+    def test_query_bigquery_cache_key(self):
+        # queries that only differ in their job config are cached separately
+        with patch.object(GcpModule, '_cache', get=MagicMock(return_value=['cached'])) as cache:
+            for dataset in ['project.a', 'project.b']:
+                self.test_obj.query_bigquery('query_str', job_config=QueryJobConfig(default_dataset=dataset), cache_ttl=60)
+            keys = [c[0] for c in cache.key.call_args_list]
+            self.assertNotEqual(keys[0], keys[1])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,8 @@
 import unittest
-from unittest.mock import MagicMock, mock_open, patch
+from unittest.mock import AsyncMock, MagicMock, mock_open, patch
 
-from lib.ibgw import IBGW
+from lib.ibgw import IB, IBGW
+from lib.pacing import RequestPacer
 
 
 class TestIbgw(unittest.TestCase):
@@ -34,6 +35,109 @@ class TestIbgw(unittest.TestCase):
         self.assertDictEqual(self.test_obj.IB_CONFIG, ibgw.ib_config)
         self.assertEqual(self.CONNECTION_TIMEOUT, ibgw.connection_timeout)
         self.assertEqual(self.TIMEOUT_SLEEP, ibgw.timeout_sleep)
+        self.assertIsInstance(ibgw.pacer, RequestPacer)
+
+        pacer = MagicMock()
+        self.assertEqual(pacer, IBGW(self.IBC_CONFIG, pacer=pacer).pacer)
+
+    def test_use_cassette(self):
+        cassette = MagicMock()
+        self.test_obj.use_cassette(cassette)
+        self.assertEqual(cassette, self.test_obj.cassette)
+        try:
+            cassette.attach.assert_called_once_with(self.test_obj)
+        except AssertionError:
+            self.fail()
+
+    def test_pacing_metrics(self):
+        with patch.object(self.test_obj, 'pacer', metrics={'requests': 1}):
+            self.assertDictEqual({'requests': 1}, self.test_obj.pacing_metrics)
+
+    def test_place_order(self):
+        with patch.object(IB, 'placeOrder', return_value='trade') as place_order, \
+                patch.object(self.test_obj, 'pacer', reserve=MagicMock(side_effect=[0, 0.5])) as pacer, \
+                patch.object(self.test_obj, 'sleep') as sleep:
+            self.assertEqual('trade', self.test_obj.placeOrder('contract', 'order'))
+            sleep.assert_not_called()
+            self.test_obj.placeOrder('contract', 'order')
+            try:
+                sleep.assert_called_once_with(0.5)
+                self.assertEqual(2, pacer.reserve.call_count)
+                place_order.assert_called_with('contract', 'order')
+            except AssertionError:
+                self.fail()
+
+    def test_request_batch(self):
+        contracts = [MagicMock(__repr__=MagicMock(return_value=f'Contract(conId={i})')) for i in range(2)]
+        with patch.object(IB, 'reqHistoricalDataAsync', AsyncMock(side_effect=['bars0', 'bars1'])) as req_historical_data, \
+                patch.object(self.test_obj, 'pacer', reserve=MagicMock(return_value=0)) as pacer:
+            actual = self.test_obj.request_batch('reqHistoricalData', [
+                (contracts[0], '', '1 D', '1 day', 'TRADES', True),
+                {'contract': contracts[1], 'endDateTime': '', 'durationStr': '1 D', 'barSizeSetting': '1 day',
+                 'whatToShow': 'TRADES', 'useRTH': True}
+            ])
+            self.assertListEqual(['bars0', 'bars1'], actual)
+            try:
+                self.assertEqual(2, req_historical_data.call_count)
+                pacer.reserve.assert_called_with(1, historical_key=('Contract(conId=1)', '', '1 D', '1 day', 'TRADES', True),
+                                                 contract_key=('Contract(conId=1)', 'TRADES'))
+            except AssertionError:
+                self.fail()
+
+        with patch.object(IB, 'reqTickersAsync', AsyncMock(return_value=['ticker'] * 2)), \
+                patch.object(self.test_obj, 'pacer', reserve=MagicMock(return_value=0)) as pacer:
+            self.assertListEqual([['ticker'] * 2], self.test_obj.request_batch('reqTickers', [contracts]))
+            try:
+                pacer.reserve.assert_called_once_with(2)
+            except AssertionError:
+                self.fail()
+
+    def test_req_contract_details(self):
+        contract = MagicMock(__repr__=MagicMock(return_value='Contract(conId=1)'))
+        with patch.object(IB, 'reqContractDetails', side_effect=[[], ['details'], ['other']]) as req_contract_details:
+            self.assertListEqual([], self.test_obj.reqContractDetails(contract))
+            self.assertListEqual(['details'], self.test_obj.reqContractDetails(contract))
+            self.assertListEqual(['details'], self.test_obj.reqContractDetails(contract))
+            self.assertEqual(2, req_contract_details.call_count)
+
+            self.test_obj.ibc = MagicMock()
+            self.test_obj.isConnected = MagicMock(return_value=True)
+            self.test_obj.start_and_connect()
+            self.assertListEqual(['other'], self.test_obj.reqContractDetails(contract))
+
+    def test_contract_details_cache(self):
+        with patch('lib.ibgw.monotonic', return_value=0.), patch.object(self.test_obj, 'CONTRACT_DETAILS_CACHE_SIZE', 2):
+            for i in range(3):
+                self.test_obj._cache_contract_details(f'key{i}', [f'details{i}'])
+            # the least recently used entry is evicted
+            self.assertListEqual(['key1', 'key2'], [*self.test_obj._contract_details.keys()])
+            self.assertIsNone(self.test_obj._get_cached_contract_details('key0'))
+            self.assertListEqual(['details1'], self.test_obj._get_cached_contract_details('key1'))
+            self.assertListEqual(['key2', 'key1'], [*self.test_obj._contract_details.keys()])
+
+        with patch('lib.ibgw.monotonic', return_value=self.test_obj.CONTRACT_DETAILS_TTL + 1.):
+            self.assertIsNone(self.test_obj._get_cached_contract_details('key1'))
+            self.assertListEqual(['key2'], [*self.test_obj._contract_details.keys()])
+
+    def test_req_contract_details_batch(self):
+        contracts = [MagicMock(__repr__=MagicMock(return_value=f'Contract(conId={i})')) for i in range(3)]
+        with patch.object(IB, 'reqContractDetails', return_value=['details0']), \
+                patch.object(self.test_obj, 'request_batch', return_value=[['details1'], []]) as request_batch:
+            self.test_obj.reqContractDetails(contracts[0])
+            self.assertListEqual([['details0'], ['details1'], []], self.test_obj.reqContractDetailsBatch(contracts))
+            try:
+                # only what isn't cached is requested
+                request_batch.assert_called_once_with('reqContractDetails', [(contracts[1],), (contracts[2],)])
+            except AssertionError:
+                self.fail()
+
+            request_batch.reset_mock(return_value=True)
+            request_batch.return_value = [[]]
+            self.assertListEqual([['details0'], ['details1'], []], self.test_obj.reqContractDetailsBatch(contracts))
+            try:
+                request_batch.assert_called_once_with('reqContractDetails', [(contracts[2],)])
+            except AssertionError:
+                self.fail()
 
     @patch('lib.ibgw.logging')
     def test_start_and_connect(self, logging):
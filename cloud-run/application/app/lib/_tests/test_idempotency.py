@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import unittest
+from unittest.mock import MagicMock, patch
+
+from lib.idempotency import IdempotencyKeys
+from lib.idempotency import datetime, timedelta, timezone
+
+
+class TestIdempotencyKeys(unittest.TestCase):
+
+    NOW = datetime(2022, 1, 1, 12, tzinfo=timezone.utc)
+    TRADING_MODE = 'trading_mode'
+
+    @patch('lib.idempotency.Environment')
+    def setUp(self, *_):
+        self.test_obj = IdempotencyKeys()
+        self.test_obj._cache = OrderedDict()
+
+    @patch('lib.idempotency.datetime', now=MagicMock(return_value=NOW))
+    def test_add(self, *_):
+        with patch.object(self.test_obj, '_env', db=MagicMock(), trading_mode=self.TRADING_MODE) as env:
+            self.test_obj.add('key', 5, intent='Intent')
+            self.assertDictEqual({(self.TRADING_MODE, 'key'): self.NOW}, self.test_obj._cache)
+            try:
+                env.db.collection.assert_called_once_with(f'idempotency/{self.TRADING_MODE}/keys')
+                env.db.collection.return_value.document.assert_called_once_with('key')
+                env.db.collection.return_value.document.return_value.set.assert_called_once_with({
+                    'intent': 'Intent',
+                    'expireAt': self.NOW + timedelta(minutes=5),
+                    'timestamp': self.NOW
+                })
+            except AssertionError:
+                self.fail()
+
+        with patch.object(self.test_obj, 'LRU_SIZE', 2):
+            with patch.object(self.test_obj, '_env', db=MagicMock(), trading_mode=self.TRADING_MODE):
+                self.test_obj.add('key2', 5)
+                self.test_obj.add('key3', 5)
+                self.assertListEqual([(self.TRADING_MODE, 'key2'), (self.TRADING_MODE, 'key3')], [*self.test_obj._cache.keys()])
+
+    @patch('lib.idempotency.datetime', now=MagicMock(return_value=NOW))
+    def test_exists(self, *_):
+        with patch.object(self.test_obj, '_env',
+                          db=MagicMock(collection=MagicMock(return_value=MagicMock(document=MagicMock(return_value=MagicMock(get=MagicMock(return_value=MagicMock(exists=False))))))),
+                          trading_mode=self.TRADING_MODE) as env:
+            self.assertFalse(self.test_obj.exists('key', 5))
+            try:
+                env.db.collection.return_value.document.assert_called_once_with('key')
+            except AssertionError:
+                self.fail()
+
+            # cache hit does not touch Firestore
+            self.test_obj._cache[(self.TRADING_MODE, 'key')] = self.NOW - timedelta(minutes=1)
+            env.db.reset_mock()
+            self.assertTrue(self.test_obj.exists('key', 5))
+            try:
+                env.db.collection.assert_not_called()
+            except AssertionError:
+                self.fail()
+
+            # a key of another trading mode is not a cache hit
+            env.trading_mode = 'other'
+            self.assertFalse(self.test_obj.exists('key', 5))
+            try:
+                env.db.collection.assert_called_once_with('idempotency/other/keys')
+            except AssertionError:
+                self.fail()
+            env.trading_mode = self.TRADING_MODE
+            env.db.reset_mock()
+
+            # expired cache entry falls back to Firestore
+            self.assertFalse(self.test_obj.exists('key', 0.5))
+            try:
+                env.db.collection.return_value.document.return_value.get.assert_called_once()
+            except AssertionError:
+                self.fail()
+
+        for minutes, expected in [(1, False), (5, True)]:
+            self.test_obj._cache = OrderedDict()
+            with patch.object(self.test_obj, '_env',
+                              db=MagicMock(collection=MagicMock(return_value=MagicMock(document=MagicMock(return_value=MagicMock(get=MagicMock(return_value=MagicMock(
+                                  exists=True, to_dict=MagicMock(return_value={'timestamp': self.NOW - timedelta(minutes=2)})))))))),
+                              trading_mode=self.TRADING_MODE):
+                self.assertEqual(expected, self.test_obj.exists('key', minutes))
+                self.assertDictEqual({(self.TRADING_MODE, 'key'): self.NOW - timedelta(minutes=2)}, self.test_obj._cache)
+
+
+    def test_cache_threads(self):
+        def remember(i):
+            for j in range(200):
+                self.test_obj._remember(f'{i}-{j}', self.NOW)
+                self.test_obj.exists(f'{i}-{j // 2}', 5)
+
+        with patch.object(self.test_obj, '_env', trading_mode=self.TRADING_MODE) as env, \
+                patch.object(IdempotencyKeys, 'LRU_SIZE', 10):
+            env.db.collection.return_value.document.return_value.get.return_value.exists = False
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(remember, range(8)))
+        self.assertEqual(10, len(self.test_obj._cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import logging
+import os
+import unittest
+from unittest.mock import MagicMock, patch
+
+from lib.log import APP_ROOT, DebugSamplingFilter, DeferredQueueHandler, Lazy, module_name, ModuleLevelFilter, setup_logger
+
+
+class TestLog(unittest.TestCase):
+
+    @staticmethod
+    def record(level=logging.DEBUG, module='lib.trading', lineno=1, msg='msg', args=None):
+        return logging.LogRecord('logger', level, os.path.join(APP_ROOT, *module.split('.')) + '.py', lineno, msg, args, None)
+
+    def test_lazy(self):
+        func = MagicMock(return_value={'a': 1})
+        lazy = Lazy(func, 1, 2)
+        func.assert_not_called()
+        self.assertEqual("msg {'a': 1}", self.record(msg='msg %s', args=(lazy,)).getMessage())
+        func.assert_called_once_with(1, 2)
+
+    def test_module_name(self):
+        self.assertEqual('lib.trading', module_name(os.path.join(APP_ROOT, 'lib', 'trading.py')))
+
+    def test_module_level_filter(self):
+        levels = ModuleLevelFilter.parse_levels('lib=INFO, lib.trading=warning,intents.summary=DEBUG')
+        self.assertDictEqual({'lib': logging.INFO, 'lib.trading': logging.WARNING, 'intents.summary': logging.DEBUG}, levels)
+        self.assertDictEqual({}, ModuleLevelFilter.parse_levels(None))
+
+        test_obj = ModuleLevelFilter(logging.ERROR, levels)
+        self.assertEqual(logging.DEBUG, test_obj.min_level)
+        self.assertFalse(test_obj.filter(self.record(logging.INFO, 'lib.trading')))
+        self.assertTrue(test_obj.filter(self.record(logging.WARNING, 'lib.trading')))
+        self.assertTrue(test_obj.filter(self.record(logging.INFO, 'lib.ibgw')))
+        self.assertFalse(test_obj.filter(self.record(logging.INFO, 'libx')))
+        self.assertTrue(test_obj.filter(self.record(logging.DEBUG, 'intents.summary')))
+        self.assertFalse(test_obj.filter(self.record(logging.WARNING, 'intents.allocation')))
+
+    def test_debug_sampling_filter(self):
+        clock = MagicMock(return_value=0)
+        test_obj = DebugSamplingFilter(burst=2, every=3, window=60, clock=clock)
+        self.assertListEqual([True, True, True, False, False, True, False],
+                             [test_obj.filter(self.record()) for _ in range(7)])
+        # other call sites and levels are counted separately
+        self.assertTrue(test_obj.filter(self.record(lineno=2)))
+        self.assertTrue(test_obj.filter(self.record(logging.INFO)))
+        clock.return_value = 61
+        self.assertTrue(test_obj.filter(self.record()))
+
+    def test_deferred_queue_handler(self):
+        record = self.record(msg='%s', args=(Lazy(MagicMock(side_effect=Exception)),))
+        self.assertIs(record, DeferredQueueHandler(MagicMock()).prepare(record))
+
+    @patch('lib.log.atexit')
+    def test_setup_logger(self, atexit):
+        handler = MagicMock(level=logging.NOTSET)
+        logger, listener = setup_logger('test_setup_logger', handler, logging.INFO, {'lib._tests': logging.WARNING})
+        try:
+            self.assertEqual(logging.INFO, logger.level)
+            self.assertFalse(logger.propagate)
+            logger.info('info')
+            logger.warning('warning %s', 'message')
+            listener.stop()
+            self.assertEqual(1, handler.handle.call_count)
+            self.assertEqual('warning message', handler.handle.call_args[0][0].getMessage())
+            atexit.register.assert_called_once_with(listener.stop)
+        except AssertionError:
+            self.fail()
+
+
+if __name__ == '__main__':
+    unittest.main()
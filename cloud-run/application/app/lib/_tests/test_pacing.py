@@ -0,0 +1,52 @@
+import unittest
+
+from lib.pacing import RequestPacer
+
+
+class TestRequestPacer(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.
+        self.test_obj = RequestPacer(rate=10, burst=2, clock=lambda: self.now)
+
+    def test_reserve(self):
+        # burst goes through without delay, then requests queue at the message rate
+        self.assertListEqual([0., 0., 0.1, 0.2], [round(self.test_obj.reserve(), 6) for _ in range(4)])
+        self.now = 1.
+        self.assertEqual(0., self.test_obj.reserve())
+        self.assertEqual(0.3, round(self.test_obj.reserve(messages=4), 6))
+
+    def test_reserve_historical(self):
+        test_obj = RequestPacer(clock=lambda: self.now)
+
+        # identical requests
+        self.assertEqual(0., test_obj.reserve(historical_key='a', contract_key='c'))
+        self.assertEqual(15., test_obj.reserve(historical_key='a', contract_key='c'))
+
+        # same contract
+        delays = [test_obj.reserve(historical_key=f'b{i}', contract_key='d') for i in range(6)]
+        self.assertListEqual([0.] * 5, [round(d) for d in delays[:5]])
+        self.assertEqual(2., round(delays[5], 6))
+
+        # 60 requests within 10 minutes
+        delays = []
+        for i in range(53):
+            self.now = 20. + i
+            delays.append(test_obj.reserve(historical_key=f'e{i}', contract_key=f'f{i}'))
+        self.assertEqual(0., round(delays[51], 6))
+        self.assertEqual(600. - self.now, round(delays[52], 6))
+
+    def test_metrics(self):
+        for _ in range(4):
+            self.test_obj.reserve()
+        self.assertDictEqual({'requests': 4, 'queued': 2, 'queuedSeconds': 0.3, 'maxQueuedSeconds': 0.2},
+                             {k: round(v, 6) for k, v in self.test_obj.metrics.items()})
+
+    def test_default_clock(self):
+        test_obj = RequestPacer()
+        self.assertEqual(0., test_obj.reserve())
+        self.assertIsInstance(test_obj.metrics, dict)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+from threading import get_ident
+from time import sleep
+import unittest
+from unittest.mock import MagicMock, patch
+
+from lib.profiling import SamplingProfiler
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.test_obj = SamplingProfiler(interval=0.001)
+
+    def test_sample(self):
+        def inner():
+            self.test_obj.sample()
+
+        self.test_obj._thread_id = get_ident()
+        for _ in range(2):
+            inner()
+        self.assertEqual(2, self.test_obj.samples)
+        self.test_obj.sample()
+        self.assertEqual(3, self.test_obj.samples)
+
+        stacks = self.test_obj.collapsed().splitlines()
+        self.assertEqual(2, len(stacks))
+        stack, count = stacks[0].rsplit(' ', 1)
+        self.assertEqual('2', count)
+        # innermost frames first: the sampling call itself, then the profiled code
+        self.assertTrue(stack.split(';')[-1].startswith('lib.profiling:sample:'))
+        self.assertTrue(stack.split(';')[-2].startswith(f'{__name__}:inner:'))
+        self.assertTrue(stack.split(';')[-3].startswith(f'{__name__}:test_sample:'))
+        self.assertEqual(1, len(self.test_obj.collapsed(max_stacks=1).splitlines()))
+        # truncated to the stacks that fit
+        self.assertEqual(stacks[0], self.test_obj.collapsed(max_bytes=len(stacks[0]) + 1))
+        self.assertEqual('', self.test_obj.collapsed(max_bytes=len(stacks[0])))
+
+    def test_sample_unknown_thread(self):
+        with patch('lib.profiling.sys', _current_frames=MagicMock(return_value={})):
+            self.test_obj.sample()
+        self.assertEqual(0, self.test_obj.samples)
+
+    def test_context_manager(self):
+        with self.test_obj:
+            sleep(0.05)
+        self.assertGreater(self.test_obj.samples, 0)
+        self.assertGreaterEqual(self.test_obj.seconds, 0.05)
+        self.assertIn('test_context_manager', self.test_obj.collapsed())
+
+        actual = self.test_obj.to_dict()
+        self.assertEqual(0.001, actual['interval'])
+        self.assertEqual(self.test_obj.samples, actual['samples'])
+        self.assertEqual(len(self.test_obj._stacks), actual['stacks'])
+        self.assertEqual(self.test_obj.collapsed(), actual['collapsed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import numpy as np
+import unittest
+
+from lib.sizing import SizingEngine
+
+
+class TestSizingEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.test_obj = SizingEngine(['abc', 'def', 'ghi', 'abc'])
+
+    def test_init(self):
+        self.assertListEqual(['abc', 'def', 'ghi'], self.test_obj.contract_ids)
+        self.assertDictEqual({'abc': 0, 'def': 1, 'ghi': 2}, self.test_obj.index)
+        self.assertEqual(3, len(self.test_obj))
+
+    def test_consolidate(self):
+        engine, matrix = SizingEngine.consolidate([{'abc': 10, 'def': -20}, {'def': 20, 'ghi': 30}, {}])
+        self.assertListEqual(['abc', 'def', 'ghi'], engine.contract_ids)
+        np.testing.assert_array_equal(np.array([[10, -20, 0], [0, 20, 30], [0, 0, 0]]), matrix)
+
+    def test_target_positions(self):
+        actual = SizingEngine.target_positions(50000,
+                                               np.array([1.2, -2.3, 3.4, 0]),
+                                               np.array([10, 20, 5, np.nan]),
+                                               np.array([2, 5, 10, np.nan]),
+                                               np.array([0.9, 1.1, 1, np.nan]))
+        np.testing.assert_array_equal(np.array([3333, -1045, 3400, 0]), actual)
+
+        # broadcasts over points in time
+        actual = SizingEngine.target_positions(1000, np.array([[1, -1], [0, 1]]), np.array([[10, 20], [10, 25]]), np.array([1, 2]), np.array([1, 1]))
+        np.testing.assert_array_equal(np.array([[100, -25], [0, 20]]), actual)
+
+    def test_trades(self):
+        np.testing.assert_array_equal(np.array([-1, 1, 0]), SizingEngine.trades(np.array([1, 2, 3]), np.array([2, 1, 3])))
+
+    def test_to_dict(self):
+        actual = self.test_obj.to_dict(np.array([3333., 0., -1045.]))
+        self.assertDictEqual({'abc': 3333, 'def': 0, 'ghi': -1045}, actual)
+        self.assertIsInstance(actual['abc'], int)
+
+        self.assertDictEqual({'abc': 3333, 'ghi': -1045}, self.test_obj.to_dict(np.array([3333., 0., -1045.]), nonzero=True))
+
+        self.assertRaises(ValueError, self.test_obj.to_dict, np.array([1, np.nan, 2]))
+
+    def test_vector(self):
+        np.testing.assert_array_equal(np.array([1., 0., 3.]), self.test_obj.vector({'abc': 1, 'ghi': 3, 'xyz': 4}))
+        np.testing.assert_array_equal(np.array([1., -1., 3.]), self.test_obj.vector({'abc': 1, 'ghi': 3}, default=-1))
+
+
+if __name__ == '__main__':
+    unittest.main()
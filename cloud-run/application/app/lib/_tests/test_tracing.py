@@ -0,0 +1,82 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from lib.tracing import Tracer
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.histograms = patch.object(Tracer, '_histograms', {})
+        self.histograms.start()
+
+    def tearDown(self):
+        self.histograms.stop()
+        Tracer.end()
+
+    @patch('lib.tracing.perf_counter', side_effect=[0., 0.02, 1., 1.5, 2., 2.01, 3., 3.])
+    def test_span(self, *_):
+        Tracer.begin('Intent')
+        with Tracer.span('firestore.get') as span:
+            span.size = 3
+        with Tracer.span('firestore.get'):
+            pass
+        with self.assertRaises(ValueError):
+            with Tracer.span('ib.reqTickers'):
+                raise ValueError()
+
+        self.assertDictEqual({
+            'firestore.get': {'count': 2, 'errors': 0, 'seconds': 0.52, 'maxSeconds': 0.5, 'size': 3},
+            'ib.reqTickers': {'count': 1, 'errors': 1, 'seconds': 0.01, 'maxSeconds': 0.01, 'size': 0}
+        }, Tracer.end())
+        self.assertDictEqual({}, Tracer.end())
+
+        buckets, total, count = Tracer._histograms[('firestore.get', 'Intent')]
+        self.assertEqual(2, count)
+        self.assertAlmostEqual(0.52, total)
+        self.assertEqual(1, buckets[Tracer.BUCKETS.index(.025)])
+        self.assertEqual(1, buckets[Tracer.BUCKETS.index(.5)])
+
+        # outside of intents, spans only go to the histograms
+        with Tracer.span('firestore.get'):
+            pass
+        self.assertIn(('firestore.get', ''), Tracer._histograms)
+        self.assertDictEqual({}, Tracer.end())
+
+    def test_traced(self):
+        @Tracer.traced('sync')
+        def sync(x):
+            return x
+
+        @Tracer.traced('async')
+        async def coroutine(x):
+            return x
+
+        Tracer.begin('Intent')
+        self.assertListEqual([1, 2], sync([1, 2]))
+        self.assertIsNone(sync(None))
+        self.assertEqual('abc', asyncio.run(coroutine('abc')))
+        actual = Tracer.end()
+        self.assertEqual(2, actual['sync']['count'])
+        self.assertEqual(2, actual['sync']['size'])
+        self.assertEqual(3, actual['async']['size'])
+
+    @patch('lib.tracing.perf_counter', side_effect=[0., 0.02, 0., 100.])
+    def test_prometheus(self, *_):
+        with Tracer.span('ib.reqTickers'):
+            pass
+        with Tracer.span('ib.reqTickers'):
+            pass
+        lines = Tracer.prometheus().splitlines()
+        self.assertEqual(f'# TYPE {Tracer.METRIC} histogram', lines[1])
+        self.assertIn(f'{Tracer.METRIC}_bucket{{call="ib.reqTickers",intent="",le="0.01"}} 0', lines)
+        self.assertIn(f'{Tracer.METRIC}_bucket{{call="ib.reqTickers",intent="",le="0.025"}} 1', lines)
+        self.assertIn(f'{Tracer.METRIC}_bucket{{call="ib.reqTickers",intent="",le="60.0"}} 1', lines)
+        self.assertIn(f'{Tracer.METRIC}_bucket{{call="ib.reqTickers",intent="",le="+Inf"}} 2', lines)
+        self.assertIn(f'{Tracer.METRIC}_sum{{call="ib.reqTickers",intent=""}} 100.02', lines)
+        self.assertIn(f'{Tracer.METRIC}_count{{call="ib.reqTickers",intent=""}} 2', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,22 @@
 from ib_insync import MarketOrder, OrderStatus
+from ib_insync.util import UNSET_DOUBLE
 import unittest
 from unittest.mock import call, MagicMock, patch, PropertyMock
 
-from lib.trading import Instrument, InstrumentSet, Future, Trade
+from lib.trading import CalendarSpread, ConsolidatedTrade, Instrument, InstrumentRecord, InstrumentSet, Future, FuturesOption, FutureSpec, Option, OptionChain, Trade
 from lib.trading import datetime, DELETE_FIELD
 
 
+class TestInstrumentRecord(unittest.TestCase):
+
+    def test_from_contract_details(self):
+        contract_details = MagicMock(contract=MagicMock(conId=123, localSymbol='ABC', multiplier='', currency='USD', lastTradeDateOrContractMonth=''),
+                                     minTick=0.01)
+        actual = InstrumentRecord.from_contract_details(contract_details)
+        self.assertEqual(InstrumentRecord(123, 'ABC', 1, 'USD', 0.01, None), actual)
+        self.assertFalse(hasattr(actual, '__dict__'))
+
+
 class TestInstrument(unittest.TestCase):
 
     @patch('lib.trading.Environment')
@@ -43,24 +54,67 @@ class TestInstrument(unittest.TestCase):
         except AssertionError:
             self.fail()
 
+    def test_slots(self):
+        self.assertFalse(hasattr(self.test_obj, '__dict__'))
+        self.assertFalse(hasattr(Future.__new__(Future), '__dict__'))
+
+    def test_get_details(self):
+        with patch.object(self.test_obj, '_env', ibgw=MagicMock()) as env:
+            self.test_obj.get_details()
+            self.assertIsNone(self.test_obj.details)
+            try:
+                env.ibgw.reqContractDetails.assert_not_called()
+            except AssertionError:
+                self.fail()
+
+        with patch.object(self.test_obj, '_contract') as contract:
+            with patch.object(self.test_obj, '_env', ibgw=MagicMock(reqContractDetails=MagicMock(return_value=[MagicMock(nonDefaults=MagicMock(return_value={'contract': contract, 'key': 'value'}))]))) as env:
+                # accessing the details doesn't request them
+                self.assertIsNone(self.test_obj.details)
+                self.test_obj.get_details()
+                self.assertDictEqual({'key': 'value'}, self.test_obj.details)
+                try:
+                    env.ibgw.reqContractDetails.assert_called_once_with(contract)
+                except AssertionError:
+                    self.fail()
+
     def test_get_contract_details(self):
-        contract = {'contract': MagicMock(localSymbol='ABC')}
-        key_value = {'key': 'value'}
+        contract = MagicMock(conId=123, localSymbol='ABC', multiplier='5', currency='USD', lastTradeDateOrContractMonth='20220318')
 
         with patch.object(self.test_obj, '_env', ibgw=MagicMock(reqContractDetails=MagicMock(return_value=[]))):
             self.test_obj.get_contract_details()
+            self.assertEqual(None, self.test_obj._contract)
+            self.assertEqual(None, self.test_obj._record)
+
+        ib_contract = MagicMock()
+        with patch.object(self.test_obj, '_env', ibgw=MagicMock(reqContractDetails=MagicMock(return_value=[MagicMock(contract=contract, minTick=0.25)]))) as env:
+            self.test_obj.get_contract_details(ib_contract)
+            self.assertEqual(contract, self.test_obj._contract)
+            self.assertEqual(contract.localSymbol, self.test_obj.local_symbol)
+            self.assertEqual(InstrumentRecord(123, 'ABC', 5, 'USD', 0.25, '20220318'), self.test_obj._record)
             self.assertEqual(None, self.test_obj._details)
+            try:
+                env.ibgw.reqContractDetails.assert_called_once_with(ib_contract)
+            except AssertionError:
+                self.fail()
 
-        with patch.object(self.test_obj, '_ib_contract') as ib_contract:
-            with patch.object(self.test_obj, '_env', ibgw=MagicMock(reqContractDetails=MagicMock(return_value=[MagicMock(nonDefaults=MagicMock(return_value={**contract, **key_value}))]))) as env:
-                self.test_obj.get_contract_details()
-                self.assertEqual(contract['contract'], self.test_obj._contract)
-                self.assertEqual(contract['contract'].localSymbol, self.test_obj._local_symbol)
-                self.assertDictEqual(key_value, self.test_obj._details)
-                try:
-                    env.ibgw.reqContractDetails.assert_called_once_with(ib_contract)
-                except AssertionError:
-                    self.fail()
+            # without a contract, the resolved one is requested again
+            env.ibgw.reqContractDetails.reset_mock()
+            self.test_obj.get_contract_details()
+            try:
+                env.ibgw.reqContractDetails.assert_called_once_with(contract)
+            except AssertionError:
+                self.fail()
+
+    @patch('lib.trading.Environment')
+    def test_from_contract_details(self, *_):
+        contract = MagicMock(conId=123, localSymbol='ABC', multiplier='100', currency='USD', lastTradeDateOrContractMonth='20220318')
+        actual = Option.from_contract_details(MagicMock(contract=contract, minTick=0.01))
+        self.assertIsInstance(actual, Option)
+        self.assertEqual(contract, actual.contract)
+        self.assertEqual('ABC', actual.local_symbol)
+        self.assertEqual(InstrumentRecord(123, 'ABC', 100, 'USD', 0.01, '20220318'), actual.record)
+        self.assertIsNone(actual.greeks)
 
     def test_get_tickers(self):
         with patch.object(self.test_obj, '_env', ibgw=MagicMock(reqTickers=MagicMock(return_value=[]))):
@@ -77,60 +131,166 @@ class TestInstrument(unittest.TestCase):
                     self.fail()
 
 
+class TestFutureSpec(unittest.TestCase):
+
+    def test_from_dict(self):
+        actual = FutureSpec.from_dict('CL', {'currency': 'USD', 'exchange': 'NYMEX', 'expiryScheme': 'm', 'expiryMonthOffset': -1},
+                                      Future.EXPIRY_SCHEMES)
+        self.assertEqual(FutureSpec('CL', 'NYMEX', 'USD', [*range(1, 13)], -1, 1), actual)
+        actual = FutureSpec.from_dict('MNQ', {'currency': 'USD', 'exchange': 'GLOBEX', 'expiryScheme': 'ZHU', 'rollOffset': 3}, {})
+        self.assertEqual(FutureSpec('MNQ', 'GLOBEX', 'USD', [3, 9, 12], 0, 3), actual)
+
+    def test_roll_calendar(self):
+        spec = FutureSpec('MNQ', 'GLOBEX', 'USD', [3, 6, 9, 12])
+        self.assertListEqual(['MNQZ1', 'MNQH2', 'MNQM2'], spec.roll_calendar(2, datetime(2021, 12, 12)))
+        self.assertListEqual(['MNQH2', 'MNQM2'], spec.roll_calendar(1, datetime(2022, 1, 5)))
+
+        # last trading day in the month before the contract month
+        spec = FutureSpec('CL', 'NYMEX', 'USD', [*range(1, 13)], -1)
+        self.assertListEqual(['CLF3', 'CLG3'], spec.roll_calendar(1, datetime(2022, 12, 12)))
+
+
 class TestFuture(unittest.TestCase):
 
     CONTRACT_SPECS = {
         'TICKER': {
             'currency': 'CCY',
             'exchange': 'EXC',
-            'expiry_scheme': 'x'
+            'expiryScheme': 'x',
+            'rollOffset': 2
         }
     }
     EXPIRY_SCHEMES = {
-        'x': ['A', 'B', 'C']
+        'x': 'FHK'
     }
 
     @patch('lib.trading.Environment')
     def setUp(self, *_):
         self.test_obj = Future()
-        self.test_obj.CONTRACT_SPECS = self.CONTRACT_SPECS
-        self.test_obj.EXPIRY_SCHEMES = self.EXPIRY_SCHEMES
+
+    @patch.object(Future, 'CONTRACT_SPECS', CONTRACT_SPECS)
+    @patch.object(Future, 'EXPIRY_SCHEMES', EXPIRY_SCHEMES)
+    def test_get_spec(self):
+        with patch('lib.trading.Environment', return_value=MagicMock(config={})):
+            self.assertEqual(FutureSpec('TICKER', 'EXC', 'CCY', [1, 3, 5], 0, 2), Future.get_spec('TICKER'))
+            self.assertRaises(KeyError, Future.get_spec, 'ABC')
+
+        # the config extends and overrides the defaults
+        with patch('lib.trading.Environment', return_value=MagicMock(config={'futuresSpecs': {
+            'TICKER': {'currency': 'USD', 'exchange': 'EXC', 'expiryScheme': 'x'},
+            'ABC': {'currency': 'EUR', 'exchange': 'EUREX', 'expiryScheme': 'HMUZ'}
+        }})):
+            self.assertEqual(FutureSpec('TICKER', 'EXC', 'USD', [1, 3, 5], 0, 1), Future.get_spec('TICKER'))
+            self.assertEqual(FutureSpec('ABC', 'EUREX', 'EUR', [3, 6, 9, 12], 0, 1), Future.get_spec('ABC'))
 
     @patch.object(Future, 'CONTRACT_SPECS', CONTRACT_SPECS)
     @patch.object(Future, 'EXPIRY_SCHEMES', EXPIRY_SCHEMES)
     @patch.object(Future, '__new__')
     @patch('lib.trading.InstrumentSet', return_value=range(6))
     @patch('lib.trading.GcpModule', get_logger=MagicMock())
-    def test_get_contract_series(self, gcp_module, instrumentset, future, *_):
-        side_effect = [MagicMock(contract=None),
-                       MagicMock(contract=MagicMock(lastTradeDateOrContractMonth='20211118')),
-                       MagicMock(contract=MagicMock(lastTradeDateOrContractMonth='20211218')),
-                       MagicMock(contract=MagicMock(lastTradeDateOrContractMonth='20220118')),
-                       MagicMock(contract=MagicMock(lastTradeDateOrContractMonth='20220218')),
-                       MagicMock(contract=MagicMock(lastTradeDateOrContractMonth='20220318'))]
+    @patch('lib.trading.Environment', return_value=MagicMock(config={}))
+    def test_get_contract_series(self, _, gcp_module, instrumentset, future, *__):
+        side_effect = [MagicMock(contract=MagicMock(lastTradeDateOrContractMonth='20220118')),
+                       MagicMock(contract=None),
+                       MagicMock(contract=MagicMock(lastTradeDateOrContractMonth='20220518'))]
 
         future.side_effect = side_effect
-        with patch('lib.trading.datetime', now=MagicMock(return_value=datetime(2021, 12, 12))):
-            actual = Future.get_contract_series(3, 'TICKER', 6)
-            self.assertCountEqual(instrumentset.return_value[:3], actual)
+        with patch('lib.trading.datetime', now=MagicMock(return_value=datetime(2022, 1, 12))):
+            actual = Future.get_contract_series(2, 'TICKER', 6)
+            self.assertCountEqual(instrumentset.return_value[:2], actual)
             try:
                 gcp_module.get_logger.assert_called_once()
+                # only the next n contracts plus a spare one are requested
                 future.assert_has_calls([call(Future, localSymbol=s, exchange='EXC', currency='CCY')
-                                         for s in [f'TICKER{m}{y}' for y in [1, 2] for m in self.EXPIRY_SCHEMES['x']]])
-                instrumentset.assert_called_once_with(*side_effect[3:])
+                                         for s in ['TICKERF2', 'TICKERH2', 'TICKERK2']])
+                self.assertEqual(3, future.call_count)
+                instrumentset.assert_called_once_with(*side_effect[2:])
             except AssertionError:
                 self.fail()
 
+        # the roll offset of the spec applies by default
+        future.reset_mock()
         future.side_effect = side_effect
         instrumentset.reset_mock()
-        with patch('lib.trading.datetime', now=MagicMock(return_value=datetime(2021, 12, 11))):
-            Future.get_contract_series(3, 'TICKER', 6)
+        with patch('lib.trading.datetime', now=MagicMock(return_value=datetime(2022, 1, 12))):
+            Future.get_contract_series(2, 'TICKER')
             try:
-                instrumentset.assert_called_once_with(*side_effect[2:])
+                instrumentset.assert_called_once_with(side_effect[0], side_effect[2])
             except AssertionError:
                 self.fail()
 
 
+class TestOptionChain(unittest.TestCase):
+
+    CHAINS = [MagicMock(exchange='SMART', underlyingConId=1, tradingClass='ABC', multiplier='100',
+                        expirations={'20220318', '20220415'}, strikes={90., 100., 110.}),
+              MagicMock(exchange='CBOE', underlyingConId=1, tradingClass='ABC', multiplier='100',
+                        expirations={'20220318'}, strikes={100.})]
+
+    def _option_chain(self, sec_type='STK', **kwargs):
+        underlying = MagicMock(local_symbol='ABC', contract=MagicMock(symbol='ABC', exchange='GLOBEX', currency='USD', secType=sec_type, conId=1))
+        with patch('lib.trading.Environment', return_value=MagicMock(ibgw=MagicMock(reqSecDefOptParams=MagicMock(return_value=self.CHAINS)))) as environment:
+            return OptionChain(underlying, **kwargs), environment.return_value
+
+    def test_init(self):
+        option_chain, env = self._option_chain(exchange='SMART')
+        self.assertListEqual(['20220318', '20220415'], option_chain.expirations)
+        self.assertListEqual([90., 100., 110.], option_chain.strikes)
+        self.assertIs(Option, option_chain._option_cls)
+        try:
+            env.ibgw.reqSecDefOptParams.assert_called_once_with('ABC', '', 'STK', 1)
+        except AssertionError:
+            self.fail()
+
+        # one chain per trading class and multiplier, SMART if listed
+        option_chain, _ = self._option_chain()
+        self.assertListEqual([self.CHAINS[0]], option_chain._chains)
+        option_chain, _ = self._option_chain(exchange='CBOE')
+        self.assertListEqual([self.CHAINS[1]], option_chain._chains)
+
+        option_chain, env = self._option_chain('FUT')
+        self.assertEqual(1, len(option_chain._chains))
+        self.assertIs(FuturesOption, option_chain._option_cls)
+        try:
+            env.ibgw.reqSecDefOptParams.assert_called_once_with('ABC', 'GLOBEX', 'FUT', 1)
+        except AssertionError:
+            self.fail()
+
+    def test_strikes_around(self):
+        option_chain, _ = self._option_chain()
+        self.assertListEqual([100., 110.], option_chain.strikes_around(106, 2))
+
+    @patch.object(InstrumentSet, 'get_tickers')
+    @patch.object(Option, 'from_contract_details', side_effect=lambda d: MagicMock(spec=Option, contract=MagicMock(conId=d)))
+    def test_resolve(self, from_contract_details, get_tickers):
+        option_chain, env = self._option_chain(exchange='SMART')
+        env.ibgw.reqContractDetailsBatch.return_value = [[1], [], [2]]
+        actual = option_chain.resolve(['20220318'], [100., 110.], ('C',), get_tickers=True)
+        self.assertListEqual([1, 2], [o.contract.conId for o in actual])
+        contracts = env.ibgw.reqContractDetailsBatch.call_args[0][0]
+        self.assertListEqual([('20220318', 100., 'C'), ('20220318', 110., 'C')],
+                             [(c.lastTradeDateOrContractMonth, c.strike, c.right) for c in contracts])
+        try:
+            get_tickers.assert_called_once()
+        except AssertionError:
+            self.fail()
+
+        # all strikes of an expiry
+        env.ibgw.reqContractDetailsBatch.return_value = []
+        option_chain.resolve(['20220415'])
+        self.assertEqual(6, len(env.ibgw.reqContractDetailsBatch.call_args[0][0]))
+
+        # not the whole grid
+        env.ibgw.reqContractDetailsBatch.reset_mock()
+        self.assertRaises(ValueError, option_chain.resolve)
+        with patch.object(OptionChain, 'MAX_CONTRACTS', 5):
+            self.assertRaises(ValueError, option_chain.resolve, ['20220415'])
+        try:
+            env.ibgw.reqContractDetailsBatch.assert_not_called()
+        except AssertionError:
+            self.fail()
+
+
 class TestInstrumentSet(unittest.TestCase):
 
     @patch('lib.trading.Environment')
@@ -173,14 +333,45 @@ class TestInstrumentSet(unittest.TestCase):
         for i, j in zip(instruments, instrumentset):
             self.assertEqual(i, j)
 
-    def test_get_tickers(self):
-        with patch.object(self.test_obj, '_env', ibgw=MagicMock(reqTickers=MagicMock(return_value=[i for i in range(3)]))) as env:
-            self.test_obj.get_tickers()
-            self.assertEqual([i for i in range(3)], [c._tickers for c in self.test_obj._constituents])
-            try:
-                env.ibgw.reqTickers.assert_called_once_with(*self.test_obj.contracts)
-            except AssertionError:
-                self.fail()
+    @patch('lib.trading.Environment', return_value=MagicMock(ibgw=MagicMock(reqTickers=MagicMock(return_value=[i for i in range(3)]))))
+    def test_get_tickers(self, environment):
+        self.test_obj.get_tickers()
+        self.assertEqual([i for i in range(3)], [c._tickers for c in self.test_obj._constituents])
+        try:
+            environment.return_value.ibgw.reqTickers.assert_called_once_with(*self.test_obj.contracts)
+        except AssertionError:
+            self.fail()
+
+    def test_indexes(self):
+        instruments = [MagicMock(spec=Instrument, local_symbol=f'S{i}', contract=MagicMock(conId=i, currency=c))
+                       for i, c in enumerate(['USD', 'EUR', 'USD'])]
+        unresolved = MagicMock(spec=Instrument, contract=None)
+        instrumentset = InstrumentSet(*instruments, unresolved, instruments[0], unresolved)
+        self.assertEqual(4, len(instrumentset))
+        self.assertEqual(instruments[1], instrumentset.get(1))
+        self.assertIsNone(instrumentset.get(3))
+        self.assertEqual(instruments[2], instrumentset.get_by_local_symbol('S2'))
+        self.assertIn(2, instrumentset)
+        self.assertIn(unresolved, instrumentset)
+        self.assertDictEqual({0: 'S0', 1: 'S1', 2: 'S2'}, dict(instrumentset.local_symbols))
+        self.assertDictEqual({'S0': 0, 'S1': 1, 'S2': 2}, dict(instrumentset.contract_ids))
+        self.assertListEqual(['USD', 'EUR'], instrumentset.currencies)
+        by_currency = instrumentset.by_currency()
+        self.assertListEqual([instruments[0], instruments[2]], [*by_currency['USD']])
+        self.assertListEqual([instruments[1]], [*by_currency['EUR']])
+
+    def test_set_operations(self):
+        instruments = [MagicMock(spec=Instrument, local_symbol=f'S{i}', contract=MagicMock(conId=i, currency='USD')) for i in range(4)]
+        a, b = InstrumentSet(*instruments[:3]), InstrumentSet(*instruments[1:])
+        self.assertListEqual(instruments, [*(a + b)])
+        self.assertListEqual(instruments, [*(a | b)])
+        self.assertListEqual(instruments[1:3], [*(a & b)])
+        # instruments with the same contract ID count as the same
+        duplicate = MagicMock(spec=Instrument, local_symbol='S1', contract=MagicMock(conId=1, currency='USD'))
+        self.assertListEqual([instruments[1]], [*(a & InstrumentSet(duplicate))])
+        a += b
+        self.assertListEqual(instruments, [*a])
+        self.assertEqual(3, len(b))
 
 
 class TestTrade(unittest.TestCase):
@@ -197,6 +388,66 @@ class TestTrade(unittest.TestCase):
         trade = Trade(strategies)
         self.assertEqual(strategies, trade._strategies)
 
+    def test_check_margin(self):
+        def trades():
+            return {1: ConsolidatedTrade(contract=MagicMock(contract='c1'), quantity=10, source={'s0': 6, 's1': 4}),
+                    2: ConsolidatedTrade(contract=MagicMock(contract='c2'), quantity=-5, source={'s0': -5})}
+
+        order_states = [MagicMock(initMarginChange='6000', maintMarginChange='5000', warningText=''),
+                        MagicMock(initMarginChange='-1000', maintMarginChange='0', warningText='warning')]
+        account_values = {'NetLiquidation': {'CHF': 10000.}, 'InitMarginReq': {'CHF': 4000.}, 'MaintMarginReq': {'CHF': 3000.}}
+        with patch.object(self.test_obj, '_env', config=self.CONFIG) as env, \
+                patch.object(self.test_obj, '_calendar_spreads', {}):
+            env.ibgw.request_batch.return_value = order_states
+            env.get_account_values.return_value = account_values
+
+            with patch.object(self.test_obj, '_trades', trades()):
+                actual = self.test_obj.check_margin()
+                self.assertEqual('passed', actual['action'])
+                self.assertDictEqual({'before': 4000., 'change': 5000., 'after': 9000.}, actual['initMargin'])
+                self.assertDictEqual({'before': 3000., 'change': 5000., 'after': 8000.}, actual['maintMargin'])
+                self.assertListEqual(['warning'], actual['warnings'])
+                try:
+                    method, requests = env.ibgw.request_batch.call_args[0]
+                    self.assertEqual('whatIfOrder', method)
+                    self.assertListEqual([('c1', 'BUY', 10), ('c2', 'SELL', 5)], [(c, o.action, o.totalQuantity) for c, o in requests])
+                    env.get_account_values.assert_called_once_with('account', rows=('NetLiquidation', 'InitMarginReq', 'MaintMarginReq'))
+                except AssertionError:
+                    self.fail()
+
+            # initial margin after trades of 9000 vs. limit of 8000
+            with patch.object(self.test_obj, '_trades', trades()):
+                actual = self.test_obj.check_margin(0.8)
+                self.assertEqual('blocked', actual['action'])
+                self.assertDictEqual({}, self.test_obj.trades)
+
+            with patch.object(self.test_obj, '_trades', trades()):
+                actual = self.test_obj.check_margin(0.8, scale=True)
+                self.assertEqual('scaled', actual['action'])
+                # (8000 - 4000 + 1000) / 6000
+                self.assertAlmostEqual(5 / 6, actual['scale'])
+                self.assertEqual((8, {'s0': 5, 's1': 3}), (self.test_obj.trades[1].quantity, self.test_obj.trades[1].source))
+                # the margin decreasing trade is left as is
+                self.assertEqual((-5, {'s0': -5}), (self.test_obj.trades[2].quantity, self.test_obj.trades[2].source))
+
+            # fails closed if IB doesn't evaluate an order
+            for states in [[order_states[0], None], [order_states[0], []], [order_states[0]],
+                           [order_states[0], MagicMock(initMarginChange='', maintMarginChange=str(UNSET_DOUBLE))]]:
+                env.ibgw.request_batch.return_value = states
+                with patch.object(self.test_obj, '_trades', trades()):
+                    actual = self.test_obj.check_margin(scale=True)
+                    self.assertEqual('error', actual['action'])
+                    self.assertDictEqual({}, self.test_obj.trades)
+            self.assertIn('[2]', actual['error'])
+
+            # or without account values
+            env.ibgw.request_batch.return_value = order_states
+            env.get_account_values.return_value = {}
+            with patch.object(self.test_obj, '_trades', trades()):
+                actual = self.test_obj.check_margin()
+                self.assertEqual('error', actual['action'])
+                self.assertDictEqual({}, self.test_obj.trades)
+
     def test_consolidate_trades(self):
         with patch.object(self.test_obj, '_strategies', [MagicMock(trades={'abc': 10, 'def': -20}, contracts={'abc': 'c1', 'def': 'c2'}),
                                                          MagicMock(trades={'def': 20, 'ghi': 30}, contracts={'def': 'c2', 'ghi': 'c3'}),
@@ -205,20 +456,64 @@ class TestTrade(unittest.TestCase):
                 type(s).id = PropertyMock(return_value=f's{i}')
 
             expected = {
-                'abc': {
-                    'contract': 'c1',
-                    'quantity': 10,
-                    'source': {'s0': 10}
-                },
-                'ghi': {
-                    'contract': 'c3',
-                    'quantity': 20,
-                    'source': {'s1': 30, 's2': -10}
-                },
+                'abc': ConsolidatedTrade(contract='c1', quantity=10, source={'s0': 10}),
+                'ghi': ConsolidatedTrade(contract='c3', quantity=20, source={'s1': 30, 's2': -10})
             }
             self.test_obj.consolidate_trades()
             self.assertDictEqual(expected, self.test_obj._trades)
 
+    def test_combine_rolls(self):
+        def future(con_id, expiry, symbol='MNQ'):
+            return MagicMock(local_symbol=f'{symbol}{expiry}',
+                             contract=MagicMock(conId=con_id, secType='FUT', symbol=symbol, exchange='GLOBEX', currency='USD',
+                                                multiplier='2', lastTradeDateOrContractMonth=expiry))
+
+        front, back, other = future(1, '20220318'), future(2, '20220617'), future(3, '20220318', 'MES')
+        trades = {
+            2: ConsolidatedTrade(contract=back, quantity=6, source={'s0': 5, 's1': 1}),
+            1: ConsolidatedTrade(contract=front, quantity=-4, source={'s0': -5, 's2': 1}),
+            3: ConsolidatedTrade(contract=other, quantity=-1, source={'s0': -1})
+        }
+        with patch.object(self.test_obj, '_trades', trades), patch.object(self.test_obj, '_calendar_spreads', {}):
+            self.test_obj.combine_rolls()
+            spread = self.test_obj.calendar_spreads[(2, 1)]
+            self.assertEqual(({2: 1, 1: -1}, 'MNQ20220318/MNQ20220617', 5, {'s0': 5}),
+                             (spread.legs, spread.local_symbol, spread.quantity, spread.source))
+            self.assertEqual('BAG', spread.contract.secType)
+            self.assertListEqual([(2, 'BUY'), (1, 'SELL')], [(leg.conId, leg.action) for leg in spread.contract.comboLegs])
+            # the rest is traded outright
+            self.assertDictEqual({
+                2: ConsolidatedTrade(contract=back, quantity=1, source={'s1': 1}),
+                1: ConsolidatedTrade(contract=front, quantity=1, source={'s2': 1}),
+                3: ConsolidatedTrade(contract=other, quantity=-1, source={'s0': -1})
+            }, self.test_obj.trades)
+
+        # no roll: trades in the same direction
+        trades = {1: ConsolidatedTrade(contract=front, quantity=1, source={'s0': 1}),
+                  2: ConsolidatedTrade(contract=back, quantity=1, source={'s0': 1})}
+        with patch.object(self.test_obj, '_trades', trades), patch.object(self.test_obj, '_calendar_spreads', {}):
+            self.test_obj.combine_rolls()
+            self.assertDictEqual({}, self.test_obj.calendar_spreads)
+            self.assertEqual(2, len(self.test_obj.trades))
+
+    @patch('lib.trading.datetime', now=MagicMock(return_value=datetime(2022, 1, 1)))
+    def test_log_trades_calendar_spread(self, *_):
+        trade = MagicMock(contract=MagicMock(conId=0, secType='BAG', comboLegs=[MagicMock(conId=2), MagicMock(conId=1)]),
+                          orderStatus=MagicMock(status=OrderStatus.Filled, nonDefaults=MagicMock(return_value={})),
+                          order=MagicMock(nonDefaults=MagicMock(return_value={})),
+                          isActive=MagicMock(return_value=False))
+        spread = CalendarSpread(contract=trade.contract, legs={2: 1, 1: -1}, local_symbol='MNQH2/MNQM2', quantity=5, source={'s0': 5})
+        with patch.object(self.test_obj, '_calendar_spreads', {(2, 1): spread}):
+            with patch.object(self.test_obj, '_env', trading_mode='trading_mode') as env:
+                env.db.collection.return_value.document.return_value.get.return_value = MagicMock(exists=True, to_dict=MagicMock(return_value={'1': 5}))
+                actual = self.test_obj._log_trades([trade])
+                self.assertListEqual(['MNQH2/MNQM2'], [*actual.keys()])
+                try:
+                    env.db.collection.return_value.document.assert_called_once_with('s0')
+                    env.db.collection.return_value.document.return_value.update.assert_called_once_with({'2': 5, '1': DELETE_FIELD})
+                except AssertionError:
+                    self.fail()
+
     @patch('lib.trading.datetime', now=MagicMock(return_value=datetime(2022, 1, 1)))
     def test_log_trades(self, *_):
         active_trades = [MagicMock(contract=MagicMock(conId=i, localSymbol=f's{i}'),
@@ -231,8 +526,8 @@ class TestTrade(unittest.TestCase):
                                  order=MagicMock(orderId=f'o{i + len(active_trades)}', permId=f'p{i + len(active_trades)}', nonDefaults=MagicMock(return_value={i + len(active_trades): f'{i + len(active_trades)}'})),
                                  isActive=MagicMock(return_value=i + len(active_trades)))
                        for i, o in enumerate(OrderStatus.DoneStates)]
-        _active_trades = {i: {'source': {f's{i}': (i + 1) * 100}} for i in range(len(active_trades))}
-        _done_trades = {i + len(active_trades): {'source': {f's{i + len(active_trades)}': (i + len(active_trades) + 1) * 100}} for i in range(len(done_trades))}
+        _active_trades = {i: MagicMock(source={f's{i}': (i + 1) * 100}) for i in range(len(active_trades))}
+        _done_trades = {i + len(active_trades): MagicMock(source={f's{i + len(active_trades)}': (i + len(active_trades) + 1) * 100}) for i in range(len(done_trades))}
 
         with patch.object(self.test_obj, '_trades', {**_active_trades, **_done_trades}):
             with patch.object(self.test_obj, '_env',
@@ -255,7 +550,7 @@ class TestTrade(unittest.TestCase):
                 self.assertDictEqual(expected, actual)
                 try:
                     env.db.collection.assert_has_calls([call('positions/trading_mode/openOrders') for _ in range(len(active_trades))] + [call('positions/trading_mode/holdings') for _ in range(len(done_trades))])
-                    env.db.collection.return_value.document.assert_has_calls([call() for _ in range(len(active_trades))] + [call(k) for v in _done_trades.values() for k in v['source'].keys()])
+                    env.db.collection.return_value.document.assert_has_calls([call() for _ in range(len(active_trades))] + [call(k) for v in _done_trades.values() for k in v.source.keys()])
                     env.db.collection.return_value.document.return_value.set.assert_has_calls([call({
                         'acctNumber': self.CONFIG['account'],
                         'contractId': i,
@@ -280,7 +575,7 @@ class TestTrade(unittest.TestCase):
 
     @patch.object(MarketOrder, 'update', return_value=MagicMock(update=MagicMock()))
     def test_place_orders(self, market_order):
-        trades = {i: {'contract': MagicMock(contract=f'c{i}'), 'quantity': (2 * int(i % 2) - 1) * (i + 1) * 100} for i in range(3)}
+        trades = {i: ConsolidatedTrade(contract=MagicMock(contract=f'c{i}'), quantity=(2 * int(i % 2) - 1) * (i + 1) * 100, source={}) for i in range(3)}
         order_prarams = {'key': 'param_value'}
         order_properties = {'key': 'property_value'}
 
@@ -302,6 +597,22 @@ class TestTrade(unittest.TestCase):
                     except AssertionError:
                         self.fail()
 
+    @patch.object(MarketOrder, 'update', return_value=MagicMock(update=MagicMock()))
+    def test_place_orders_calendar_spread(self, market_order):
+        spread = CalendarSpread(contract='bag', legs={}, local_symbol='', quantity=-2, source={})
+        with patch.object(self.test_obj, '_trades', {1: ConsolidatedTrade(contract=MagicMock(contract='c1'), quantity=1, source={})}), \
+                patch.object(self.test_obj, '_calendar_spreads', {(2, 1): spread}), \
+                patch.object(self.test_obj, '_log_trades'), \
+                patch.object(self.test_obj, '_env') as env:
+            self.test_obj.place_orders(market_order, {'key': 'param_value'}, spread_order_params={'key': 'spread_value'})
+            try:
+                market_order.assert_has_calls([call(action='BUY', totalQuantity=1, key='param_value'),
+                                               call(action='SELL', totalQuantity=2, key='spread_value')])
+                self.assertListEqual(['c1', 'bag'], [c[0][0] for c in env.ibgw.placeOrder.call_args_list])
+                env.ibgw.sleep.assert_called_once_with(2)
+            except AssertionError:
+                self.fail()
+
 
 if __name__ == '__main__':
     unittest.main()
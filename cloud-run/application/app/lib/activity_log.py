@@ -0,0 +1,162 @@
+import atexit
+from hashlib import md5
+import json
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import sleep
+
+from google.api_core.exceptions import Aborted, DeadlineExceeded, InternalServerError, ServiceUnavailable, TooManyRequests
+
+from lib.environment import Environment
+from lib.tracing import Tracer
+
+
+class ActivityLogWriter:
+    """
+    Background writer for activity log entries. Entries are queued and written to
+    Firestore in batches (and optionally streamed to BigQuery) by a daemon thread
+    so that intents don't have to wait for the writes. The static config is stored
+    once per content hash under activityConfigs/{hash} and referenced from the entry.
+    Transient errors are retried; if a batch still fails, its entries are written one
+    by one so that a single bad entry doesn't drop the others.
+    """
+
+    BATCH_SIZE = 50
+    BATCH_WAIT = 0.5
+    COLLECTION = 'activity'
+    CONFIG_COLLECTION = 'activityConfigs'
+    RETRIES = 3
+    RETRY_WAIT = 0.5
+    TRANSIENT_ERRORS = (Aborted, DeadlineExceeded, InternalServerError, ServiceUnavailable, TooManyRequests)
+    _atexit_registered = False
+    _config_hashes = set()
+    _lock = Lock()
+    _queue = Queue()
+    _thread = None
+
+    def __init__(self):
+        self._env = Environment()
+
+    def enqueue(self, entry, collection=None):
+        """
+        Queues an entry for writing and makes sure the writer thread is running.
+
+        :param entry: activity log entry (dict)
+        :param collection: Firestore collection (str)
+        """
+        with self._lock:
+            if ActivityLogWriter._thread is None or not ActivityLogWriter._thread.is_alive():
+                ActivityLogWriter._thread = Thread(target=self._run, name='activity-log-writer', daemon=True)
+                ActivityLogWriter._thread.start()
+            if not ActivityLogWriter._atexit_registered:
+                atexit.register(self.flush)
+                ActivityLogWriter._atexit_registered = True
+        self._queue.put((collection or self.COLLECTION, entry))
+
+    def flush(self):
+        """
+        Blocks until all queued entries have been written.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def _dedup_config(self, entry, batch, config_hashes):
+        """
+        Replaces the config in an entry by a reference to its hash, adding the config
+        to the batch if it hasn't been stored yet.
+
+        :param entry: activity log entry (dict)
+        :param batch: Firestore write batch
+        :param config_hashes: config hashes already added to the batch (set)
+        :return: activity log entry (dict)
+        """
+        if 'config' not in entry:
+            return entry
+        entry = {**entry}
+        config = entry.pop('config')
+        config_hash = md5(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+        if config_hash not in self._config_hashes | config_hashes:
+            batch.set(self._env.db.collection(self.CONFIG_COLLECTION).document(config_hash), config)
+            config_hashes.add(config_hash)
+        return {**entry, 'configHash': config_hash}
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            try:
+                while len(items) < self.BATCH_SIZE:
+                    items.append(self._queue.get(timeout=self.BATCH_WAIT))
+            except Empty:
+                pass
+            try:
+                self._write(items)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def _commit(self, items):
+        """
+        Writes entries to Firestore in a single batch, retrying transient errors.
+
+        :param items: collection and entry pairs (list of tuple)
+        :return: collection and entry pairs as written (list of tuple)
+        """
+        for attempt in range(self.RETRIES + 1):
+            config_hashes = set()
+            batch = self._env.db.batch()
+            entries = []
+            for collection, entry in items:
+                entry = self._dedup_config(entry, batch, config_hashes)
+                batch.set(self._env.db.collection(collection).document(), entry)
+                entries.append((collection, entry))
+            try:
+                with Tracer.span('firestore.writeActivity') as span:
+                    span.size = len(entries)
+                    batch.commit()
+            except self.TRANSIENT_ERRORS as e:
+                if attempt == self.RETRIES:
+                    raise
+                self._env.logging.warning('Error writing activity log, retrying: %s', e)
+                sleep(self.RETRY_WAIT * 2 ** attempt)
+                continue
+            self._config_hashes.update(config_hashes)
+            return entries
+
+    def _write(self, items):
+        """
+        Writes queued entries to Firestore in a single batch and to BigQuery if configured.
+        If the batch fails with a permanent error, the entries are written one by one.
+
+        :param items: collection and entry pairs (list of tuple)
+        """
+        try:
+            entries = self._commit(items)
+        except Exception as e:
+            # still failing after the retries, or nothing left to split
+            if len(items) == 1 or isinstance(e, self.TRANSIENT_ERRORS):
+                self._env.logging.error(e)
+                for _, entry in items:
+                    self._env.logging.info(entry)
+                return
+            self._env.logging.warning('Error writing activity log batch, writing entries one by one: %s', e)
+            for item in items:
+                self._write([item])
+            return
+
+        if table := self._env.config.get('activityLogBigQueryTable'):
+            rows = [{
+                'timestamp': entry['timestamp'].isoformat() if 'timestamp' in entry else None,
+                'tradingMode': entry.get('tradingMode'),
+                'intent': entry.get('intent'),
+                'signature': entry.get('signature'),
+                'configHash': entry.get('configHash'),
+                'entry': json.dumps(entry, default=str)
+            } for collection, entry in entries if collection == self.COLLECTION]
+            try:
+                with Tracer.span('bigquery.insertActivity') as span:
+                    span.size = len(rows)
+                    errors = self._env.bq.insert_rows_json(table, rows) if len(rows) else []
+                if len(errors):
+                    self._env.logging.warning(f'BigQuery activity log errors: {errors}')
+            except Exception as e:
+                self._env.logging.error(f'BigQuery error: {e}')
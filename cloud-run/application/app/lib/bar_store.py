@@ -0,0 +1,175 @@
+import os
+from threading import Lock, RLock, Thread
+
+import numpy as np
+
+from lib.environment import Environment
+
+
+class BarStore:
+    """
+    Local store of historical bars with one memory-mapped NumPy file pair per
+    instrument and bar size (timestamps in ns since epoch, and OHLCV values).
+    New ranges are merged in incrementally, reads are zero-copy slices of the
+    memory map and the store can be synced from a BigQuery table (in the background).
+    """
+
+    COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+    ROOT = '/tmp/bars'
+    SYNC_QUERY = """
+        SELECT UNIX_MICROS(timestamp) AS timestamp, {columns}
+        FROM `{table}`
+        WHERE key = @key AND timestamp >= TIMESTAMP_MICROS(@since)
+        ORDER BY timestamp
+    """
+    _locks = {}
+    _lock = Lock()
+
+    def __init__(self, root=None):
+        self._env = Environment()
+        self._root = root or self._env.config.get('barStorePath', self.ROOT)
+
+    @staticmethod
+    def key(instrument, bar_size):
+        """
+        Builds the store key of an instrument and bar size.
+
+        :param instrument: contract ID or local symbol (int or str)
+        :param bar_size: bar size, e.g. '1 day' (str)
+        :return: key (str)
+        """
+        return f"{instrument}_{bar_size.replace(' ', '')}"
+
+    def _lock_for(self, key):
+        # re-entrant, as merging loads under the same lock
+        with self._lock:
+            return self._locks.setdefault((self._root, key), RLock())
+
+    def _paths(self, key):
+        return os.path.join(self._root, f'{key}.timestamps.npy'), os.path.join(self._root, f'{key}.values.npy')
+
+    def load(self, key):
+        """
+        Memory-maps the bars of a key.
+
+        :param key: store key (str)
+        :return: timestamps (np.ndarray of datetime64[ns]), values (np.ndarray, bars x columns)
+        """
+        timestamps_path, values_path = self._paths(key)
+        if not os.path.exists(timestamps_path):
+            return np.empty(0, dtype='datetime64[ns]'), np.empty((0, len(self.COLUMNS)))
+        with self._lock_for(key):
+            return np.load(timestamps_path, mmap_mode='r'), np.load(values_path, mmap_mode='r')
+
+    def merge(self, key, timestamps, values):
+        """
+        Merges bars into the store, new values taking precedence for existing timestamps.
+
+        :param key: store key (str)
+        :param timestamps: bar timestamps (array-like of datetime64)
+        :param values: bar values (array-like, bars x columns)
+        :return: number of bars stored (int)
+        """
+        timestamps = np.asarray(timestamps, dtype='datetime64[ns]')
+        values = np.asarray(values, dtype=float).reshape(len(timestamps), len(self.COLUMNS))
+
+        os.makedirs(self._root, exist_ok=True)
+        # held across the read-modify-write, so that concurrent merges don't drop each other's bars
+        with self._lock_for(key):
+            old_timestamps, old_values = self.load(key)
+            if len(old_timestamps) and len(timestamps) and timestamps[0] >= old_timestamps[-1] and (np.diff(timestamps) > np.timedelta64(0)).all():
+                # the usual case: a range after the stored one is appended, replacing the last stored bar if included
+                n = len(old_timestamps) - int(timestamps[0] == old_timestamps[-1])
+                merged_timestamps = np.concatenate([old_timestamps[:n], timestamps])
+                merged_values = np.concatenate([old_values[:n], values])
+            else:
+                all_timestamps = np.concatenate([timestamps, old_timestamps])
+                # np.unique keeps the first occurrence, i.e. the new bar
+                merged_timestamps, index = np.unique(all_timestamps, return_index=True)
+                merged_values = np.concatenate([values, old_values])[index]
+
+            # write to temporary files and swap, existing memory maps keep reading the old files
+            for path, array in zip(self._paths(key), [merged_timestamps, merged_values]):
+                with open(f'{path}.tmp', 'wb') as fp:
+                    np.save(fp, array)
+                os.replace(f'{path}.tmp', path)
+        return len(merged_timestamps)
+
+    def slice(self, key, start=None, end=None):
+        """
+        Gets the bars within a date range as views of the memory map (no copy).
+
+        :param key: store key (str)
+        :param start: first timestamp, inclusive (datetime or np.datetime64)
+        :param end: last timestamp, exclusive (datetime or np.datetime64)
+        :return: timestamps (np.ndarray), values (np.ndarray)
+        """
+        timestamps, values = self.load(key)
+        i = 0 if start is None else np.searchsorted(timestamps, np.datetime64(start, 'ns'), side='left')
+        j = len(timestamps) if end is None else np.searchsorted(timestamps, np.datetime64(end, 'ns'), side='left')
+        return timestamps[i:j], values[i:j]
+
+    def column(self, key, column='close', start=None, end=None):
+        """
+        Gets a single column of bars within a date range (no copy).
+
+        :param key: store key (str)
+        :param column: column name (str)
+        :param start: first timestamp, inclusive (datetime or np.datetime64)
+        :param end: last timestamp, exclusive (datetime or np.datetime64)
+        :return: timestamps (np.ndarray), values (np.ndarray)
+        """
+        timestamps, values = self.slice(key, start, end)
+        return timestamps, values[:, self.COLUMNS.index(column)]
+
+    def covers(self, key, start=None):
+        """
+        Checks whether the store has bars for a range starting at start, i.e. whether
+        any are stored and the last one isn't before start.
+
+        :param key: store key (str)
+        :param start: first timestamp, inclusive (datetime or np.datetime64)
+        :return: whether the range is covered (bool)
+        """
+        timestamps, _ = self.load(key)
+        return len(timestamps) > 0 and (start is None or timestamps[-1] >= np.datetime64(start, 'ns'))
+
+    def sync(self, key, table=None):
+        """
+        Fetches the bars from the last stored one onwards from BigQuery. The last stored
+        bar is fetched again, as it may have been stored while still incomplete.
+
+        :param key: store key (str)
+        :param table: BigQuery table with columns key, timestamp and the bar columns (str)
+        :return: number of bars fetched (int)
+        """
+        table = table or self._env.config['barStoreTable']
+        timestamps, _ = self.load(key)
+        since = int(timestamps[-1].astype('datetime64[us]').astype(np.int64)) if len(timestamps) else 0
+        rows = self._env.query_bigquery(self.SYNC_QUERY.format(columns=', '.join(self.COLUMNS), table=table),
+                                        {'key': key, 'since': since}, return_type='list')
+        if len(rows):
+            self.merge(key,
+                       np.array([r['timestamp'] for r in rows], dtype='datetime64[us]'),
+                       [[r[c] for c in self.COLUMNS] for r in rows])
+        self._env.logging.debug(f'Synced {len(rows)} bars for {key} from {table}')
+        return len(rows)
+
+    def sync_in_background(self, *keys, table=None):
+        """
+        Syncs keys from BigQuery in a background thread.
+
+        :param keys: store keys (str)
+        :param table: BigQuery table (str)
+        :return: sync thread (Thread)
+        """
+        def run():
+            for key in keys:
+                try:
+                    self.sync(key, table)
+                except Exception as e:
+                    self._env.logging.warning(f'Bar store sync of {key} failed: {e}')
+
+        thread = Thread(target=run, name='bar-store-sync', daemon=True)
+        thread.start()
+        return thread
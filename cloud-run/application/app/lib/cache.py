@@ -0,0 +1,98 @@
+from hashlib import sha256
+import json
+import os
+import pickle
+from threading import Lock
+from time import time
+
+
+class DiskCache:
+    """
+    Size-bounded LRU cache on local disk with a time-to-live per entry. Each entry is
+    a pickle file named after the hash of its key; the file's modification time tracks
+    the last access, so the least recently used entries are evicted first.
+    """
+
+    DIRECTORY = '/tmp/cache'
+    MAX_BYTES = 256 * 1024 ** 2
+    _lock = Lock()
+
+    def __init__(self, directory=DIRECTORY, max_bytes=MAX_BYTES):
+        self._directory = directory
+        self._max_bytes = max_bytes
+
+    @staticmethod
+    def key(*parts):
+        """
+        Hashes the parts of a key.
+
+        :param parts: JSON-serialisable key parts
+        :return: key (str)
+        """
+        return sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, f'{key}.pkl')
+
+    def get(self, key):
+        """
+        Gets an entry if it exists and hasn't expired.
+
+        :param key: key (str)
+        :return: value (or None)
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fp:
+                expires, value = pickle.load(fp)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires < time():
+            self.delete(key)
+            return None
+        # mark as recently used
+        os.utime(path)
+        return value
+
+    def set(self, key, value, ttl):
+        """
+        Stores an entry and evicts the least recently used ones beyond the size limit.
+
+        :param key: key (str)
+        :param value: picklable value
+        :param ttl: time-to-live in seconds (float)
+        """
+        os.makedirs(self._directory, exist_ok=True)
+        path = self._path(key)
+        with open(f'{path}.tmp', 'wb') as fp:
+            pickle.dump((time() + ttl, value), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{path}.tmp', path)
+        self._evict()
+
+    def delete(self, key):
+        """
+        Deletes an entry.
+
+        :param key: key (str)
+        """
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self._directory):
+                if entry.name.endswith('.pkl'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self._max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
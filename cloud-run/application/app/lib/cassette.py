@@ -0,0 +1,192 @@
+import atexit
+from collections import defaultdict, deque
+from copy import deepcopy
+import gzip
+import pickle
+from time import perf_counter
+
+from lib.gcp import logger as logging
+
+
+class Cassette:
+    """
+    Record/replay of IB gateway traffic. In record mode, the results of the IBGW
+    request methods are captured together with the time each call took and saved
+    to a gzipped pickle. In replay mode, the recorded results are served in the
+    order they were recorded (per method and arguments), without a gateway, and the
+    recorded latencies are reproduced scaled by time_scale (0 replays at full speed).
+
+    Order and fill events are recorded with the call during or after which they
+    arrived and the time since that call started, and emitted again at the same
+    point when replaying, so that fill-driven code can be replayed too.
+    """
+
+    EVENTS = ['commissionReportEvent', 'execDetailsEvent', 'orderStatusEvent']
+
+    METHODS = [
+        'accountValues', 'cancelOrder', 'executions', 'fills', 'openTrades', 'placeOrder', 'portfolio', 'positions',
+        'reqContractDetails', 'reqCurrentTime', 'reqExecutions', 'reqGlobalCancel', 'reqHistoricalData',
+        'reqSecDefOptParams', 'reqTickers', 'request_batch', 'trades', 'whatIfOrder'
+    ]
+    # gateway session handling that is skipped when replaying
+    REPLAY_NOOPS = ['connect', 'disconnect', 'reqMarketDataType', 'start_and_connect', 'stop_and_terminate']
+    MODES = ['record', 'replay']
+    VERSION = 2
+
+    def __init__(self, path, mode='replay', time_scale=0.):
+        if mode not in self.MODES:
+            raise ValueError(f'Unknown cassette mode {mode}')
+        self._path = path
+        self._mode = mode
+        self._time_scale = time_scale
+        self._calls = defaultdict(deque)
+        self._events = deque()
+        # number of calls so far and start of the current one (replay: time since its start)
+        self._sequence = 0
+        self._clock = 0.
+        self._ibgw = None
+        if mode == 'replay':
+            self.load()
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def path(self):
+        return self._path
+
+    @staticmethod
+    def _key(method, args, kwargs):
+        return method, repr(args), repr(sorted(kwargs.items()))
+
+    def load(self):
+        """
+        Loads the recorded calls from disk.
+        """
+        with gzip.open(self._path, 'rb') as fp:
+            cassette = pickle.load(fp)
+        if cassette.get('version') != self.VERSION:
+            raise ValueError(f"Unsupported cassette version {cassette.get('version')}")
+        self._calls = defaultdict(deque, {k: deque(v) for k, v in cassette['calls'].items()})
+        self._events = deque(cassette['events'])
+        logging.info(f'Loaded {sum(len(v) for v in self._calls.values())} IB calls and {len(self._events)} events from {self._path}')
+
+    def save(self):
+        """
+        Saves the recorded calls to disk.
+        """
+        if self._mode != 'record':
+            return
+        with gzip.open(self._path, 'wb') as fp:
+            pickle.dump({'version': self.VERSION, 'calls': {k: list(v) for k, v in self._calls.items()}, 'events': list(self._events)},
+                        fp, protocol=pickle.HIGHEST_PROTOCOL)
+        logging.info(f'Saved {sum(len(v) for v in self._calls.values())} IB calls and {len(self._events)} events to {self._path}')
+
+    def record(self, method, func):
+        """
+        Wraps a method so that its results (or exceptions) are recorded.
+
+        :param method: method name (str)
+        :param func: bound method
+        :return: wrapped method
+        """
+        def wrapper(*args, **kwargs):
+            # keyed by the arguments as passed, as some are modified by the call (e.g. the order ID of an order)
+            key = self._key(method, args, kwargs)
+            self._sequence += 1
+            self._clock = start = perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self._calls[key].append((perf_counter() - start, None, e))
+                raise e
+            # copied like the events, as e.g. the status of a trade changes later on
+            self._calls[key].append((perf_counter() - start, deepcopy(result), None))
+            return result
+        return wrapper
+
+    def record_event(self, event):
+        """
+        Creates an event handler that records the event.
+
+        :param event: event name (str)
+        :return: event handler
+        """
+        def handler(*args):
+            # copied as e.g. the order status of a trade changes later on
+            self._events.append((self._sequence, perf_counter() - self._clock, event, deepcopy(args)))
+        return handler
+
+    def _emit_events(self, sequence, clock):
+        """
+        Emits the recorded events up to a call and the time since its start.
+
+        :param sequence: number of the call (int)
+        :param clock: time since the start of the call (float)
+        """
+        while len(self._events) and (self._events[0][0] < sequence or (self._events[0][0] == sequence and self._events[0][1] <= clock)):
+            _, _, event, args = self._events.popleft()
+            getattr(self._ibgw, event).emit(*args)
+
+    def replay(self, method, sleep):
+        """
+        Creates a method that serves the recorded results. The last result of a call is
+        served again once all recorded results have been consumed (e.g. when polling).
+
+        :param method: method name (str)
+        :param sleep: sleep function used to reproduce the recorded latencies
+        :return: replaying method
+        """
+        def wrapper(*args, **kwargs):
+            key = self._key(method, args, kwargs)
+            if not len(calls := self._calls.get(key, [])):
+                raise KeyError(f'No recorded IB call {method}{key[1]} {key[2]} in {self._path}')
+            # events that arrived after the previous call
+            self._emit_events(self._sequence, float('inf'))
+            elapsed, result, exception = calls.popleft() if len(calls) > 1 else calls[0]
+            self._sequence += 1
+            self._clock = elapsed
+            if self._time_scale:
+                sleep(elapsed * self._time_scale)
+            self._emit_events(self._sequence, self._clock)
+            if exception is not None:
+                raise exception
+            return result
+        return wrapper
+
+    def attach(self, ibgw):
+        """
+        Attaches the cassette to an IBGW instance by shadowing its methods.
+
+        :param ibgw: IB gateway (IBGW)
+        """
+        self._ibgw = ibgw
+        if self._mode == 'record':
+            for method in self.METHODS:
+                setattr(ibgw, method, self.record(method, getattr(ibgw, method)))
+            for event in self.EVENTS:
+                getattr(ibgw, event).connect(self.record_event(event))
+            stop_and_terminate = ibgw.stop_and_terminate
+
+            def stop_and_save(*args, **kwargs):
+                stop_and_terminate(*args, **kwargs)
+                self.save()
+
+            ibgw.stop_and_terminate = stop_and_save
+            atexit.register(self.save)
+        else:
+            sleep = ibgw.sleep
+
+            def scaled_sleep(secs=0.02):
+                if self._time_scale:
+                    sleep(secs * self._time_scale)
+                self._clock += secs
+                self._emit_events(self._sequence, self._clock)
+
+            for method in self.METHODS:
+                setattr(ibgw, method, self.replay(method, sleep))
+            for method in self.REPLAY_NOOPS:
+                setattr(ibgw, method, lambda *_, **__: None)
+            ibgw.isConnected = lambda: True
+            ibgw.sleep = scaled_sleep
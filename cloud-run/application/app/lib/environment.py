@@ -2,8 +2,10 @@ from ib_insync import util
 import logging
 from os import environ
 
+from lib.cassette import Cassette
 from lib.gcp import GcpModule
 from lib.ibgw import IBGW
+from lib.tracing import Tracer
 
 
 class Environment:
@@ -12,7 +14,7 @@ class Environment:
     class __Implementation(GcpModule):
 
         ACCOUNT_VALUE_TIMEOUT = 60
-        ENV_VARS = ['K_REVISION', 'PROJECT_ID']
+        ENV_VARS = ['IB_CASSETTE', 'IB_CASSETTE_MODE', 'IB_CASSETTE_TIME_SCALE', 'K_REVISION', 'PROJECT_ID']
         SECRET_RESOURCE = 'projects/{}/secrets/{}/versions/latest'
 
         def __init__(self, trading_mode, ibc_config):
@@ -27,13 +29,19 @@ class Environment:
             self._logging.debug({**config, 'password': 'xxx'})
 
             # query config
-            self._config = {
-                **self._db.document('config/common').get().to_dict(),
-                **self._db.document(f'config/{self._trading_mode}').get().to_dict()
-            }
+            with Tracer.span('firestore.getConfig'):
+                self._config = {
+                    **self._db.document('config/common').get().to_dict(),
+                    **self._db.document(f'config/{self._trading_mode}').get().to_dict()
+                }
 
             # instantiate IB Gateway
             self._ibgw = IBGW(config)
+            if 'IB_CASSETTE' in self._env:
+                # record IB traffic or replay it offline
+                self._ibgw.use_cassette(Cassette(self._env['IB_CASSETTE'],
+                                                 self._env.get('IB_CASSETTE_MODE', 'replay'),
+                                                 float(self._env.get('IB_CASSETTE_TIME_SCALE', 0))))
             # set IB logging level
             util.logToConsole(level=logging.ERROR)
 
@@ -57,6 +65,7 @@ class Environment:
         def trading_mode(self):
             return self._trading_mode
 
+        @Tracer.traced('ib.accountValues')
         def get_account_values(self, account, rows=('NetLiquidation', 'CashBalance', 'MaintMarginReq')):
             """
             Requests account data from IB.
@@ -66,7 +75,9 @@ class Environment:
             :return: account data (dict)
             """
             account_summary = {}
-            account_value = []
+            # account values are kept up to date for the whole gateway session, so there's
+            # no need to wait if they have been received already (e.g. by an earlier intent)
+            account_value = self._ibgw.accountValues(account)
             timeout = self.ACCOUNT_VALUE_TIMEOUT
             while not len(account_value) and timeout:
                 # needs several attempts sometimes, so let's retry
@@ -0,0 +1,160 @@
+from decimal import Decimal, ROUND_CEILING, ROUND_FLOOR
+
+import ib_insync
+
+from lib.environment import Environment
+from lib.trading import InstrumentSet
+
+
+class LimitExecution:
+    """
+    Places the outright trades of a Trade as limit orders, priced off the ticker snapshot
+    (midpoint, or close without a quote) at a distance and rounded to the contract's min.
+    tick. Orders still working are re-priced to the current market on a schedule by
+    modifying them in place, so that the limit follows the market like a peg. Fill
+    latency and slippage versus the arrival price are reported per order.
+    """
+
+    REPRICE_ATTEMPTS = 0
+    REPRICE_SECONDS = 30
+
+    def __init__(self, trade, distance=0., reprice_attempts=REPRICE_ATTEMPTS, reprice_seconds=REPRICE_SECONDS):
+        """
+        :param trade: consolidated trades (Trade)
+        :param distance: distance of the limit from the reference price, marketable if positive (float)
+        :param reprice_attempts: max. number of times working orders are re-priced (int)
+        :param reprice_seconds: seconds between re-pricing (float)
+        """
+        self._env = Environment()
+        self._trade = trade
+        self._distance = distance
+        self._reprice_attempts = reprice_attempts
+        self._reprice_seconds = reprice_seconds
+        self._arrival_prices = {}
+        self._reprices = {}
+
+    @staticmethod
+    def round_to_tick(price, min_tick, action):
+        """
+        Rounds a limit price to the tick size, buys down and sells up so that the limit
+        is never more aggressive than intended. Decimal arithmetic avoids prices like
+        4500.250000001 that IB rejects.
+
+        :param price: price (float)
+        :param min_tick: tick size (float)
+        :param action: 'BUY' or 'SELL' (str)
+        :return: price (float)
+        """
+        tick = Decimal(str(min_tick))
+        ticks = (Decimal(str(price)) / tick).to_integral_value(ROUND_FLOOR if action == 'BUY' else ROUND_CEILING)
+        return float(ticks * tick)
+
+    @staticmethod
+    def reference_price(ticker):
+        """
+        Gets the reference price of a ticker snapshot.
+
+        :param ticker: ticker (ib_insync Ticker object)
+        :return: midpoint, or close without a quote (float or None)
+        """
+        if ticker is None:
+            return None
+        price = ticker.midpoint()
+        if price != price:
+            price = ticker.close
+        return price if price == price and price > 0 else None
+
+    def limit_price(self, instrument, quantity):
+        """
+        Calculates the limit price of a trade from the instrument's ticker snapshot.
+
+        :param instrument: instrument (Instrument)
+        :param quantity: quantity, negative to sell (int)
+        :return: limit price, None if there is no price or min. tick (float)
+        """
+        reference_price = self.reference_price(instrument.tickers)
+        if reference_price is None or instrument.record is None or not instrument.record.min_tick:
+            return None
+        side = 1 if quantity > 0 else -1
+        return self.round_to_tick(reference_price * (1 + side * self._distance), instrument.record.min_tick,
+                                  'BUY' if side > 0 else 'SELL')
+
+    def place_orders(self, order_params=None, order_properties=None, spread_order_params=None):
+        """
+        Places the orders (limit orders where a price is available, otherwise market orders),
+        re-prices the ones still working and reports the execution.
+
+        :param order_params: arguments for IB order (dict)
+        :param order_properties: additional order parameters (dict)
+        :param spread_order_params: arguments for IB combo orders of calendar spreads (dict)
+        :return: activity log entry (dict)
+        """
+        trades = self._trade.trades
+        # one ticker batch for the contracts without a snapshot yet
+        if len(missing := InstrumentSet(*[v.contract for v in trades.values() if v.contract.tickers is None])):
+            missing.get_tickers()
+
+        limit_prices = {}
+        for k, v in trades.items():
+            if (price := self.limit_price(v.contract, v.quantity)) is None:
+                self._env.logging.warning('No price or min. tick for %s, placing a market order', v.contract.local_symbol)
+                continue
+            limit_prices[k] = price
+            self._arrival_prices[k] = self.reference_price(v.contract.tickers)
+
+        trade_log = self._trade.place_orders(ib_insync.MarketOrder, order_params, order_properties, spread_order_params,
+                                             limit_prices=limit_prices)
+        self.reprice()
+        return trade_log
+
+    def reprice(self):
+        """
+        Re-prices the limit orders that are still working to the current market, waiting
+        reprice_seconds before each attempt.
+        """
+        for _ in range(self._reprice_attempts):
+            self._env.ibgw.sleep(self._reprice_seconds)
+            working = [t for t in self._trade.orders
+                       if t.contract.conId in self._arrival_prices and t.order.orderType == 'LMT' and t.isActive()]
+            if not len(working):
+                break
+
+            instruments = InstrumentSet(*[self._trade.trades[t.contract.conId].contract for t in working])
+            instruments.get_tickers()
+            repriced = 0
+            for t in working:
+                price = self.limit_price(instruments.get(t.contract.conId), 1 if t.order.action == 'BUY' else -1)
+                if price is not None and price != t.order.lmtPrice:
+                    # modifying an order means placing it again with the same order ID
+                    t.order.lmtPrice = price
+                    self._env.ibgw.placeOrder(t.contract, t.order)
+                    self._reprices[t.contract.conId] = self._reprices.get(t.contract.conId, 0) + 1
+                    repriced += 1
+            self._env.logging.info('Re-priced %d of %d working orders', repriced, len(working))
+
+    def report(self):
+        """
+        Reports the execution of the limit orders: slippage of the average fill price versus
+        the arrival price (positive if worse) and the latency from submission to the last fill.
+
+        :return: execution report by local symbol (dict)
+        """
+        report = {}
+        for t in self._trade.orders:
+            if (k := t.contract.conId) not in self._arrival_prices:
+                continue
+            instrument = self._trade.trades[k].contract
+            side = 1 if t.order.action == 'BUY' else -1
+            avg_fill_price = t.orderStatus.avgFillPrice if t.orderStatus.filled else None
+            slippage = side * (avg_fill_price - self._arrival_prices[k]) if avg_fill_price is not None else None
+            report[instrument.local_symbol] = {
+                'arrivalPrice': self._arrival_prices[k],
+                'limitPrice': t.order.lmtPrice,
+                'filled': t.orderStatus.filled,
+                'avgFillPrice': avg_fill_price,
+                'slippage': slippage,
+                'slippageTicks': slippage / instrument.record.min_tick if slippage is not None else None,
+                'latencySeconds': (t.fills[-1].time - t.log[0].time).total_seconds() if len(t.fills) and len(t.log) else None,
+                'reprices': self._reprices.get(k, 0)
+            }
+        return report
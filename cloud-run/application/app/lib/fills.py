@@ -0,0 +1,172 @@
+from google.api_core.exceptions import Conflict
+from google.cloud.firestore_v1 import DELETE_FIELD, transactional
+
+from lib.environment import Environment
+
+
+@transactional
+def _complete_order(transaction, db, trading_mode, order_ref, fill, execution_doc=None, execution=None):
+    """
+    Applies an order to the holdings of its source strategies and deletes it, if the fill
+    completes it. The order and holdings are read within the transaction, so an order
+    that a concurrent run has applied (and deleted) already is not applied twice.
+
+    :param transaction: Firestore transaction (Transaction)
+    :param db: Firestore client (Client)
+    :param trading_mode: trading mode (str)
+    :param order_ref: openOrders document (DocumentReference)
+    :param fill: latest fill of the order (ib_insync Fill object)
+    :param execution_doc: executions document to record the execution under (DocumentReference)
+    :param execution: execution to record (dict)
+    :return: the order if it was completed (dict or None)
+    """
+    if execution_doc is not None and execution_doc.get(transaction=transaction).exists:
+        raise Conflict(f'Execution {fill.execution.execId} exists already')
+    # gone if the order has been applied already
+    order = order_ref.get(transaction=transaction).to_dict() or {}
+    side = 1 if fill.execution.side == 'BOT' else -1
+    completed = len(order) and side * fill.execution.cumQty == sum(order['source'].values())
+    # a calendar spread is complete with the execution of the combo, not of its legs
+    if 'legs' in order and fill.contract.secType != 'BAG':
+        completed = False
+
+    holdings = {}
+    if completed:
+        for strategy in order['source']:
+            holdings_doc = db.document(f'positions/{trading_mode}/holdings/{strategy}')
+            holdings[strategy] = (holdings_doc, holdings_doc.get(transaction=transaction))
+
+    # all reads precede the writes
+    if execution_doc is not None:
+        transaction.set(execution_doc, execution)
+    if not completed:
+        return None
+    legs = order.get('legs', {str(fill.contract.conId): 1})
+    for strategy, quantity in order['source'].items():
+        holdings_doc, snapshot = holdings[strategy]
+        positions = snapshot.to_dict() or {}
+        action = transaction.update if snapshot.exists else transaction.set
+        action(holdings_doc, {k: positions.get(k, 0) + quantity * ratio or DELETE_FIELD for k, ratio in legs.items()})
+    transaction.delete(order_ref)
+    return order
+
+
+class FillHandler:
+    """
+    Applies fills to the Firestore holdings as they are received from the gateway.
+    Each execution is recorded once under executions/{execId} (the idempotency key),
+    and once an order is completely filled, the holdings of its source strategies are
+    updated and its openOrders document is removed.
+
+    ib_insync only dispatches events while its event loop runs, i.e. during IB calls,
+    and the (sync) worker doesn't run it between requests. With a persistent gateway,
+    fills are therefore applied during the next request rather than within seconds.
+    Trade reconciliation remains what guarantees that the holdings are complete.
+    """
+
+    _attached = None
+
+    def __init__(self):
+        self._env = Environment()
+
+    @classmethod
+    def attach(cls, ibgw):
+        """
+        Subscribes a fill handler to the execution and commission events of the gateway (once).
+
+        :param ibgw: IB gateway (IBGW)
+        :return: fill handler (FillHandler)
+        """
+        if cls._attached is None:
+            handler = cls()
+            ibgw.execDetailsEvent.connect(handler.on_exec_details)
+            ibgw.commissionReportEvent.connect(handler.on_commission_report)
+            cls._attached = handler
+        return cls._attached
+
+    def _execution_doc(self, exec_id):
+        return self._env.db.document(f'positions/{self._env.trading_mode}/executions/{exec_id}')
+
+    def find_open_order(self, execution, contract_id, open_orders=None):
+        """
+        Finds the openOrders document of an execution, by permId or else by orderId and contract.
+
+        :param execution: execution (ib_insync Execution object)
+        :param contract_id: contract ID (int)
+        :param open_orders: openOrders documents if already queried (list of DocumentSnapshot)
+        :return: openOrders document (DocumentSnapshot or None)
+        """
+        if open_orders is None:
+            collection = self._env.db.collection(f'positions/{self._env.trading_mode}/openOrders')
+            res = list(collection.where('permId', '==', execution.permId).get()) or \
+                list(collection.where('orderId', '==', execution.orderId).where('contractId', '==', contract_id).get())
+            return res[0] if len(res) else None
+
+        matches = [d for d in open_orders if d.get('permId') == execution.permId] or \
+                  [d for d in open_orders if d.get('orderId') == execution.orderId and d.get('contractId') == contract_id]
+        return matches[0] if len(matches) else None
+
+    def complete_order(self, order_doc, fill, execution=None):
+        """
+        Applies a completely filled order to the holdings of its source strategies and
+        removes it from openOrders, if the fill completes the order.
+
+        :param order_doc: openOrders document (DocumentSnapshot)
+        :param fill: latest fill of the order (ib_insync Fill object)
+        :param execution: execution to record under executions/{execId} in the same transaction (dict)
+        :return: whether the order was completed (bool)
+        """
+        execution_doc = self._execution_doc(fill.execution.execId) if execution is not None else None
+        order = _complete_order(self._env.db.transaction(), self._env.db, self._env.trading_mode, order_doc.reference,
+                                fill, execution_doc, execution)
+        if order is None:
+            return False
+        self._env.logging.info('Applied order %s to holdings of %s', fill.execution.permId, ', '.join(order['source'].keys()))
+        return True
+
+    def on_exec_details(self, _, fill):
+        """
+        Handles an execution (execDetailsEvent).
+
+        :param _: trade (ib_insync Trade object)
+        :param fill: fill (ib_insync Fill object)
+        """
+        execution = fill.execution
+        record = {
+            'acctNumber': execution.acctNumber,
+            'contractId': fill.contract.conId,
+            'cumQty': execution.cumQty,
+            'orderId': execution.orderId,
+            'permId': execution.permId,
+            'price': execution.price,
+            'shares': execution.shares,
+            'side': execution.side,
+            'timestamp': execution.time
+        }
+        try:
+            if (order_doc := self.find_open_order(execution, fill.contract.conId)) is not None:
+                # the execution is recorded along with the holdings, so a failed update is retried
+                self.complete_order(order_doc, fill, record)
+            else:
+                self._execution_doc(execution.execId).create(record)
+        except Conflict:
+            self._env.logging.debug('Execution %s has been handled already', execution.execId)
+        except Exception as e:
+            self._env.logging.error('Error handling execution %s: %s', execution.execId, e)
+
+    def on_commission_report(self, _, fill, report):
+        """
+        Adds the commission to an execution (commissionReportEvent).
+
+        :param _: trade (ib_insync Trade object)
+        :param fill: fill (ib_insync Fill object)
+        :param report: commission report (ib_insync CommissionReport object)
+        """
+        try:
+            self._execution_doc(fill.execution.execId).set({
+                'commission': report.commission,
+                'commissionCurrency': report.currency,
+                'realizedPNL': report.realizedPNL
+            }, merge=True)
+        except Exception as e:
+            self._env.logging.error('Error storing commission of %s: %s', fill.execution.execId, e)
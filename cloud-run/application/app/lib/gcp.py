@@ -1,22 +1,34 @@
+from copy import deepcopy
+from datetime import date, datetime
+from decimal import Decimal
 import json
 import logging
 from os import environ
 
 from google.cloud import bigquery, firestore_v1 as firestore, logging as gcp_logging, secretmanager_v1 as secretmanager
 
+from lib.cache import DiskCache
+from lib.log import Lazy, ModuleLevelFilter, setup_logger
+from lib.tracing import Tracer
+
 # set up Cloud Logging
 on_localhost = environ.get('K_SERVICE', 'localhost') == 'localhost'
 # logging.captureWarnings(True)
 handler = logging.StreamHandler() if on_localhost else gcp_logging.Client().get_default_handler()
-logger = logging.getLogger(__name__ if on_localhost else 'cloudLogger')
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
-logger.propagate = False
+# records are shipped by a background listener, levels can be set per module (e.g. LOG_LEVELS=lib.trading=INFO)
+logger, log_listener = setup_logger(__name__ if on_localhost else 'cloudLogger',
+                                    handler,
+                                    logging.getLevelName(environ.get('LOG_LEVEL', 'DEBUG').upper()),
+                                    ModuleLevelFilter.parse_levels(environ.get('LOG_LEVELS')))
 
 
 class GcpModule:
 
+    # list results from this many rows on are downloaded via the BigQuery Storage Read API
+    BQSTORAGE_MIN_ROWS = 100000
+
     _bq = bigquery.Client()
+    _cache = DiskCache(environ.get('QUERY_CACHE_DIRECTORY', DiskCache.DIRECTORY))
     _db = firestore.Client()
     _logging = logger
     _sm = secretmanager.SecretManagerServiceClient()
@@ -41,6 +53,7 @@ class GcpModule:
     def get_logger(cls):
         return cls._logging
 
+    @Tracer.traced('secretManager.getSecret')
     def get_secret(self, secret_name):
         """
         Fetches secrets from Secret Manager.
@@ -54,38 +67,65 @@ class GcpModule:
         except json.decoder.JSONDecodeError:
             return secret
 
-    def query_bigquery(self, query, query_parameters=None, job_config=None, return_type='DataFrame', **kwargs):
+    @Tracer.traced('bigquery.query')
+    def query_bigquery(self, query, query_parameters=None, job_config=None, return_type='DataFrame', cache_ttl=None,
+                       estimate_bytes=False, **kwargs):
         """
         Queries data form BigQuery.
 
         :param query: query string (str)
         :param query_parameters: parameters for parametrised query (dict)
         :param job_config: query job configuration (bigquery.job.QueryJobConfig)
-        :param return_type: type of the return object (e.g. 'DataFrame') (str)
+        :param return_type: type of the return object ('DataFrame', 'list' or 'arrow') (str)
+        :param cache_ttl: seconds to cache the result on local disk for, no caching if None (float)
+        :param estimate_bytes: log the bytes processed according to a dry run before executing (bool)
         :param kwargs: additional arguments for the fetch method
         :return: data (type depending on return_type, defaults to list of tuple)
         """
+        if cache_ttl is not None:
+            key = self._cache.key(query, query_parameters or {}, job_config.to_api_repr() if job_config is not None else {},
+                                  return_type.lower(), kwargs)
+            if (result := self._cache.get(key)) is not None:
+                self._logging.debug('Serving BigQuery result from cache')
+                return result
+            result = self.query_bigquery(query, query_parameters, job_config, return_type, estimate_bytes=estimate_bytes, **kwargs)
+            self._cache.set(key, result, cache_ttl)
+            return result
+
         query_parameters = query_parameters or {}
         job_config = job_config or bigquery.job.QueryJobConfig()
 
-        def _create_query_parameters(params):
-            parameter_types = {
-                # dict: bigquery.StructQueryParameter,
-                list: bigquery.ArrayQueryParameter
-            }
+        def _data_type(value):
             data_types = {
                 bool: 'BOOL',
-                int: 'INT64',
+                bytes: 'BYTES',
+                date: 'DATE',
+                Decimal: 'NUMERIC',
                 float: 'FLOAT64',
+                int: 'INT64',
                 str: 'STRING'
             }
+            if isinstance(value, datetime):
+                # timezone-aware datetimes are points in time, naive ones are civil time
+                return 'DATETIME' if value.tzinfo is None else 'TIMESTAMP'
+            return data_types.get(type(value))
+
+        def _create_query_parameter(name, value):
+            if isinstance(value, dict):
+                fields = [_create_query_parameter(k, v) for k, v in value.items()]
+                return bigquery.StructQueryParameter(name, *fields) if all(f is not None for f in fields) else None
+            if isinstance(value, list):
+                if isinstance(value[0], dict):
+                    structs = [_create_query_parameter(None, v) for v in value]
+                    return bigquery.ArrayQueryParameter(name, 'STRUCT', structs) if all(s is not None for s in structs) else None
+                return bigquery.ArrayQueryParameter(name, dtype, value) if (dtype := _data_type(value[0])) else None
+            return bigquery.ScalarQueryParameter(name, dtype, value) if (dtype := _data_type(value)) else None
 
+        def _create_query_parameters(params):
             query_parameters = []
             for k, v in params.items():
-                ptype, dtype = type(v), type(v[0] if isinstance(v, list) else v)
-                if dtype in data_types.keys():
-                    query_parameters.append(
-                        parameter_types.get(ptype, bigquery.ScalarQueryParameter)(k, data_types[dtype], v))
+                if (parameter := _create_query_parameter(k, v)) is not None:
+                    query_parameters.append(parameter)
                 else:
                     self._logging.warning(f'No BigQuery query parameter type for {v.__class__.__name__} available')
 
@@ -97,8 +137,19 @@ class GcpModule:
             self._logging.error(e)
             raise Exception('Query parameter error')
 
+        if estimate_bytes:
+            try:
+                # dry run to log the bytes the query will scan (e.g. whether partitions are pruned)
+                dry_run_config = deepcopy(job_config)
+                dry_run_config.dry_run = True
+                dry_run_config.use_query_cache = False
+                dry_run = self._bq.query(query, job_config=dry_run_config)
+                self._logging.debug(f'BigQuery query will process {dry_run.total_bytes_processed} bytes')
+            except Exception as e:
+                self._logging.warning(f'BigQuery dry run error: {e}')
+
         try:
-            self._logging.debug(f'Querying BigQuery with parameters {job_config.query_parameters}...')
+            self._logging.debug('Querying BigQuery with parameters %s...', Lazy(list, job_config.query_parameters))
             job = self._bq.query(query, job_config=job_config)
         except Exception as e:
             self._logging.error(f'BigQuery error: {e}')
@@ -112,7 +163,13 @@ class GcpModule:
                     df.set_index(kwargs['index_col'], inplace=True)
                 return df
             elif return_type.lower() == 'list':
-                return [{k: v for k, v in row.items()} for row in job.result()]
+                rows = job.result()
+                # built column-wise from Arrow instead of row by row (pyarrow < 7, as required by the BigQuery client, has no to_pylist)
+                columns = rows.to_arrow(create_bqstorage_client=rows.total_rows >= self.BQSTORAGE_MIN_ROWS).to_pydict()
+                return [dict(zip(columns.keys(), values)) for values in zip(*columns.values())]
+            elif return_type.lower() == 'arrow':
+                # downloads via the BigQuery Storage Read API
+                return job.to_arrow(create_bqstorage_client=True)
             else:
                 raise NotImplementedError(f'Return type "{return_type}" is not implemented')
         except NotImplementedError as e:
@@ -1,28 +1,168 @@
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+
 from ib_insync import IB, IBC
 
 from lib.gcp import logger as logging
+from lib.pacing import RequestPacer
+from lib.tracing import Tracer
 
 
 class IBGW(IB):
 
+    CONTRACT_DETAILS_CACHE_SIZE = 2048
+    CONTRACT_DETAILS_TTL = 6 * 60 * 60
     IB_CONFIG = {'host': '127.0.0.1', 'port': 4001, 'clientId': 1}
 
-    def __init__(self, ibc_config, ib_config=None, connection_timeout=60, timeout_sleep=5):
+    def __init__(self, ibc_config, ib_config=None, connection_timeout=60, timeout_sleep=5, pacer=None):
         super().__init__()
         ib_config = ib_config or {}
         self.ibc_config = ibc_config
         self.ib_config = {**self.IB_CONFIG, **ib_config}
         self.connection_timeout = connection_timeout
         self.timeout_sleep = timeout_sleep
+        self.pacer = pacer or RequestPacer()
+        self.cassette = None
 
         self.ibc = IBC(**self.ibc_config)
+        # contract details by contract, shared by everything running in the same gateway session
+        # (LRU, with entries expiring so that a persistent session picks up changes, e.g. expiries)
+        self._contract_details = OrderedDict()
+
+    def use_cassette(self, cassette):
+        """
+        Records IB traffic to or replays it from a cassette.
+
+        :param cassette: cassette (Cassette)
+        """
+        logging.info(f'Using IB cassette {cassette.path} in {cassette.mode} mode')
+        cassette.attach(self)
+        self.cassette = cassette
+
+    @property
+    def pacing_metrics(self):
+        return self.pacer.metrics
+
+    async def _pace(self, messages=1, **kwargs):
+        if (delay := self.pacer.reserve(messages, **kwargs)) > 0:
+            await asyncio.sleep(delay)
+
+    def _pace_sync(self, messages=1):
+        if (delay := self.pacer.reserve(messages)) > 0:
+            self.sleep(delay)
+
+    @Tracer.traced('ib.cancelOrder')
+    def cancelOrder(self, order):
+        self._pace_sync()
+        return super().cancelOrder(order)
+
+    @Tracer.traced('ib.placeOrder')
+    def placeOrder(self, contract, order):
+        self._pace_sync()
+        return super().placeOrder(contract, order)
+
+    @Tracer.traced('ib.reqContractDetails')
+    async def reqContractDetailsAsync(self, contract):
+        await self._pace()
+        return await super().reqContractDetailsAsync(contract)
+
+    @Tracer.traced('ib.reqExecutions')
+    async def reqExecutionsAsync(self, execFilter=None):
+        await self._pace()
+        return await super().reqExecutionsAsync(execFilter)
+
+    @Tracer.traced('ib.reqHistoricalData')
+    async def reqHistoricalDataAsync(self, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH, *args, **kwargs):
+        await self._pace(historical_key=(repr(contract), str(endDateTime), durationStr, barSizeSetting, whatToShow, useRTH),
+                         contract_key=(repr(contract), whatToShow))
+        return await super().reqHistoricalDataAsync(contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH, *args, **kwargs)
+
+    @Tracer.traced('ib.reqSecDefOptParams')
+    async def reqSecDefOptParamsAsync(self, underlyingSymbol, futFopExchange, underlyingSecType, underlyingConId):
+        await self._pace()
+        return await super().reqSecDefOptParamsAsync(underlyingSymbol, futFopExchange, underlyingSecType, underlyingConId)
+
+    @Tracer.traced('ib.reqTickers')
+    async def reqTickersAsync(self, *contracts, regulatorySnapshot=False):
+        # one snapshot request per contract
+        await self._pace(len(contracts))
+        return await super().reqTickersAsync(*contracts, regulatorySnapshot=regulatorySnapshot)
+
+    @Tracer.traced('ib.whatIfOrder')
+    async def whatIfOrderAsync(self, contract, order):
+        await self._pace()
+        return await super().whatIfOrderAsync(contract, order)
+
+    def request_batch(self, method, requests):
+        """
+        Submits a batch of requests concurrently at the maximum rate the pacing rules allow.
+
+        :param method: name of the request method, e.g. 'reqHistoricalData' (str)
+        :param requests: arguments of each request (list of tuple or dict)
+        :return: results in the order of the requests (list)
+        """
+        coroutine = getattr(self, f'{method}Async')
+        return self._run(asyncio.gather(*[coroutine(**r) if isinstance(r, dict) else coroutine(*r) for r in requests]))
+
+    @Tracer.traced('ib.reqCurrentTime')
+    def reqCurrentTime(self):
+        return super().reqCurrentTime()
+
+    def _get_cached_contract_details(self, key):
+        if (entry := self._contract_details.get(key)) is None:
+            return None
+        if entry[0] < monotonic():
+            del self._contract_details[key]
+            return None
+        self._contract_details.move_to_end(key)
+        return entry[1]
+
+    def _cache_contract_details(self, key, contract_details):
+        self._contract_details[key] = (monotonic() + self.CONTRACT_DETAILS_TTL, contract_details)
+        self._contract_details.move_to_end(key)
+        while len(self._contract_details) > self.CONTRACT_DETAILS_CACHE_SIZE:
+            self._contract_details.popitem(last=False)
+
+    def reqContractDetails(self, contract):
+        """
+        Requests contract details from IB, cached for the gateway session.
+
+        :param contract: contract (ib_insync Contract object)
+        :return: contract details (list of ib_insync ContractDetails objects)
+        """
+        key = repr(contract)
+        if (contract_details := self._get_cached_contract_details(key)) is None:
+            if not len(contract_details := super().reqContractDetails(contract)):
+                return contract_details
+            self._cache_contract_details(key, contract_details)
+        return contract_details
+
+    def reqContractDetailsBatch(self, contracts):
+        """
+        Requests contract details of many contracts concurrently, cached like reqContractDetails.
+
+        :param contracts: contracts (list of ib_insync Contract objects)
+        :return: contract details of each contract (list of lists of ib_insync ContractDetails objects)
+        """
+        keys = [repr(c) for c in contracts]
+        result = {k: contract_details for k in keys if (contract_details := self._get_cached_contract_details(k)) is not None}
+        missing = {k: c for k, c in zip(keys, contracts) if k not in result}
+        if len(missing):
+            for k, contract_details in zip(missing.keys(), self.request_batch('reqContractDetails', [(c,) for c in missing.values()])):
+                if len(contract_details):
+                    self._cache_contract_details(k, contract_details)
+                    result[k] = contract_details
+        return [result.get(k, []) for k in keys]
 
+    @Tracer.traced('ib.startAndConnect')
     def start_and_connect(self):
         """
         Starts the IB gateway with IBC and connects to it.
         """
 
         logging.info('Starting IBC...')
+        self._contract_details = OrderedDict()
         self.ibc.start()
         wait = self.connection_timeout
 
@@ -50,6 +190,7 @@ class IBGW(IB):
                 logging.warning(f"{self.ibc_config['twsPath']}/launcher.log not found")
             raise e
 
+    @Tracer.traced('ib.stopAndTerminate')
     def stop_and_terminate(self, wait=0):
         """
         Closes the connection with the IB gateway and terminates it.
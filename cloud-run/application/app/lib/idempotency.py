@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+
+from lib.environment import Environment
+
+
+class IdempotencyKeys:
+    """
+    Idempotency-key store backed by Firestore (document ID = key) with an in-process
+    LRU cache in front of it, so that checking a key is a single document get at most.
+    The cache is keyed by trading mode and key, as paper and live runs may share a process.
+
+    Documents carry an 'expireAt' field which a Firestore TTL policy on the collection
+    group 'keys' can use to clean them up.
+    """
+
+    COLLECTION = 'idempotency/{}/keys'
+    LRU_SIZE = 256
+    # shared by the whole process (e.g. request and background threads)
+    _cache = OrderedDict()
+    _lock = Lock()
+
+    def __init__(self):
+        self._env = Environment()
+
+    def _collection(self):
+        return self._env.db.collection(self.COLLECTION.format(self._env.trading_mode))
+
+    def _cache_key(self, key):
+        return self._env.trading_mode, key
+
+    def _remember(self, key, timestamp):
+        cache_key = self._cache_key(key)
+        with self._lock:
+            self._cache[cache_key] = timestamp
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self.LRU_SIZE:
+                self._cache.popitem(last=False)
+
+    def add(self, key, minutes, **kwargs):
+        """
+        Stores an idempotency key.
+
+        :param key: idempotency key, e.g. intent signature (str)
+        :param minutes: validity of the key in minutes (int)
+        :param kwargs: additional fields to store with the key
+        """
+        timestamp = datetime.now(timezone.utc)
+        self._collection().document(key).set({
+            **kwargs,
+            'expireAt': timestamp + timedelta(minutes=minutes),
+            'timestamp': timestamp
+        })
+        self._remember(key, timestamp)
+
+    def exists(self, key, minutes):
+        """
+        Checks whether an idempotency key has been stored within the last minutes.
+
+        :param key: idempotency key, e.g. intent signature (str)
+        :param minutes: look-back period in minutes (int)
+        :return: whether the key exists (bool)
+        """
+        cutoff = datetime.now(timezone.utc) - timedelta(minutes=minutes)
+        cache_key = self._cache_key(key)
+        with self._lock:
+            if (cached := self._cache.get(cache_key)) is not None:
+                self._cache.move_to_end(cache_key)
+        if cached is not None and cached > cutoff:
+            return True
+
+        doc = self._collection().document(key).get()
+        if doc.exists and (timestamp := doc.to_dict().get('timestamp')) is not None:
+            self._remember(key, timestamp)
+            return timestamp > cutoff
+        return False
@@ -0,0 +1,144 @@
+import atexit
+from functools import lru_cache
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+from queue import Queue
+from threading import Lock
+from time import monotonic
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Lazy:
+    """
+    Defers building an expensive log payload until the record is actually formatted,
+    e.g. logger.debug('Fills: %s', Lazy(lambda: {...})). The payload is built on the
+    listener thread, so it must not depend on state that changes in the meantime.
+    """
+
+    __slots__ = ('_func', '_args')
+
+    def __init__(self, func, *args):
+        self._func = func
+        self._args = args
+
+    def __str__(self):
+        return str(self._func(*self._args))
+
+
+@lru_cache(maxsize=None)
+def module_name(pathname):
+    """
+    Derives the dotted module name of a source file within the app, e.g. 'lib.trading'.
+
+    :param pathname: source file path (str)
+    :return: module name (str)
+    """
+    return os.path.splitext(os.path.relpath(pathname, APP_ROOT))[0].replace(os.sep, '.')
+
+
+class ModuleLevelFilter(logging.Filter):
+    """
+    Applies log levels per module (or package), the most specific prefix winning.
+    """
+
+    def __init__(self, default_level=logging.DEBUG, levels=None):
+        super().__init__()
+        self._default_level = default_level
+        # longest prefixes first
+        self._levels = sorted((levels or {}).items(), key=lambda kv: -len(kv[0]))
+
+    @classmethod
+    def parse_levels(cls, spec):
+        """
+        Parses a level specification like 'lib.trading=INFO,intents=WARNING'.
+
+        :param spec: level specification (str)
+        :return: levels by module prefix (dict)
+        """
+        levels = {}
+        for item in filter(None, (spec or '').split(',')):
+            module, level = item.split('=')
+            levels[module.strip()] = logging.getLevelName(level.strip().upper())
+        return levels
+
+    @property
+    def min_level(self):
+        return min([self._default_level] + [level for _, level in self._levels])
+
+    def filter(self, record):
+        module = module_name(record.pathname)
+        for prefix, level in self._levels:
+            if module == prefix or module.startswith(f'{prefix}.'):
+                return record.levelno >= level
+        return record.levelno >= self._default_level
+
+
+class DebugSamplingFilter(logging.Filter):
+    """
+    Samples repetitive debug records: per call site, the first records within a window
+    pass and after that only every n-th one.
+    """
+
+    BURST = 10
+    EVERY = 100
+    WINDOW = 60
+
+    def __init__(self, burst=BURST, every=EVERY, window=WINDOW, clock=monotonic):
+        super().__init__()
+        self._burst = burst
+        self._every = every
+        self._window = window
+        self._clock = clock
+        self._counts = {}
+        self._window_start = clock()
+        self._lock = Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        with self._lock:
+            if (now := self._clock()) - self._window_start > self._window:
+                self._counts, self._window_start = {}, now
+            count = self._counts[(record.pathname, record.lineno)] = self._counts.get((record.pathname, record.lineno), 0) + 1
+        return count <= self._burst or not count % self._every
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queue handler that leaves formatting to the listener thread instead of formatting
+    the record on the logging thread.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logger(name, handler, default_level=logging.DEBUG, levels=None):
+    """
+    Sets up a logger that only queues records on the calling thread. Filtering by level
+    and sampling happen before queueing, formatting and shipping on a listener thread.
+
+    :param name: logger name (str)
+    :param handler: handler shipping the records (logging.Handler)
+    :param default_level: default log level (int)
+    :param levels: log levels by module prefix (dict)
+    :return: logger (logging.Logger), listener (QueueListener)
+    """
+    level_filter = ModuleLevelFilter(default_level, levels)
+    queue_handler = DeferredQueueHandler(Queue(-1))
+    queue_handler.addFilter(level_filter)
+    queue_handler.addFilter(DebugSamplingFilter())
+
+    logger = logging.getLogger(name)
+    logger.addHandler(queue_handler)
+    # lets logger.isEnabledFor and the level check in logger.debug etc. skip disabled records early
+    logger.setLevel(level_filter.min_level)
+    logger.propagate = False
+
+    listener = QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+    listener.start()
+    # ship what is left in the queue on shutdown
+    atexit.register(listener.stop)
+    return logger, listener
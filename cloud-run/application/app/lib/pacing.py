@@ -0,0 +1,95 @@
+from bisect import insort
+from collections import deque
+from time import monotonic
+
+
+class RequestPacer:
+    """
+    Pacing of IB API requests. A token bucket limits the general message rate and the
+    historical data pacing rules are tracked separately:
+    https://interactivebrokers.github.io/tws-api/historical_limitations.html#pacing_violations
+
+    Requests reserve a slot and get the delay after which they may be sent, so that
+    excess requests queue up instead of triggering pacing violations.
+    """
+
+    # stay below ib_insync's own throttle (45 requests per second) so that it never kicks in
+    MESSAGE_RATE = 40
+    MESSAGE_BURST = 40
+    HISTORICAL_CONTRACT_REQUESTS = 5
+    HISTORICAL_CONTRACT_WINDOW = 2
+    HISTORICAL_IDENTICAL_WINDOW = 15
+    HISTORICAL_REQUESTS = 60
+    HISTORICAL_WINDOW = 600
+
+    def __init__(self, rate=MESSAGE_RATE, burst=MESSAGE_BURST, clock=monotonic):
+        self._rate = rate
+        self._burst = burst
+        self._clock = clock
+        self._tokens = burst
+        self._updated = clock()
+        self._historical = []
+        self._historical_contract = {}
+        self._historical_identical = {}
+        self._metrics = {'requests': 0, 'queued': 0, 'queuedSeconds': 0., 'maxQueuedSeconds': 0.}
+
+    @property
+    def metrics(self):
+        return {**self._metrics}
+
+    def _reserve_historical(self, start, now, historical_key, contract_key):
+        """
+        Applies the historical data pacing rules to a request.
+
+        :param start: earliest send time according to the message rate (float)
+        :param now: current time (float)
+        :param historical_key: identifies identical requests (hashable)
+        :param contract_key: identifies requests for the same contract, exchange and tick type (hashable)
+        :return: earliest send time (float)
+        """
+        # no more than 60 requests within any 10 minute period
+        self._historical = [t for t in self._historical if t > now - self.HISTORICAL_WINDOW]
+        if len(self._historical) >= self.HISTORICAL_REQUESTS:
+            start = max(start, self._historical[-self.HISTORICAL_REQUESTS] + self.HISTORICAL_WINDOW)
+        # no identical requests within 15 seconds
+        if historical_key in self._historical_identical:
+            start = max(start, self._historical_identical[historical_key] + self.HISTORICAL_IDENTICAL_WINDOW)
+        # no six or more requests for the same contract, exchange and tick type within two seconds
+        contract_times = self._historical_contract.setdefault(contract_key, deque(maxlen=self.HISTORICAL_CONTRACT_REQUESTS))
+        if len(contract_times) == self.HISTORICAL_CONTRACT_REQUESTS:
+            start = max(start, contract_times[0] + self.HISTORICAL_CONTRACT_WINDOW)
+
+        insort(self._historical, start)
+        self._historical_identical = {
+            k: v for k, v in self._historical_identical.items() if v > now - self.HISTORICAL_IDENTICAL_WINDOW
+        }
+        self._historical_identical[historical_key] = start
+        contract_times.append(start)
+        return start
+
+    def reserve(self, messages=1, historical_key=None, contract_key=None):
+        """
+        Reserves a slot for a request.
+
+        :param messages: number of API messages the request sends (int)
+        :param historical_key: identifies identical historical data requests, if any (hashable)
+        :param contract_key: identifies historical data requests for the same contract, exchange and tick type (hashable)
+        :return: delay in seconds before the request may be sent (float)
+        """
+        now = self._clock()
+        # refill, a negative balance represents requests reserved for the future
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        start = now + max(0., (messages - self._tokens) / self._rate)
+        self._tokens -= messages
+
+        if historical_key is not None:
+            start = self._reserve_historical(start, now, historical_key, contract_key)
+
+        delay = start - now
+        self._metrics['requests'] += 1
+        if delay > 0:
+            self._metrics['queued'] += 1
+            self._metrics['queuedSeconds'] += delay
+            self._metrics['maxQueuedSeconds'] = max(self._metrics['maxQueuedSeconds'], delay)
+        return delay
@@ -0,0 +1,115 @@
+from collections import Counter
+import sys
+from threading import Event, Thread, get_ident
+from time import perf_counter
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler that periodically samples the call stack of a thread from a
+    background thread. Stacks are aggregated in collapsed format ('frame;frame;... count'),
+    which flamegraph tools read directly. Nothing is hooked into the profiled code, so
+    there is no overhead unless the profiler is running.
+    """
+
+    INTERVAL = 0.005
+    # keeps a stored profile well below Firestore's 1 MiB document limit
+    MAX_BYTES = 512 * 1024
+    MAX_STACKS = 1000
+
+    def __init__(self, interval=INTERVAL, thread_id=None):
+        self._interval = interval
+        self._thread_id = thread_id
+        self._stacks = Counter()
+        self._samples = 0
+        self._seconds = 0.
+        self._stop = Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    @property
+    def samples(self):
+        return self._samples
+
+    @property
+    def seconds(self):
+        return self._seconds
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f"{frame.f_globals.get('__name__', code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.sample()
+
+    def sample(self):
+        """
+        Takes one sample of the profiled thread's call stack.
+        """
+        if (frame := sys._current_frames().get(self._thread_id)) is None:
+            return
+        stack = []
+        while frame is not None:
+            stack.append(self._frame_name(frame))
+            frame = frame.f_back
+        self._stacks[';'.join(reversed(stack))] += 1
+        self._samples += 1
+
+    def start(self):
+        """
+        Starts sampling the given thread (by default the calling thread).
+        """
+        self._thread_id = self._thread_id or get_ident()
+        self._stop.clear()
+        self._seconds = perf_counter()
+        self._thread = Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self._seconds = perf_counter() - self._seconds
+
+    def collapsed(self, max_stacks=MAX_STACKS, max_bytes=MAX_BYTES):
+        """
+        Exports the samples as collapsed stacks, most frequent first, truncated to a
+        maximum number of stacks and size.
+
+        :param max_stacks: maximum number of distinct stacks (int)
+        :param max_bytes: maximum size in bytes (int)
+        :return: collapsed stacks (str)
+        """
+        lines, size = [], 0
+        for stack, count in self._stacks.most_common(max_stacks):
+            line = f'{stack} {count}'
+            if (size := size + len(line.encode()) + 1) > max_bytes:
+                break
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        """
+        Summarises the profile for the activity log.
+
+        :return: profile (dict)
+        """
+        return {
+            'interval': self._interval,
+            'samples': self._samples,
+            'seconds': round(self._seconds, 3),
+            'stacks': len(self._stacks),
+            'collapsed': self.collapsed()
+        }
@@ -0,0 +1,94 @@
+import numpy as np
+
+
+class SizingEngine:
+    """
+    Array-backed position sizing. Signals, prices, multipliers, FX rates and positions
+    are held as NumPy vectors aligned to a fixed order of contract IDs, so that target
+    positions, trades and the consolidation over strategies are a few vector operations
+    regardless of the number of contracts. The calculations broadcast, i.e. they also
+    work on matrices with one row per point in time.
+    """
+
+    def __init__(self, contract_ids):
+        self._contract_ids = list(dict.fromkeys(contract_ids))
+        self._index = {k: i for i, k in enumerate(self._contract_ids)}
+
+    def __len__(self):
+        return len(self._contract_ids)
+
+    @property
+    def contract_ids(self):
+        return self._contract_ids
+
+    @property
+    def index(self):
+        return self._index
+
+    @classmethod
+    def consolidate(cls, trades):
+        """
+        Aligns the trades of several strategies in a matrix (strategies x contracts).
+
+        :param trades: trades per strategy (list of dict)
+        :return: sizing engine for the union of contracts, trade matrix (tuple)
+        """
+        engine = cls(k for t in trades for k in t.keys())
+        matrix = np.zeros((len(trades), len(engine)))
+        for i, t in enumerate(trades):
+            matrix[i, [engine.index[k] for k in t.keys()]] = [*t.values()]
+        return engine, matrix
+
+    @staticmethod
+    def target_positions(exposure, signals, prices, multipliers, fx):
+        """
+        Converts signals into target positions (number of contracts).
+
+        :param exposure: exposure in base currency (float)
+        :param signals: signals (np.ndarray)
+        :param prices: prices in contract currency (np.ndarray)
+        :param multipliers: contract multipliers (np.ndarray)
+        :param fx: FX rates contract currency to base currency (np.ndarray)
+        :return: target positions (np.ndarray)
+        """
+        signals = np.asarray(signals, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            positions = np.round(exposure * signals / (np.asarray(prices) * np.asarray(multipliers) * np.asarray(fx)))
+        # no price data needed for contracts without signal
+        return np.where(signals != 0, positions, 0)
+
+    @staticmethod
+    def trades(target_positions, holdings):
+        """
+        Converts target positions into trades (subtract current holdings).
+
+        :param target_positions: target positions (np.ndarray)
+        :param holdings: current holdings (np.ndarray)
+        :return: trades (np.ndarray)
+        """
+        return np.asarray(target_positions) - np.asarray(holdings)
+
+    def to_dict(self, vector, nonzero=False):
+        """
+        Exports a vector of contract quantities as dict keyed by contract ID.
+
+        :param vector: quantities aligned to the contract IDs (np.ndarray)
+        :param nonzero: only export non-zero quantities (bool)
+        :return: quantities (dict)
+        """
+        if not np.isfinite(vector).all():
+            # e.g. missing prices - never let these end up as (arbitrary) order quantities
+            raise ValueError('Cannot export non-finite quantities')
+        quantities = np.asarray(vector).astype(np.int64)
+        keys = np.flatnonzero(quantities) if nonzero else range(len(self._contract_ids))
+        return {self._contract_ids[i]: quantities[i].item() for i in keys}
+
+    def vector(self, values, default=0):
+        """
+        Builds a vector aligned to the contract IDs from a dict.
+
+        :param values: values keyed by contract ID (dict)
+        :param default: value for contracts not in values (float)
+        :return: vector (np.ndarray)
+        """
+        return np.fromiter((values.get(k, default) for k in self._contract_ids), dtype=float, count=len(self._contract_ids))
@@ -0,0 +1,160 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from inspect import iscoroutinefunction
+from threading import Lock, local
+from time import perf_counter
+
+
+class Span:
+    """
+    Timing of a single call.
+    """
+
+    __slots__ = ('name', 'seconds', 'size', 'error')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.
+        self.size = None
+        self.error = False
+
+
+class Tracer:
+    """
+    Lightweight instrumentation of calls to IB, Firestore and BigQuery. Spans are
+    aggregated per intent for the activity log and into process-wide latency
+    histograms that are exposed in Prometheus text format.
+    """
+
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+    METRIC = 'ib_trading_call_duration_seconds'
+    _histograms = {}
+    _lock = Lock()
+    _local = local()
+
+    @classmethod
+    def begin(cls, intent):
+        """
+        Starts collecting the spans of an intent (in the current thread).
+
+        :param intent: intent name (str)
+        """
+        cls._local.intent = intent
+        cls._local.spans = {}
+
+    @classmethod
+    def end(cls):
+        """
+        Stops collecting spans and summarises them.
+
+        :return: span summary by call (dict)
+        """
+        spans = getattr(cls._local, 'spans', {})
+        cls._local.intent, cls._local.spans = None, {}
+        return {
+            name: {**summary, 'seconds': round(summary['seconds'], 3), 'maxSeconds': round(summary['maxSeconds'], 3)}
+            for name, summary in sorted(spans.items())
+        }
+
+    @classmethod
+    def _record(cls, span):
+        """
+        Adds a finished span to the intent summary and the histograms.
+
+        :param span: finished span (Span)
+        """
+        intent = getattr(cls._local, 'intent', None)
+        if (spans := getattr(cls._local, 'spans', None)) is not None and intent is not None:
+            summary = spans.setdefault(span.name, {'count': 0, 'errors': 0, 'seconds': 0., 'maxSeconds': 0., 'size': 0})
+            summary['count'] += 1
+            summary['errors'] += span.error
+            summary['seconds'] += span.seconds
+            summary['maxSeconds'] = max(summary['maxSeconds'], span.seconds)
+            summary['size'] += span.size or 0
+
+        with cls._lock:
+            histogram = cls._histograms.setdefault((span.name, intent or ''), [[0] * len(cls.BUCKETS), 0., 0])
+            if (i := bisect_left(cls.BUCKETS, span.seconds)) < len(cls.BUCKETS):
+                histogram[0][i] += 1
+            histogram[1] += span.seconds
+            histogram[2] += 1
+
+    @classmethod
+    @contextmanager
+    def span(cls, name):
+        """
+        Times a block of code. The size of the payload can be set on the yielded span.
+
+        :param name: call name, e.g. 'ib.reqTickers' (str)
+        :return: span (Span)
+        """
+        span = Span(name)
+        start = perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.error = True
+            raise e
+        finally:
+            span.seconds = perf_counter() - start
+            cls._record(span)
+
+    @classmethod
+    def traced(cls, name):
+        """
+        Decorator that times each call of a function or coroutine function, using the
+        length of the result as payload size.
+
+        :param name: call name (str)
+        :return: decorator
+        """
+        def size(result):
+            try:
+                return len(result)
+            except TypeError:
+                return None
+
+        def decorator(func):
+            if iscoroutinefunction(func):
+                @wraps(func)
+                async def wrapper(*args, **kwargs):
+                    with cls.span(name) as span:
+                        result = await func(*args, **kwargs)
+                        span.size = size(result)
+                        return result
+            else:
+                @wraps(func)
+                def wrapper(*args, **kwargs):
+                    with cls.span(name) as span:
+                        result = func(*args, **kwargs)
+                        span.size = size(result)
+                        return result
+            return wrapper
+        return decorator
+
+    @classmethod
+    def prometheus(cls):
+        """
+        Renders the latency histograms in Prometheus text exposition format.
+
+        :return: metrics (str)
+        """
+        lines = [
+            f'# HELP {cls.METRIC} Duration of calls to IB, Firestore and BigQuery.',
+            f'# TYPE {cls.METRIC} histogram'
+        ]
+        with cls._lock:
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in cls._histograms.items()}
+        for (name, intent), (buckets, total, count) in sorted(histograms.items()):
+            labels = f'call="{name}",intent="{intent}"'
+            cumulative = 0
+            for bound, n in zip(cls.BUCKETS, buckets):
+                cumulative += n
+                lines.append(f'{cls.METRIC}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines += [
+                f'{cls.METRIC}_bucket{{{labels},le="+Inf"}} {count}',
+                f'{cls.METRIC}_sum{{{labels}}} {total}',
+                f'{cls.METRIC}_count{{{labels}}} {count}'
+            ]
+        return '\n'.join(lines) + '\n'
@@ -1,24 +1,67 @@
 from abc import ABC
 from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
 import ib_insync
 from google.cloud.firestore_v1 import DELETE_FIELD
+import numpy as np
 
 from lib.environment import Environment
 from lib.gcp import GcpModule
+from lib.sizing import SizingEngine
+from lib.tracing import Tracer
+
+
+class InstrumentRecord:
+    """
+    Compact record of a resolved instrument.
+    """
+
+    __slots__ = ('con_id', 'local_symbol', 'multiplier', 'currency', 'min_tick', 'expiry')
+
+    def __init__(self, con_id, local_symbol, multiplier=1, currency=None, min_tick=None, expiry=None):
+        self.con_id = con_id
+        self.local_symbol = local_symbol
+        self.multiplier = multiplier
+        self.currency = currency
+        self.min_tick = min_tick
+        self.expiry = expiry
+
+    def __eq__(self, other):
+        return isinstance(other, InstrumentRecord) and all(getattr(self, a) == getattr(other, a) for a in self.__slots__)
+
+    def __repr__(self):
+        return f"InstrumentRecord({', '.join(f'{a}={getattr(self, a)!r}' for a in self.__slots__)})"
+
+    @classmethod
+    def from_contract_details(cls, contract_details):
+        """
+        Creates a record from IB contract details.
+
+        :param contract_details: contract details (ib_insync ContractDetails object)
+        :return: instrument record (InstrumentRecord)
+        """
+        contract = contract_details.contract
+        return cls(con_id=contract.conId,
+                   local_symbol=contract.localSymbol,
+                   multiplier=int(contract.multiplier or 1),
+                   currency=contract.currency,
+                   min_tick=contract_details.minTick or None,
+                   expiry=contract.lastTradeDateOrContractMonth or None)
 
 
 class Instrument(ABC):
+    """
+    Instrument resolved from IB. Instances are slotted and only hold the qualified
+    contract and its compact record; the full contract details are loaded on request.
+    """
 
+    __slots__ = ('_contract', '_details', '_env', '_record', '_tickers')
     IB_CLS = None
-    _contract = None
-    _details = None
-    _local_symbol = None
-    _tickers = None
 
     def __init__(self, get_tickers=False, **kwargs):
-        self._ib_contract = self.IB_CLS(**kwargs)
+        self._contract = self._details = self._record = self._tickers = None
         self._env = Environment()
-        self.get_contract_details()
+        self.get_contract_details(self.IB_CLS(**kwargs))
         if get_tickers:
             self.get_tickers()
 
@@ -32,7 +75,11 @@ class Instrument(ABC):
 
     @property
     def local_symbol(self):
-        return self._local_symbol
+        return self._record.local_symbol if self._record is not None else None
+
+    @property
+    def record(self):
+        return self._record
 
     @property
     def tickers(self):
@@ -41,72 +88,309 @@ class Instrument(ABC):
     def as_instrumentset(self):
         return InstrumentSet(self)
 
-    def get_contract_details(self):
+    @classmethod
+    def from_contract_details(cls, contract_details):
+        """
+        Creates an instrument from contract details requested already (e.g. in a batch),
+        without requesting them again.
+
+        :param contract_details: contract details (ib_insync ContractDetails object)
+        :return: instrument (Instrument)
+        """
+        instrument = cls.__new__(cls)
+        # nothing is requested yet, so the environment is only created on request (e.g. not in offline backtests)
+        instrument._details = instrument._env = instrument._tickers = None
+        instrument._set_contract_details(contract_details)
+        return instrument
+
+    def _environment(self):
+        if self._env is None:
+            self._env = Environment()
+        return self._env
+
+    def _set_contract_details(self, contract_details):
+        self._contract = contract_details.contract
+        self._record = InstrumentRecord.from_contract_details(contract_details)
+
+    def get_contract_details(self, contract=None):
         """
         Requests contract details from IB.
+
+        :param contract: contract to resolve, defaults to the instrument's contract (ib_insync Contract object)
+        """
+        if len(contract_details := self._environment().ibgw.reqContractDetails(contract or self._contract)):
+            self._set_contract_details(contract_details[0])
+
+    def get_details(self):
         """
-        if len(contract_details := self._env.ibgw.reqContractDetails(self._ib_contract)):
-            contract_details = contract_details[0].nonDefaults()
-            self._contract = contract_details.pop('contract')
-            self._local_symbol = self._contract.localSymbol
-            self._details = contract_details
+        Requests the full contract details (e.g. trading hours) from IB, which aren't
+        kept by default to keep instances small.
+        """
+        if self._contract is not None and len(contract_details := self._environment().ibgw.reqContractDetails(self._contract)):
+            self._details = {k: v for k, v in contract_details[0].nonDefaults().items() if k != 'contract'}
 
     def get_tickers(self):
         """
         Requests price data for contract from IB.
         """
-        self._env.logging.info(f'Requesting tick data for {self._local_symbol}...')
-        if len(tickers := self._env.ibgw.reqTickers(self._contract)):
+        env = self._environment()
+        env.logging.info('Requesting tick data for %s...', self.local_symbol)
+        if len(tickers := env.ibgw.reqTickers(self._contract)):
             self._tickers = tickers[0]
 
 
 class Contract(Instrument):
 
+    __slots__ = ()
     IB_CLS = ib_insync.Contract
 
 
 class Forex(Instrument):
 
+    __slots__ = ()
     IB_CLS = ib_insync.Forex
 
 
+class FutureSpec:
+    """
+    Contract specification of a futures root, with the roll calendar derived from it.
+    """
+
+    __slots__ = ('root', 'exchange', 'currency', 'expiry_months', 'expiry_month_offset', 'roll_offset')
+    MONTH_CODES = 'FGHJKMNQUVXZ'
+
+    def __init__(self, root, exchange, currency, expiry_months, expiry_month_offset=0, roll_offset=1):
+        self.root = root
+        self.exchange = exchange
+        self.currency = currency
+        self.expiry_months = expiry_months
+        self.expiry_month_offset = expiry_month_offset
+        self.roll_offset = roll_offset
+
+    def __eq__(self, other):
+        return isinstance(other, FutureSpec) and all(getattr(self, a) == getattr(other, a) for a in self.__slots__)
+
+    def __repr__(self):
+        return f"FutureSpec({', '.join(f'{a}={getattr(self, a)!r}' for a in self.__slots__)})"
+
+    @classmethod
+    def from_dict(cls, root, spec, expiry_schemes):
+        """
+        Creates a spec from its config entry, e.g. {'exchange': 'GLOBEX', 'currency': 'USD',
+        'expiryScheme': 'q', 'rollOffset': 1}. The expiry scheme is either the name of a
+        scheme or the month codes themselves (e.g. 'HMUZ'). expiryMonthOffset is the
+        month of the last trading day relative to the contract month (e.g. -1 for CL).
+
+        :param root: root symbol (str)
+        :param spec: spec (dict)
+        :param expiry_schemes: month codes by scheme name (dict)
+        :return: futures spec (FutureSpec)
+        """
+        month_codes = expiry_schemes.get(spec['expiryScheme'], spec['expiryScheme'])
+        return cls(root=root,
+                   exchange=spec['exchange'],
+                   currency=spec['currency'],
+                   expiry_months=sorted(cls.MONTH_CODES.index(c) + 1 for c in month_codes),
+                   expiry_month_offset=spec.get('expiryMonthOffset', 0),
+                   roll_offset=spec.get('rollOffset', 1))
+
+    def roll_calendar(self, n, roll_date):
+        """
+        Lists the local symbols of the contracts that can still be live at the roll date,
+        i.e. the first contract month whose last trading day may fall into the month of the
+        roll date, plus the n following ones (the first may have expired already).
+
+        :param n: number of contracts needed (int)
+        :param roll_date: date the contracts must not expire before (datetime)
+        :return: local symbols in order of expiry (list of str)
+        """
+        # contract month of which the last trading day falls into the month of the roll date
+        year, month = divmod(roll_date.year * 12 + roll_date.month - 1 - self.expiry_month_offset, 12)
+        month += 1
+        symbols = []
+        while len(symbols) < n + 1:
+            if month in self.expiry_months:
+                symbols.append(f'{self.root}{self.MONTH_CODES[month - 1]}{str(year)[-1]}')
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return symbols
+
+
 class Future(Instrument):
 
+    __slots__ = ()
+    # defaults, extended/overridden by the futuresSpecs config
     CONTRACT_SPECS = {
         'MNQ': {
             'currency': 'USD',
             'exchange': 'GLOBEX',
-            'expiry_scheme': 'q'
+            'expiryScheme': 'q'
         }
     }
     IB_CLS = ib_insync.Future
     EXPIRY_SCHEMES = {
-        'm': ['F', 'G', 'H', 'J', 'K', 'M', 'N', 'Q', 'U', 'V', 'X', 'Z'],
-        'q': ['H', 'M', 'U', 'Z']
+        'm': FutureSpec.MONTH_CODES,
+        'q': 'HMUZ'
     }
 
     @classmethod
-    def get_contract_series(cls, n, ticker, rollover_days_before_expiry=1):
+    def get_spec(cls, root):
+        """
+        Gets the contract specification of a futures root from the registry.
+
+        :param root: root symbol (str)
+        :return: futures spec (FutureSpec)
+        """
+        specs = {**cls.CONTRACT_SPECS, **Environment().config.get('futuresSpecs', {})}
+        if root not in specs:
+            raise KeyError(f'No futures spec for {root}')
+        return FutureSpec.from_dict(root, specs[root], cls.EXPIRY_SCHEMES)
+
+    @classmethod
+    def get_contract_series(cls, n, ticker, rollover_days_before_expiry=None):
+        """
+        Gets the next n contracts of a futures root that don't expire before the roll date.
+
+        :param n: number of contracts (int)
+        :param ticker: root symbol (str)
+        :param rollover_days_before_expiry: roll offset in days, defaults to the one of the spec (int)
+        :return: contracts in order of expiry (InstrumentSet)
+        """
         logging = GcpModule.get_logger()
 
-        contract_years = [str(datetime.now().year + i)[-1] for i in range(2)]
-        contract_symbols = [ticker + m + y for y in contract_years for m in cls.EXPIRY_SCHEMES[cls.CONTRACT_SPECS[ticker]['expiry_scheme']]]
+        spec = cls.get_spec(ticker)
+        roll_offset = spec.roll_offset if rollover_days_before_expiry is None else rollover_days_before_expiry
+        roll_date = datetime.now() + timedelta(days=roll_offset)
+        contract_symbols = spec.roll_calendar(n, roll_date)
 
         logging.info(f"Requesting contract for {', '.join(contract_symbols)}...")
-        contracts = InstrumentSet(*[f for f in [cls(localSymbol=s,
-                                                    exchange=cls.CONTRACT_SPECS[ticker]['exchange'],
-                                                    currency=cls.CONTRACT_SPECS[ticker]['currency'])
+        contracts = InstrumentSet(*[f for f in [cls(localSymbol=s, exchange=spec.exchange, currency=spec.currency)
                                                 for s in contract_symbols]
-                                    if f.contract is not None and f.contract.lastTradeDateOrContractMonth > (datetime.now() + timedelta(days=rollover_days_before_expiry)).strftime('%Y%m%d')])
+                                    if f.contract is not None and f.contract.lastTradeDateOrContractMonth > roll_date.strftime('%Y%m%d')])
         return contracts[:n]
 
 
 class Index(Instrument):
 
+    __slots__ = ()
     IB_CLS = ib_insync.Index
 
 
+class Option(Instrument):
+
+    __slots__ = ()
+    IB_CLS = ib_insync.Option
+
+    @property
+    def greeks(self):
+        return self._tickers.modelGreeks if self._tickers is not None else None
+
+
+class FuturesOption(Option):
+
+    __slots__ = ()
+    IB_CLS = ib_insync.FuturesOption
+
+
+class OptionChain:
+    """
+    Option chain of an underlying, resolved in bulk: the expiry/strike grid comes from a
+    single reqSecDefOptParams request, the contract details of the grid are requested
+    concurrently and tickers (with greeks) of the options in a single batch.
+    """
+
+    MAX_CONTRACTS = 1000
+
+    def __init__(self, underlying, exchange=None, trading_class=None):
+        """
+        :param underlying: underlying (Instrument)
+        :param exchange: option exchange, one chain per trading class and multiplier (SMART if listed) if None (str)
+        :param trading_class: option trading class, all if None (str)
+        """
+        self._env = Environment()
+        self._underlying = underlying
+        contract = underlying.contract
+        is_future = contract.secType == 'FUT'
+        self._option_cls = FuturesOption if is_future else Option
+
+        chains = self._env.ibgw.reqSecDefOptParams(contract.symbol, contract.exchange if is_future else '', contract.secType, contract.conId)
+        self._chains = [
+            c for c in chains
+            if (exchange is None or c.exchange == exchange)
+            and (trading_class is None or c.tradingClass == trading_class)
+            # futures options of other contract months are returned too
+            and (not is_future or c.underlyingConId == contract.conId)
+        ]
+        if exchange is None:
+            # the same grid is listed for every exchange
+            unique = {}
+            for c in sorted(self._chains, key=lambda c: c.exchange != 'SMART'):
+                unique.setdefault((c.tradingClass, c.multiplier), c)
+            self._chains = list(unique.values())
+
+    @property
+    def expirations(self):
+        return sorted({e for c in self._chains for e in c.expirations})
+
+    @property
+    def strikes(self):
+        return sorted({k for c in self._chains for k in c.strikes})
+
+    def strikes_around(self, price, n):
+        """
+        Selects the strikes closest to a price.
+
+        :param price: price, e.g. of the underlying (float)
+        :param n: number of strikes (int)
+        :return: strikes in ascending order (list of float)
+        """
+        return sorted(sorted(self.strikes, key=lambda k: abs(k - price))[:n])
+
+    def resolve(self, expirations=None, strikes=None, rights=('C', 'P'), get_tickers=False):
+        """
+        Resolves the options of part of the expiry/strike grid. Combinations that
+        aren't listed are dropped.
+
+        :param expirations: expiries (YYYYMMDD), all if None (list of str)
+        :param strikes: strikes, all if None (list of float)
+        :param rights: rights (tuple of str)
+        :param get_tickers: whether to request tickers and greeks (bool)
+        :return: options (InstrumentSet)
+        """
+        if expirations is None and strikes is None:
+            raise ValueError('Expirations or strikes required')
+        expirations = set(expirations) if expirations is not None else None
+        strikes = set(strikes) if strikes is not None else None
+        contracts = [
+            self._option_cls.IB_CLS(symbol=self._underlying.contract.symbol,
+                                    lastTradeDateOrContractMonth=e,
+                                    strike=k,
+                                    right=r,
+                                    exchange=c.exchange,
+                                    multiplier=c.multiplier,
+                                    currency=self._underlying.contract.currency,
+                                    tradingClass=c.tradingClass)
+            for c in self._chains
+            for e in sorted(c.expirations) if expirations is None or e in expirations
+            for k in sorted(c.strikes) if strikes is None or k in strikes
+            for r in rights
+        ]
+        if len(contracts) > self.MAX_CONTRACTS:
+            raise ValueError(f'{len(contracts)} options exceed the maximum of {self.MAX_CONTRACTS}')
+        self._env.logging.info('Requesting contract details for %d options of %s...', len(contracts), self._underlying.local_symbol)
+        options = InstrumentSet(*[self._option_cls.from_contract_details(d[0])
+                                  for d in self._env.ibgw.reqContractDetailsBatch(contracts) if len(d)])
+        if get_tickers and len(options):
+            options.get_tickers()
+        return options
+
+
 class InstrumentSet:
+    """
+    Ordered set of instruments, unique by contract ID, with indexes by contract ID,
+    local symbol and currency. Instruments that couldn't be resolved (no contract) are
+    unique by identity. The set doesn't hold an Environment, so that it is cheap to
+    create unions, intersections and grouped views.
+    """
 
     def __init__(self, *args):
         # check for iterability and type
@@ -114,42 +398,205 @@ class InstrumentSet:
         if not all(isinstance(a, Instrument) for a in args):
             raise TypeError('Not all arguments are of type Instrument')
 
-        self._constituents = args
-        self._env = Environment()
+        self._constituents = ()
+        self._by_con_id = {}
+        self._by_local_symbol = {}
+        self._by_currency = {}
+        self._contract_ids = {}
+        self._local_symbols = {}
+        self._keys = set()
+        self.add(*args)
+
+    @staticmethod
+    def _key(instrument):
+        return instrument.contract.conId if instrument.contract is not None else id(instrument)
 
     def __add__(self, other):
-        return InstrumentSet(*[*self] + [*other])
+        return self | other
+
+    def __and__(self, other):
+        if not isinstance(other, InstrumentSet):
+            other = InstrumentSet(*other)
+        # membership is checked against the index of the other set
+        return InstrumentSet(*[c for c in self._constituents if self._key(c) in other._keys])
+
+    def __contains__(self, item):
+        return (self._key(item) if isinstance(item, Instrument) else item) in self._keys
 
     def __getitem__(self, item):
         return self._constituents[item]
 
+    def __iadd__(self, other):
+        return self.add(*other)
+
     def __iter__(self):
         return iter(self._constituents)
 
+    def __len__(self):
+        return len(self._constituents)
+
+    def __or__(self, other):
+        union = InstrumentSet(*self._constituents)
+        return union.add(*other)
+
     @property
     def constituents(self):
         return self._constituents
 
+    @property
+    def contract_ids(self):
+        return MappingProxyType(self._contract_ids)
+
     @property
     def contracts(self):
         return [c.contract for c in self._constituents]
 
+    @property
+    def currencies(self):
+        return [*self._by_currency.keys()]
+
+    @property
+    def local_symbols(self):
+        return MappingProxyType(self._local_symbols)
+
     @property
     def tickers(self):
         return [c.tickers for c in self._constituents]
 
+    def add(self, *instruments):
+        """
+        Adds instruments that aren't in the set yet.
+
+        :param instruments: instruments (Instrument)
+        :return: the set itself (InstrumentSet)
+        """
+        if not all(isinstance(i, Instrument) for i in instruments):
+            raise TypeError('Not all arguments are of type Instrument')
+
+        to_add = []
+        for instrument in instruments:
+            if (key := self._key(instrument)) in self._keys:
+                continue
+            self._keys.add(key)
+            to_add.append(instrument)
+            if instrument.contract is not None:
+                self._by_con_id[key] = instrument
+                self._by_local_symbol[instrument.local_symbol] = instrument
+                self._contract_ids[instrument.local_symbol] = key
+                self._local_symbols[key] = instrument.local_symbol
+                self._by_currency.setdefault(instrument.contract.currency, []).append(instrument)
+        self._constituents += tuple(to_add)
+        return self
+
+    def by_currency(self):
+        """
+        Groups the instruments by currency (e.g. for FX lookups).
+
+        :return: instruments by currency (dict of InstrumentSet)
+        """
+        return {k: InstrumentSet(*v) for k, v in self._by_currency.items()}
+
+    def get(self, con_id, default=None):
+        """
+        Gets an instrument by contract ID.
+
+        :param con_id: contract ID (int)
+        :param default: value if not in the set
+        :return: instrument (Instrument)
+        """
+        return self._by_con_id.get(con_id, default)
+
+    def get_by_local_symbol(self, local_symbol, default=None):
+        """
+        Gets an instrument by local symbol.
+
+        :param local_symbol: local symbol (str)
+        :param default: value if not in the set
+        :return: instrument (Instrument)
+        """
+        return self._by_local_symbol.get(local_symbol, default)
+
     def get_tickers(self):
         """
         Requests price data for contract from IB.
         """
-        self._env.logging.info(f"Requesting tick data for {', '.join(c.local_symbol for c in self._constituents)}...")
-        tickers = self._env.ibgw.reqTickers(*self.contracts)
+        env = Environment()
+        env.logging.info(f"Requesting tick data for {', '.join(c.local_symbol for c in self._constituents)}...")
+        tickers = env.ibgw.reqTickers(*self.contracts)
         for c, t in zip(self._constituents, tickers):
             c._tickers = t
 
 
+class ConsolidatedTrade:
+    """
+    Compact record of a trade consolidated over strategies.
+    """
+
+    __slots__ = ('contract', 'quantity', 'source')
+
+    def __init__(self, contract, quantity, source):
+        self.contract = contract
+        self.quantity = quantity
+        self.source = source
+
+    def __eq__(self, other):
+        return isinstance(other, ConsolidatedTrade) and all(getattr(self, a) == getattr(other, a) for a in self.__slots__)
+
+    def __repr__(self):
+        return f'ConsolidatedTrade(contract={self.contract!r}, quantity={self.quantity!r}, source={self.source!r})'
+
+
+class CalendarSpread:
+    """
+    Compact record of a calendar spread (combo) replacing the opposite trades of a roll:
+    a positive quantity buys the back month and sells the front month.
+    """
+
+    __slots__ = ('contract', 'legs', 'local_symbol', 'quantity', 'source')
+
+    def __init__(self, contract, legs, local_symbol, quantity, source):
+        self.contract = contract
+        self.legs = legs
+        self.local_symbol = local_symbol
+        self.quantity = quantity
+        self.source = source
+
+    def __eq__(self, other):
+        return isinstance(other, CalendarSpread) and all(getattr(self, a) == getattr(other, a) for a in self.__slots__)
+
+    def __repr__(self):
+        return f"CalendarSpread({', '.join(f'{a}={getattr(self, a)!r}' for a in self.__slots__)})"
+
+    @classmethod
+    def from_legs(cls, front, back, quantity, source):
+        """
+        Creates a calendar spread with a BAG contract of two futures.
+
+        :param front: front month (Instrument)
+        :param back: back month (Instrument)
+        :param quantity: number of spreads (int)
+        :param source: number of spreads by strategy (dict)
+        :return: calendar spread (CalendarSpread)
+        """
+        contract = ib_insync.Contract(secType='BAG',
+                                      symbol=back.contract.symbol,
+                                      exchange=back.contract.exchange,
+                                      currency=back.contract.currency,
+                                      comboLegs=[
+                                          ib_insync.ComboLeg(conId=back.contract.conId, ratio=1, action='BUY', exchange=back.contract.exchange),
+                                          ib_insync.ComboLeg(conId=front.contract.conId, ratio=1, action='SELL', exchange=front.contract.exchange)
+                                      ])
+        return cls(contract=contract,
+                   legs={back.contract.conId: 1, front.contract.conId: -1},
+                   local_symbol=f'{front.local_symbol}/{back.local_symbol}',
+                   quantity=quantity,
+                   source=source)
+
+
 class Trade:
 
+    _calendar_spreads = {}
+    _orders = []
     _trades = {}
     _trade_log = {}
 
@@ -157,33 +604,155 @@ class Trade:
         self._env = Environment()
         self._strategies = strategies
 
+    @property
+    def calendar_spreads(self):
+        return self._calendar_spreads
+
+    @property
+    def orders(self):
+        return self._orders
+
     @property
     def trades(self):
         return self._trades
 
+    def combine_rolls(self):
+        """
+        Combines opposite trades in futures of the same root but adjacent expiries (rolls)
+        into calendar spreads, so that a roll is a single combo order instead of two
+        outright orders. Only the part that a strategy rolls (opposite quantities in both
+        legs) is combined, the rest of the trades remains outright.
+        """
+        roots = {}
+        for k, v in self._trades.items():
+            if (contract := v.contract.contract).secType == 'FUT':
+                roots.setdefault((contract.symbol, contract.exchange, contract.currency, contract.multiplier), []).append(k)
+
+        for contract_ids in roots.values():
+            contract_ids.sort(key=lambda k: self._trades[k].contract.contract.lastTradeDateOrContractMonth)
+            for front_id, back_id in zip(contract_ids, contract_ids[1:]):
+                front, back = self._trades.get(front_id), self._trades.get(back_id)
+                if front is None or back is None or front.quantity * back.quantity >= 0:
+                    continue
+                # spreads rolled by each strategy, in the direction of the consolidated roll
+                direction = 1 if back.quantity > 0 else -1
+                source = {
+                    k: direction * min(abs(v), abs(back.source[k]))
+                    for k, v in front.source.items()
+                    if k in back.source and v * direction < 0 < back.source[k] * direction
+                }
+                if not len(source):
+                    continue
+                quantity = sum(source.values())
+                self._calendar_spreads[(back_id, front_id)] = CalendarSpread.from_legs(front.contract, back.contract, quantity, source)
+                # what remains of the legs is traded outright
+                for contract_id, trade, ratio in [(front_id, front, -1), (back_id, back, 1)]:
+                    trade.quantity -= ratio * quantity
+                    trade.source = {k: v for k, v in {k: v - ratio * source.get(k, 0) for k, v in trade.source.items()}.items() if v}
+                    if trade.quantity == 0:
+                        del self._trades[contract_id]
+
+    @staticmethod
+    def _margin_value(value):
+        # what-if values are strings, unset ones are empty or the max. double
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return None
+        return value if value != ib_insync.util.UNSET_DOUBLE else None
+
+    def _fail_margin_check(self, error):
+        self._trades, self._calendar_spreads = {}, {}
+        self._env.logging.error('Margin check failed, trades blocked: %s', error)
+        return {'action': 'error', 'error': error}
+
+    def check_margin(self, max_utilisation=1., scale=False):
+        """
+        Checks the margin impact of the trades before placing them, with what-if orders
+        for all trades sent concurrently (a single round trip). The margin changes are
+        summed over the trades, i.e. offsets between them aren't taken into account. If
+        the initial or maintenance margin after the trades exceeds the net liquidation
+        value times max_utilisation, the trades are blocked or scaled down. The check
+        fails closed: if a what-if order or the account values are missing, the trades
+        are blocked as well.
+
+        :param max_utilisation: max. margin as a fraction of the net liquidation value (float)
+        :param scale: whether to scale the trades down instead of blocking them (bool)
+        :return: margin check (dict)
+        """
+        trades = [*self._trades.values(), *self._calendar_spreads.values()]
+        contracts = [t.contract.contract for t in self._trades.values()] + [t.contract for t in self._calendar_spreads.values()]
+        order_states = self._env.ibgw.request_batch('whatIfOrder', [
+            (c, ib_insync.MarketOrder(action='BUY' if t.quantity > 0 else 'SELL', totalQuantity=abs(t.quantity)))
+            for c, t in zip(contracts, trades)
+        ]) if len(trades) else []
+
+        margin_changes = [
+            [self._margin_value(getattr(s, change, None)) for change in ('initMarginChange', 'maintMarginChange')] if s else [None]
+            for s in order_states
+        ]
+        rows = ('NetLiquidation', 'InitMarginReq', 'MaintMarginReq')
+        account_values = self._env.get_account_values(self._env.config['account'], rows=rows)
+        if len(order_states) != len(trades) or any(None in c for c in margin_changes):
+            # IB refused or failed to evaluate (some of) the orders
+            keys = [*self._trades.keys(), *self._calendar_spreads.keys()]
+            return self._fail_margin_check(f'No what-if margin for {[k for k, c in zip(keys, margin_changes) if None in c] or keys}')
+        if not all(len(account_values.get(row, {})) for row in rows):
+            return self._fail_margin_check('No account values')
+
+        net_liquidation = [*account_values['NetLiquidation'].values()][0]
+        limit = net_liquidation * max_utilisation
+        check = {'netLiquidation': net_liquidation, 'limit': limit, 'scale': 1.}
+        increasing = np.zeros(len(trades), dtype=bool)
+        for i, (margin, row) in enumerate([('initMargin', 'InitMarginReq'), ('maintMargin', 'MaintMarginReq')]):
+            before = [*account_values[row].values()][0]
+            changes = np.array([c[i] for c in margin_changes], dtype=float)
+            increasing |= changes > 0
+            increase, decrease = changes[changes > 0].sum(), changes[changes < 0].sum()
+            check[margin] = {'before': before, 'change': float(changes.sum()), 'after': float(before + changes.sum())}
+            if before + changes.sum() > limit and increase > 0:
+                # fraction of the margin increasing trades that fits within the limit
+                check['scale'] = min(check['scale'], max(0., (limit - before - decrease) / increase))
+        if len(warnings := [s.warningText for s in order_states if getattr(s, 'warningText', '')]):
+            check['warnings'] = warnings
+
+        if check['scale'] >= 1:
+            check['action'] = 'passed'
+            return check
+
+        if scale:
+            for t in [t for t, i in zip(trades, increasing) if i]:
+                # scale per strategy so that the accounting still adds up
+                t.source = {k: v for k, v in {k: int(v * check['scale']) for k, v in t.source.items()}.items() if v}
+                t.quantity = sum(t.source.values())
+            self._trades = {k: v for k, v in self._trades.items() if v.quantity}
+            self._calendar_spreads = {k: v for k, v in self._calendar_spreads.items() if v.quantity}
+            check['action'] = 'scaled'
+        else:
+            self._trades, self._calendar_spreads = {}, {}
+            check['action'] = 'blocked'
+        self._env.logging.warning('Margin after trades exceeds %.0f, trades %s: %s', limit, check['action'], check)
+        return check
+
     def consolidate_trades(self):
         """
         Consolidates the trades of all strategies (sum of quantities, grouped by
         contract), remembering which strategy ('source') wants to trade what so
         that we have proper accounting.
         """
-        self._trades = {}
-        for strategy in self._strategies:
-            for k, v in strategy.trades.items():
-                if k not in self._trades:
-                    self._trades[k] = {}
-                self._trades[k]['contract'] = strategy.contracts[k]
-                if 'quantity' in self._trades[k]:
-                    self._trades[k]['quantity'] += v
-                else:
-                    self._trades[k]['quantity'] = v
-                if 'source' in self._trades[k]:
-                    self._trades[k]['source'][strategy.id] = v
-                else:
-                    self._trades[k]['source'] = {strategy.id: v}
-
-        self._trades = {k: v for k, v in self._trades.items() if v['quantity'] != 0}
+        self._calendar_spreads = {}
+        engine, matrix = SizingEngine.consolidate([s.trades for s in self._strategies])
+        quantities = matrix.sum(axis=0)
+        contracts = {k: s.contracts.get(k) for s in self._strategies for k in s.trades.keys()}
+        self._trades = {
+            k: ConsolidatedTrade(contract=contracts[k],
+                                 quantity=int(quantities[i]),
+                                 source={self._strategies[j].id: int(matrix[j, i]) for j in np.flatnonzero(matrix[:, i])})
+            for i, k in enumerate(engine.contract_ids)
+            if quantities[i] != 0
+        }
 
+    @Tracer.traced('firestore.logTrades')
     def _log_trades(self, trades=None):
         """
         Logs orders in Firestore under holdings if already filled or openOrders if not.
@@ -194,9 +763,17 @@ class Trade:
         if trades is None:
             trades = self._env.ibgw.trades()
 
+        local_symbols = {}
         for t in trades:
             # self._env.logging.debug(ib_insync.util.tree(t.nonDefaults()))
             contract_id = t.contract.conId
+            if t.contract.secType == 'BAG':
+                # calendar spread: holdings change in both legs
+                spread = self._calendar_spreads[tuple(leg.conId for leg in t.contract.comboLegs)]
+                source, legs = spread.source, spread.legs
+                local_symbols[id(t)] = spread.local_symbol
+            else:
+                source, legs = self._trades[contract_id].source, None
             if t.orderStatus.status in ib_insync.OrderStatus.ActiveStates:
                 # add to openOrders collection if not done yet
                 doc_ref = self._env.db.collection(f'positions/{self._env.trading_mode}/openOrders').document()
@@ -205,26 +782,28 @@ class Trade:
                     'contractId': contract_id,
                     'orderId': t.order.orderId,
                     'permId': t.order.permId if t.order.permId else None,
-                    'source': self._trades[contract_id]['source'],
-                    'timestamp': datetime.now(timezone.utc)
+                    'source': source,
+                    'timestamp': datetime.now(timezone.utc),
+                    **({'legs': {str(k): v for k, v in legs.items()}} if legs is not None else {})
                 })
                 self._env.logging.info(f'Added {contract_id} to /positions/{self._env.trading_mode}/openOrders/{doc_ref.id}')
             elif t.orderStatus.status in ib_insync.OrderStatus.DoneStates:
-                for strategy, quantity in self._trades[contract_id]['source'].items():
+                for strategy, quantity in source.items():
                     # update holdings collection if filled
                     doc_ref = self._env.db.collection(f'positions/{self._env.trading_mode}/holdings').document(strategy)
                     portfolio = doc_ref.get().to_dict() or {}
                     # firestore.transforms.Increment(increment)
                     action = doc_ref.update if doc_ref.get().exists else doc_ref.set
                     action({
-                        str(contract_id): portfolio.get(str(contract_id), 0) + quantity or DELETE_FIELD
+                        str(k): portfolio.get(str(k), 0) + quantity * ratio or DELETE_FIELD
+                        for k, ratio in (legs or {contract_id: 1}).items()
                     })
                     self._env.logging.info(f'Updated {contract_id} in /positions/{self._env.trading_mode}/holdings/{strategy}')
                     # TODO: use Fill/Execution instead?
 
         # return activity log entry
         return {
-            t.contract.localSymbol: {
+            local_symbols.get(id(t), t.contract.localSymbol): {
                 'order': {
                     k: v
                     for k, v in t.order.nonDefaults().items()
@@ -239,29 +818,41 @@ class Trade:
             } for t in trades
         }
 
-    def place_orders(self, order_type=ib_insync.MarketOrder, order_params=None, order_properties=None):
+    def place_orders(self, order_type=ib_insync.MarketOrder, order_params=None, order_properties=None, spread_order_params=None,
+                     limit_prices=None):
         """
         Places orders in the market.
 
         :param order_type: IB order type (ib_insync Order object)
         :param order_params: arguments for IB order (dict)
         :param order_properties: additional order parameters (dict)
+        :param spread_order_params: arguments for IB combo orders of calendar spreads, e.g. without algo (dict)
+        :param limit_prices: limit prices by contract ID, these trades are placed as limit orders (dict)
         :return: activity log entry (dict)
         """
         order_properties = order_properties or {}
         order_params = order_params or {}
-
-        # place orders
-        perm_ids = []
-        for v in self._trades.values():
-            order = self._env.ibgw.placeOrder(v['contract'].contract,
-                                              order_type(action='BUY' if v['quantity'] > 0 else 'SELL',
-                                                         totalQuantity=abs(v['quantity']),
-                                                         **order_params).update(**{'tif': 'GTC', **order_properties}))
+        spread_order_params = spread_order_params or {}
+        limit_prices = limit_prices or {}
+
+        # place orders (paced by the gateway)
+        orders = [
+            self._env.ibgw.placeOrder(contract,
+                                      (ib_insync.LimitOrder if k in limit_prices else order_type)(
+                                          action='BUY' if v.quantity > 0 else 'SELL',
+                                          totalQuantity=abs(v.quantity),
+                                          **params,
+                                          **({'lmtPrice': limit_prices[k]} if k in limit_prices else {})
+                                      ).update(**{'tif': 'GTC', **order_properties}))
+            for k, contract, v, params in [(k, v.contract.contract, v, order_params) for k, v in self._trades.items()] +
+                                          [(k, v.contract, v, spread_order_params) for k, v in self._calendar_spreads.items()]
+        ]
+        self._orders = orders
+        if len(orders):
             # give the IB Gateway a couple of seconds to digest orders and to raise possible errors
             self._env.ibgw.sleep(2)
-            perm_ids.append(order.order.permId)
-        self._env.logging.debug(f'Order permanent IDs: {perm_ids}')
+        perm_ids = [order.order.permId for order in orders]
+        self._env.logging.debug('Order permanent IDs: %s', perm_ids)
 
         self._trade_log = self._log_trades([t for t in self._env.ibgw.trades() if t.order.permId in perm_ids])
 
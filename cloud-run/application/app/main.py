@@ -5,14 +5,18 @@ import logging
 from os import environ, listdir
 import re
 
+from intents.activity_export import ActivityExport
 from intents.allocation import Allocation
 from intents.cash_balancer import CashBalancer
 from intents.close_all import CloseAll
 from intents.collect_market_data import CollectMarketData
 from intents.intent import Intent
+from intents.pipeline import Pipeline
 from intents.summary import Summary
 from intents.trade_reconciliation import TradeReconciliation
 from lib.environment import Environment
+from lib.profiling import SamplingProfiler
+from lib.tracing import Tracer
 
 # get environment variables
 TRADING_MODE = environ.get('TRADING_MODE', 'paper')
@@ -23,13 +27,17 @@ if TRADING_MODE not in ['live', 'paper']:
 
 # set constants
 INTENTS = {
+    'activity-export': ActivityExport,
     'allocation': Allocation,
     'cash-balancer': CashBalancer,
     'close-all': CloseAll,
     'collect-market-data': CollectMarketData,
+    'pipeline': Pipeline,
     'summary': Summary,
     'trade-reconciliation': TradeReconciliation
 }
+# intents that can be run as pipeline steps
+Pipeline.INTENTS = {k: v for k, v in INTENTS.items() if k != 'pipeline'}
 
 # build IBC config from environment variables
 env = {
@@ -44,7 +52,63 @@ ibc_config = {
     'twsVersion': re.search('IB Gateway ([0-9]{3})', install_log).group(1),
     **env
 }
-Environment(TRADING_MODE, ibc_config)
+environment = Environment(TRADING_MODE, ibc_config)
+
+
+class Health:
+    """
+    Liveness and readiness probes, answered from in-process state only (never
+    starts the gateway).
+    """
+
+    REQUIRED_CONFIG = ['account', 'marketDataType']
+
+    def on_get(self, _, response):
+        response.content_type = falcon.MEDIA_JSON
+        response.text = json.dumps({'status': 'ok'}) + '\n'
+        response.status = falcon.HTTP_200
+
+    def on_get_ready(self, _, response):
+        state = {
+            'credentials': all(environment.ibgw.ibc_config.get(k) for k in ['userid', 'password']),
+            'config': all(k in environment.config for k in self.REQUIRED_CONFIG)
+        }
+        ready = all(state.values())
+        if environment.config.get('persistentGateway', False):
+            state['gateway'] = environment.ibgw.isConnected()
+
+        response.content_type = falcon.MEDIA_JSON
+        response.text = json.dumps({'status': 'ready' if ready else 'not ready', **state}) + '\n'
+        response.status = falcon.HTTP_200 if ready else falcon.HTTP_503
+
+
+class Metrics:
+    """
+    Call latency histograms in Prometheus text format.
+    """
+
+    def on_get(self, _, response):
+        response.content_type = 'text/plain; version=0.0.4'
+        response.text = Tracer.prometheus()
+        response.status = falcon.HTTP_200
+
+
+class Time:
+    """
+    Current IB server time over an existing gateway session.
+    """
+
+    def on_get(self, _, response):
+        if environment.ibgw.isConnected():
+            result = {'currentTime': environment.ibgw.reqCurrentTime().isoformat()}
+            response.status = falcon.HTTP_200
+        else:
+            result = {'error': 'No gateway session'}
+            response.status = falcon.HTTP_503
+
+        result['utcTimestamp'] = datetime.utcnow().isoformat()
+        response.content_type = falcon.MEDIA_JSON
+        response.text = json.dumps(result) + '\n'
 
 
 class Main:
@@ -60,34 +124,84 @@ class Main:
         self._on_request(request, response, intent, **body)
 
     @staticmethod
-    def _on_request(_, response, intent, **kwargs):
+    def _profiling_requested(request):
+        """
+        Checks whether the request opts into profiling (only honoured if enabled in the config).
+
+        :param request: Falcon request
+        :return: whether to profile the request (bool)
+        """
+        if not environment.config.get('profiling', False):
+            return False
+        header = (request.get_header('X-Profile') or '').lower() in ['1', 'true', 'yes']
+        return header or bool(request.get_param_as_bool('profile'))
+
+    @staticmethod
+    def _store_profile(intent_instance, profiler):
+        """
+        Stores a profile in Firestore next to the activity log. It is written on its own
+        rather than with the activity log batches, so that a failing write can't take
+        activity log entries with it.
+
+        :param intent_instance: intent that was profiled (Intent)
+        :param profiler: stopped profiler (SamplingProfiler)
+        :return: profile (dict)
+        """
+        profile = profiler.to_dict()
+        try:
+            environment.db.collection('profiles').document().set({
+                'intent': intent_instance.__class__.__name__,
+                'signature': intent_instance._signature,
+                'timestamp': datetime.utcnow(),
+                'tradingMode': environment.trading_mode,
+                **profile
+            })
+        except Exception as e:
+            environment.logging.error('Error storing profile: %s', e)
+        return profile
+
+    @classmethod
+    def _on_request(cls, request, response, intent, **kwargs):
         """
         Handles HTTP request.
 
-        :param _: Falcon request (not used)
+        :param request: Falcon request
         :param response: Falcon response
         :param intent: intent (str)
         :param kwargs: HTTP request body (dict)
         """
 
+        profiler = None
+        intent_instance = None
         try:
             if intent is None or intent not in INTENTS.keys():
                 logging.warning('Unknown intent')
                 intent_instance = Intent()
             else:
                 intent_instance = INTENTS[intent](**kwargs)
-            result = intent_instance.run()
+            if cls._profiling_requested(request):
+                profiler = SamplingProfiler()
+                with profiler:
+                    result = intent_instance.run()
+            else:
+                result = intent_instance.run()
             response.status = falcon.HTTP_200
         except Exception as e:
             error_str = f'{e.__class__.__name__}: {e}'
             result = {'error': error_str}
             response.status = falcon.HTTP_500
 
+        if profiler is not None:
+            result['profile'] = cls._store_profile(intent_instance, profiler)
         result['utcTimestamp'] = datetime.utcnow().isoformat()
         response.content_type = falcon.MEDIA_JSON
         response.text = json.dumps(result) + '\n'
 
 
-# instantiante Falcon App and define route for intent
+# instantiante Falcon App and define routes for probes and intent
 app = falcon.App()
+app.add_route('/healthz', Health())
+app.add_route('/readyz', Health(), suffix='ready')
+app.add_route('/metrics', Metrics())
+app.add_route('/time', Time())
 app.add_route('/{intent}', Main())
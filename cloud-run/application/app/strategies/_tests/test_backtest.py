@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import unittest
+from unittest.mock import patch
+
+from strategies.backtest import Backtest, SimulatedBars
+from strategies.strategy import Strategy
+
+
+class LongOnly(Strategy):
+
+    def _get_signals(self):
+        # long the contracts with a price so far
+        self._signals = {k: self._params.get('weight', 1.) for k in [1, 2] if len(self._get_bars(k)[0])}
+
+
+class TestSimulatedBars(unittest.TestCase):
+
+    BARS = pd.DataFrame({1: [10., 11., np.nan, 12.]}, index=pd.date_range('2022-01-03', periods=4))
+
+    def test_bars(self):
+        test_obj = SimulatedBars(self.BARS)
+        timestamps, values = test_obj.bars(1, until=self.BARS.index[2])
+        np.testing.assert_array_equal(self.BARS.index[:2].to_numpy(), timestamps)
+        np.testing.assert_array_equal([10., 11.], values)
+
+        timestamps, values = test_obj.bars(1, start=self.BARS.index[1], end=self.BARS.index[3])
+        np.testing.assert_array_equal([11.], values)
+        self.assertEqual(3, len(test_obj.bars(1, column=None)[1]))
+        self.assertRaises(KeyError, test_obj.bars, 1, column='volume')
+
+
+class TestBacktest(unittest.TestCase):
+
+    BARS = pd.DataFrame({1: [10., 11., np.nan, 12.], 2: [np.nan, 20., 22., 21.]},
+                        index=pd.date_range('2022-01-03', periods=4))
+
+    @patch('strategies.strategy.Environment')
+    def test_run(self, *_):
+        result = Backtest(LongOnly, self.BARS, 100, multipliers={2: 2}, fx={2: 0.5}, commission=1., weight=0.5).run()
+
+        np.testing.assert_array_equal([[5, 0], [5, 2], [5, 2], [4, 2]], result.target_positions.to_numpy())
+        np.testing.assert_array_equal([[5, 0], [0, 2], [0, 0], [-1, 0]], result.trades.to_numpy())
+        # positions earn the PnL of the following bars (price 11 carried forward into the third bar)
+        np.testing.assert_array_equal([[0, 0], [5, 0], [0, 4], [5, -2]], result.pnl.to_numpy())
+        np.testing.assert_array_equal([-5, 3, 4, 2], result.net_pnl.to_numpy())
+        np.testing.assert_array_equal([95, 98, 102, 104], result.equity.to_numpy())
+
+        stats = result.stats()
+        self.assertAlmostEqual(0.04, stats['totalReturn'])
+        self.assertAlmostEqual(0.01 * 252, stats['annualisedReturn'])
+        self.assertAlmostEqual(-0.05, stats['maxDrawdown'])
+        self.assertEqual(8., stats['costs'])
+        self.assertEqual(8., stats['turnover'])
+
+        fx = pd.DataFrame({2: [0.5]}, index=self.BARS.index[:1])
+        actual = Backtest(LongOnly, self.BARS, 100, multipliers={2: 2}, fx=fx, weight=0.5).run()
+        np.testing.assert_array_equal(result.target_positions.to_numpy(), actual.target_positions.to_numpy())
+
+    @patch('strategies.strategy.Environment')
+    def test_run_simulated_clock(self, *_):
+        timestamps = []
+
+        def get_signals(strategy):
+            timestamps.append(strategy._get_bars(1)[0][-1])
+            strategy._signals = {}
+
+        with patch.object(LongOnly, '_get_signals', get_signals):
+            Backtest(LongOnly, self.BARS, 100).run()
+        # the strategy only sees the bars up to the simulated time
+        np.testing.assert_array_equal(self.BARS.index.to_numpy(), timestamps)
+
+    @patch('strategies.strategy.Environment')
+    def test_run_invalid_signals(self, *_):
+        with patch.object(LongOnly, 'signals_at', return_value={3: 1}):
+            self.assertRaises(ValueError, Backtest(LongOnly, self.BARS, 100).run)
+        # no signals without holdings
+        self.assertEqual(0, Backtest(Strategy, self.BARS, 100).run().trades.abs().sum().sum())
+
+    @patch('strategies.strategy.Environment')
+    def test_sweep(self, *_):
+        actual = Backtest.sweep(LongOnly, self.BARS, {'weight': [0.5, 1.]}, processes=2, exposure=100)
+        self.assertListEqual([{'weight': 0.5}, {'weight': 1.}], [params for params, _ in actual])
+        self.assertEqual(Backtest(LongOnly, self.BARS, 100, weight=1.).run().stats(), actual[1][1])
+
+    @patch('strategies.backtest.Environment')
+    def test_load_bars(self, environment):
+        environment.return_value.query_bigquery.return_value = pd.DataFrame({
+            'timestamp': [2, 1, 1], 'contractId': [1, 1, 2], 'close': [3., 4., 5.]
+        })
+        actual = Backtest.load_bars('query', {'a': 1})
+        self.assertListEqual([1, 2], actual.index.tolist())
+        self.assertListEqual([4., 3.], actual[1].tolist())
+        try:
+            environment.return_value.query_bigquery.assert_called_once_with('query', {'a': 1})
+        except AssertionError:
+            self.fail()
+
+    @patch('strategies.backtest.BarStore')
+    def test_load_store(self, bar_store):
+        bar_store.return_value.key.side_effect = lambda i, b: i
+        bar_store.return_value.column.side_effect = [
+            (np.array(['2022-01-03', '2022-01-04'], dtype='datetime64[ns]'), np.array([1., 2.])),
+            (np.array(['2022-01-04', '2022-01-05'], dtype='datetime64[ns]'), np.array([3., 4.]))
+        ]
+        actual = Backtest.load_store([1, 2], start='start')
+        self.assertListEqual([1, 2], actual.columns.tolist())
+        np.testing.assert_array_equal([[1, np.nan], [2, 3], [np.nan, 4]], actual.to_numpy())
+        try:
+            bar_store.return_value.column.assert_called_with(2, 'close', 'start', None)
+        except AssertionError:
+            self.fail()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,49 +1,71 @@
+from ib_insync import ContractDetails, Future as IBFuture
+import numpy as np
+import pandas as pd
 import unittest
-from unittest.mock import call, MagicMock, patch
+from unittest.mock import MagicMock, patch
 
+from lib.trading import Future, InstrumentSet
+from strategies.backtest import Backtest
 from strategies.dummy import Dummy
-from strategies.dummy import randint
 
 
 class TestVxcurve(unittest.TestCase):
 
     @patch('strategies.strategy.Environment')
     @patch.object(Dummy, '_get_signals')
+    @patch.object(Dummy, '_setup_instruments')
     @patch.object(Dummy, '_setup')
     def setUp(self, *_):
         self.test_obj = Dummy()
 
-    @patch('strategies.dummy.randint', return_value=12)
     @patch.object(Dummy, '_register_contracts')
-    def test_get_signals(self, _register_contracts, randint):
+    def test_get_signals(self, _register_contracts):
         instruments = {
             'mnq': [MagicMock(contract=MagicMock(conId='mnq'))]
         }
 
-        with patch.object(self.test_obj, '_instruments', instruments):
+        with patch.object(self.test_obj, '_instruments', instruments), \
+                patch.object(self.test_obj, '_rng', randint=MagicMock(return_value=12)) as rng:
             expected = {
-                instruments['mnq'][0].contract.conId: randint.return_value
+                instruments['mnq'][0].contract.conId: rng.randint.return_value
             }
             self.test_obj._get_signals()
             self.assertDictEqual(expected, self.test_obj._signals)
             try:
-                randint.assert_called_once_with(-1, 1)
+                rng.randint.assert_called_once_with(-1, 1)
                 _register_contracts.assert_called_once_with(instruments['mnq'][0])
             except AssertionError:
                 self.fail()
 
+    def test_setup(self):
+        with patch.object(self.test_obj, '_params', {'seed': 1}):
+            self.test_obj._setup()
+            signals = [self.test_obj._rng.randint(-1, 1) for _ in range(10)]
+            self.test_obj._setup()
+            # seeded, so that backtests are reproducible
+            self.assertListEqual(signals, [self.test_obj._rng.randint(-1, 1) for _ in range(10)])
+
     @patch('strategies.dummy.Future.get_contract_series', return_value='contract-series')
-    def test_setup(self, get_contract_series):
-        expected = {
-            'mnq': get_contract_series.return_value
-        }
-        self.test_obj._setup()
-        self.assertDictEqual(expected, self.test_obj._instruments)
+    def test_setup_instruments(self, get_contract_series):
+        self.assertDictEqual({'mnq': get_contract_series.return_value}, self.test_obj._setup_instruments())
         try:
             get_contract_series.assert_called_once_with(1, 'MNQ', rollover_days_before_expiry=2)
         except AssertionError:
             self.fail()
 
+    @patch('lib.trading.Environment', side_effect=AssertionError('no environment offline'))
+    @patch('strategies.strategy.Environment', side_effect=AssertionError('no environment offline'))
+    def test_backtest(self, *_):
+        # preset instruments, so that neither IB nor GCP are needed
+        mnq = Future.from_contract_details(ContractDetails(contract=IBFuture(conId=1, localSymbol='MNQH2', multiplier='2'), minTick=0.25))
+        bars = pd.DataFrame({1: np.linspace(14000., 15000., 20)}, index=pd.date_range('2022-01-03', periods=20))
+        results = [Backtest(Dummy, bars, 100000, multipliers={1: 2}, instruments={'mnq': InstrumentSet(mnq)}, seed=1).run()
+                   for _ in range(2)]
+        self.assertEqual(20, len(results[0].target_positions))
+        self.assertTrue(results[0].trades.abs().to_numpy().sum() > 0)
+        # seeded
+        self.assertTrue(results[0].trades.equals(results[1].trades))
+
 
 if __name__ == '__main__':
     unittest.main()
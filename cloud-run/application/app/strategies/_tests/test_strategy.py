@@ -1,7 +1,7 @@
 import unittest
 from unittest.mock import call, MagicMock, patch, PropertyMock
 
-from strategies.strategy import Instrument, Strategy
+from strategies.strategy import Instrument, InstrumentSet, Strategy
 
 
 class TestStrategy(unittest.TestCase):
@@ -85,7 +85,7 @@ class TestStrategy(unittest.TestCase):
     def test_calculate_trades(self):
         with patch.object(self.test_obj, '_target_positions', {'abc': 1, 'def': 2, 'ghi': 3}):
             with patch.object(self.test_obj, '_holdings', {'abc': 2, 'def': 1, 'ghi': 3}):
-                with patch.object(self.test_obj, '_contracts', {k: MagicMock(local_symbol=k) for k in ['abc', 'def', 'ghi']}):
+                with patch.object(self.test_obj, '_contracts', MagicMock(local_symbols={k: k.upper() for k in ['abc', 'def', 'ghi']})):
                     self.test_obj._calculate_trades()
                     self.assertDictEqual({'abc': -1, 'def': 1}, self.test_obj._trades)
 
@@ -98,16 +98,73 @@ class TestStrategy(unittest.TestCase):
                                                                  MagicMock(get_ticker=MagicMock(), tickers=MagicMock(close=1, midpoint=MagicMock(return_value=float('nan')))),
                                                                  MagicMock(get_ticker=MagicMock(), tickers=MagicMock(close=1, midpoint=MagicMock(return_value=1)))]
             with patch('strategies.strategy.Forex') as forex:
-                with patch.object(self.test_obj, '_contracts', {c: MagicMock(contract=MagicMock(currency=c)) for c in currencies}):
+                with patch.object(self.test_obj, '_contracts', InstrumentSet(*[MagicMock(spec=Instrument, contract=MagicMock(conId=i, currency=c))
+                                                                               for i, c in enumerate(currencies)])):
                     self.test_obj._get_currencies(base_currency)
                     self.assertDictEqual({'CHF': 1, 'EUR': 1, 'USD': 1}, self.test_obj._fx)
                     try:
-                        forex.assert_has_calls([call(pair=c + base_currency) for c in set(currencies)])
+                        forex.assert_has_calls([call(pair=c + base_currency) for c in ['CHF', 'USD', 'EUR']])
                         instrumentset.assert_called_once_with(*[forex.return_value] * 3)
                         instrumentset.return_value.get_tickers.assert_called_once()
                     except AssertionError:
                         self.fail()
 
+    @patch('strategies.strategy.BarStore')
+    def test_get_bars(self, bar_store):
+        bar_store.return_value.key.return_value = 'key'
+        with patch.object(self.test_obj, '_env', config={}):
+            self.assertEqual(bar_store.return_value.column.return_value, self.test_obj._get_bars(123, start='start'))
+            self.assertEqual(bar_store.return_value.slice.return_value, self.test_obj._get_bars(123, '1 hour', column=None))
+            try:
+                bar_store.return_value.key.assert_called_with(123, '1 hour')
+                bar_store.return_value.column.assert_called_once_with('key', 'close', 'start', None)
+                bar_store.return_value.slice.assert_called_once_with('key', None, None)
+                bar_store.return_value.sync_in_background.assert_not_called()
+            except AssertionError:
+                self.fail()
+
+        with patch.object(self.test_obj, '_env', config={'barStoreTable': 'dataset.table'}):
+            # warm store: topped up in the background
+            bar_store.return_value.covers.return_value = True
+            self.test_obj._get_bars(123, start='start')
+            try:
+                bar_store.return_value.covers.assert_called_once_with('key', 'start')
+                bar_store.return_value.sync_in_background.assert_called_once_with('key')
+                bar_store.return_value.sync.assert_not_called()
+            except AssertionError:
+                self.fail()
+
+            # range not covered (e.g. cold instance): synced before reading
+            bar_store.return_value.covers.return_value = False
+            bar_store.return_value.sync_in_background.reset_mock()
+            self.test_obj._get_bars(123)
+            try:
+                bar_store.return_value.sync.assert_called_once_with('key')
+                bar_store.return_value.sync_in_background.assert_not_called()
+            except AssertionError:
+                self.fail()
+
+    @patch.object(Strategy, '_setup')
+    @patch('strategies.strategy.Environment')
+    def test_simulate(self, environment, _setup):
+        bar_source = MagicMock()
+        strategy = Strategy.simulate(bar_source, weight=2)
+        self.assertEqual('strategy', strategy._id)
+        self.assertDictEqual({'weight': 2}, strategy._params)
+        self.assertEqual(bar_source, strategy._bar_source)
+        try:
+            _setup.assert_called_once()
+        except AssertionError:
+            self.fail()
+
+        with patch.object(strategy, '_get_signals', side_effect=lambda: setattr(strategy, '_signals', {1: 1})):
+            self.assertDictEqual({1: 1}, strategy.signals_at('timestamp'))
+            self.assertEqual(bar_source.bars.return_value, strategy._get_bars(123, start='start'))
+            try:
+                bar_source.bars.assert_called_once_with(123, '1 day', 'start', None, 'close', until='timestamp')
+            except AssertionError:
+                self.fail()
+
     @patch.object(Strategy, '_register_contracts')
     def test_get_holdings(self, _register_contracts):
         with patch.object(self.test_obj, '_env',
@@ -137,20 +194,22 @@ class TestStrategy(unittest.TestCase):
     def test_register_contracts(self):
         self.assertRaises(TypeError, self.test_obj._register_contracts, 1, 'a', MagicMock(spec=Instrument))
 
-        with patch.object(self.test_obj, '_contracts', {1: '1', 2: '2'}):
-            with patch('strategies.strategy.Contract') as contract:
+        registered = [MagicMock(spec=Instrument, contract=MagicMock(conId=i)) for i in [1, 2]]
+        with patch.object(self.test_obj, '_contracts', InstrumentSet(*registered)):
+            with patch('strategies.strategy.Contract', side_effect=lambda conId: MagicMock(spec=Instrument, contract=MagicMock(conId=conId))) as contract:
                 self.test_obj._register_contracts(2, 3)
-                self.assertDictEqual({1: '1', 2: '2', 3: contract.return_value}, self.test_obj._contracts)
+                self.assertListEqual([1, 2, 3], [c.contract.conId for c in self.test_obj._contracts])
                 try:
-                    contract.assert_has_calls([call(conId=2), call(conId=3)])
+                    # only contracts not registered yet are resolved
+                    contract.assert_called_once_with(conId=3)
                 except AssertionError:
                     self.fail()
 
-        with patch.object(self.test_obj, '_contracts', {1: '1', 2: '2'}):
+        with patch.object(self.test_obj, '_contracts', InstrumentSet(*registered)):
             contracts = [MagicMock(spec=Instrument, contract=MagicMock(conId=2)),
                          MagicMock(spec=Instrument, contract=MagicMock(conId=3))]
             self.test_obj._register_contracts(*contracts)
-            self.assertDictEqual({1: '1', 2: '2', 3: contracts[1]}, self.test_obj._contracts)
+            self.assertListEqual([*registered, contracts[1]], [*self.test_obj._contracts])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,236 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from lib.bar_store import BarStore
+from lib.environment import Environment
+from lib.sizing import SizingEngine
+
+
+class BacktestResult:
+    """
+    Positions, trades and PnL of a backtest, one row per bar and one column per contract.
+    """
+
+    def __init__(self, target_positions, trades, pnl, costs, exposure):
+        self._target_positions = target_positions
+        self._trades = trades
+        self._pnl = pnl
+        self._costs = costs
+        self._exposure = exposure
+
+    @property
+    def equity(self):
+        return self._exposure + self.net_pnl.cumsum()
+
+    @property
+    def net_pnl(self):
+        return self._pnl.sum(axis=1) - self._costs
+
+    @property
+    def pnl(self):
+        return self._pnl
+
+    @property
+    def target_positions(self):
+        return self._target_positions
+
+    @property
+    def trades(self):
+        return self._trades
+
+    def stats(self, periods_per_year=252):
+        """
+        Summarises the performance relative to the exposure.
+
+        :param periods_per_year: number of bars per year (int)
+        :return: statistics (dict)
+        """
+        returns = self.net_pnl / self._exposure
+        equity = self.equity
+        volatility = returns.std(ddof=1) * np.sqrt(periods_per_year)
+        return {
+            'totalReturn': float(equity.iloc[-1] / self._exposure - 1) if len(equity) else 0.,
+            'annualisedReturn': float(returns.mean() * periods_per_year) if len(returns) else 0.,
+            'annualisedVolatility': float(volatility) if volatility == volatility else 0.,
+            'sharpeRatio': float(returns.mean() * periods_per_year / volatility) if volatility else 0.,
+            # drawdowns relative to the high-water mark, starting from the initial exposure
+            'maxDrawdown': float((equity / equity.cummax().clip(lower=self._exposure) - 1).min()) if len(equity) else 0.,
+            'costs': float(self._costs.sum()),
+            'turnover': float(self._trades.abs().sum().sum())
+        }
+
+
+class SimulatedBars:
+    """
+    Bar source of a backtest, standing in for the bar store: serves the close prices of
+    the backtest bars up to and including the simulated time, so signals can't look ahead.
+    """
+
+    def __init__(self, bars):
+        """
+        :param bars: close prices, one column per contract ID (pd.DataFrame)
+        """
+        # cleaned once, so that each step of the simulated clock only slices
+        self._bars = {}
+        for k in bars.columns:
+            series = bars[k].dropna()
+            timestamps, values = series.index.to_numpy(dtype='datetime64[ns]'), series.to_numpy(dtype=float)
+            timestamps.flags.writeable = values.flags.writeable = False
+            self._bars[k] = timestamps, values
+
+    @staticmethod
+    def _index(timestamps, timestamp, side):
+        return int(np.searchsorted(timestamps, pd.Timestamp(timestamp).to_datetime64(), side=side))
+
+    def bars(self, instrument, bar_size='1 day', start=None, end=None, column='close', until=None):
+        """
+        Gets the bars of an instrument like Strategy._get_bars (the bar size is that of the backtest).
+
+        :param instrument: contract ID (int)
+        :param bar_size: bar size (str)
+        :param start: first timestamp, inclusive (datetime)
+        :param end: last timestamp, exclusive (datetime)
+        :param column: bar column, only close prices are available (str)
+        :param until: simulated time, last timestamp inclusive (datetime)
+        :return: timestamps (np.ndarray), values (np.ndarray)
+        """
+        if column not in ['close', None]:
+            raise KeyError(f'Only close prices are available in backtests, not {column}')
+        timestamps, values = self._bars[instrument]
+        first = self._index(timestamps, start, 'left') if start is not None else 0
+        last = len(timestamps)
+        if end is not None:
+            last = min(last, self._index(timestamps, end, 'left'))
+        if until is not None:
+            last = min(last, self._index(timestamps, until, 'right'))
+        return timestamps[first:max(first, last)], values[first:max(first, last)]
+
+
+class Backtest:
+    """
+    Backtest of a Strategy subclass over historical bars. The strategy's own signal
+    code (_setup and _get_signals) is run bar by bar over a simulated clock, with the
+    bars served by SimulatedBars, so that the backtested strategy is the one that
+    trades. Holdings and tickers aren't requested, and with preset instruments the
+    backtest runs offline. Target positions, trades and PnL are then calculated
+    vectorised with the same SizingEngine as in live trading.
+    Positions are established at the close of the signal bar and earn the PnL of the
+    following bars.
+    """
+
+    def __init__(self, strategy, bars, exposure, multipliers=None, fx=None, commission=0., instruments=None, **params):
+        """
+        :param strategy: strategy class (subclass of Strategy)
+        :param bars: close prices in contract currency, one column per contract ID (pd.DataFrame)
+        :param exposure: exposure in base currency (float)
+        :param multipliers: contract multipliers by contract ID, 1 if missing (dict)
+        :param fx: FX rates to base currency, by contract ID (dict) or per bar (pd.DataFrame), 1 if missing
+        :param commission: commission per contract traded in base currency (float)
+        :param instruments: preset instruments of the strategy, resolved through IB if None (dict)
+        :param params: strategy parameters
+        """
+        self._strategy = strategy
+        self._instruments = instruments
+        # the simulated clock: bars are processed in chronological order
+        self._bars = bars.sort_index().ffill()
+        self._exposure = exposure
+        self._multipliers = multipliers or {}
+        self._fx = fx if fx is not None else {}
+        self._commission = commission
+        self._params = params
+
+    def run(self):
+        """
+        Runs the backtest.
+
+        :return: result (BacktestResult)
+        """
+        engine = SizingEngine(self._bars.columns)
+        prices = self._bars.to_numpy(dtype=float)
+        multipliers = engine.vector(self._multipliers, default=1)
+        if isinstance(self._fx, pd.DataFrame):
+            fx = self._fx.reindex(index=self._bars.index, columns=engine.contract_ids).ffill().fillna(1).to_numpy(dtype=float)
+        else:
+            fx = engine.vector(self._fx, default=1)
+
+        strategy = self._strategy.simulate(SimulatedBars(self._bars), self._instruments, **self._params)
+        contract_ids = set(engine.contract_ids)
+        signals = np.zeros(prices.shape)
+        for i, timestamp in enumerate(self._bars.index):
+            bar_signals = strategy.signals_at(timestamp)
+            if len(missing := bar_signals.keys() - contract_ids):
+                raise ValueError(f'No bars for contracts {sorted(missing)} with a signal')
+            signals[i] = engine.vector(bar_signals)
+
+        # contracts without price yet can't be traded
+        target_positions = np.nan_to_num(engine.target_positions(self._exposure, signals, prices, multipliers, fx))
+        holdings = np.vstack([np.zeros((1, len(engine))), target_positions[:-1]])
+        trades = engine.trades(target_positions, holdings)
+        # PnL of the positions held over each bar, in base currency
+        pnl = np.nan_to_num(holdings * np.diff(prices, axis=0, prepend=np.nan) * multipliers * fx)
+        costs = np.abs(trades).sum(axis=1) * self._commission
+
+        index, columns = self._bars.index, self._bars.columns
+        return BacktestResult(pd.DataFrame(target_positions, index=index, columns=columns),
+                              pd.DataFrame(trades, index=index, columns=columns),
+                              pd.DataFrame(pnl, index=index, columns=columns),
+                              pd.Series(costs, index=index),
+                              self._exposure)
+
+    @staticmethod
+    def _run_params(args):
+        strategy, bars, kwargs, params = args
+        return params, Backtest(strategy, bars, **kwargs, **params).run().stats()
+
+    @classmethod
+    def sweep(cls, strategy, bars, param_grid, processes=None, **kwargs):
+        """
+        Runs the backtest for all combinations of strategy parameters in a process pool.
+
+        :param strategy: strategy class, must be importable by the worker processes (subclass of Strategy)
+        :param bars: close prices, one column per contract ID (pd.DataFrame)
+        :param param_grid: values to test by parameter name (dict of list)
+        :param processes: number of worker processes, defaults to the number of CPUs (int)
+        :param kwargs: further backtest arguments (e.g. exposure)
+        :return: parameters and statistics of each run (list of tuple)
+        """
+        grid = [dict(zip(param_grid.keys(), values)) for values in product(*param_grid.values())]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            return list(executor.map(cls._run_params, [(strategy, bars, kwargs, params) for params in grid]))
+
+    @staticmethod
+    def load_bars(query, query_parameters=None, index='timestamp', columns='contractId', values='close'):
+        """
+        Loads bars from BigQuery in long format and pivots them to one column per contract.
+
+        :param query: query string (str)
+        :param query_parameters: parameters for parametrised query (dict)
+        :param index: name of the time column (str)
+        :param columns: name of the contract ID column (str)
+        :param values: name of the price column (str)
+        :return: bars (pd.DataFrame)
+        """
+        df = Environment().query_bigquery(query, query_parameters)
+        return df.pivot(index=index, columns=columns, values=values).sort_index()
+
+    @staticmethod
+    def load_store(instruments, bar_size='1 day', start=None, end=None, column='close'):
+        """
+        Loads bars from the local bar store, one column per instrument.
+
+        :param instruments: contract IDs or local symbols (list)
+        :param bar_size: bar size (str)
+        :param start: first timestamp, inclusive (datetime)
+        :param end: last timestamp, exclusive (datetime)
+        :param column: bar column (str)
+        :return: bars (pd.DataFrame)
+        """
+        store = BarStore()
+        series = {}
+        for instrument in instruments:
+            timestamps, values = store.column(store.key(instrument, bar_size), column, start, end)
+            series[instrument] = pd.Series(values, index=pd.DatetimeIndex(timestamps))
+        return pd.DataFrame(series).sort_index()
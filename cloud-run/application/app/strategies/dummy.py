@@ -1,4 +1,4 @@
-from random import randint
+from random import Random
 
 from lib.trading import Future
 from strategies.strategy import Strategy
@@ -6,20 +6,26 @@ from strategies.strategy import Strategy
 
 class Dummy(Strategy):
 
+    _rng = None
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
     def _get_signals(self):
         allocation = {
-            self._instruments['mnq'][0].contract.conId: randint(-1, 1)
+            self._instruments['mnq'][0].contract.conId: self._rng.randint(-1, 1)
         }
-        self._env.logging.debug(f'Allocation: {allocation}')
+        self._env.logging.debug('Allocation: %s', allocation)
         self._signals = allocation
         # register allocation contracts so that they don't have to be created again
         self._register_contracts(self._instruments['mnq'][0])
 
     def _setup(self):
-        self._instruments = {
+        # seeded for reproducible backtests
+        self._rng = Random(self._params.get('seed'))
+
+    def _setup_instruments(self):
+        return {
             'mnq': Future.get_contract_series(1, 'MNQ', rollover_days_before_expiry=2)
         }
 
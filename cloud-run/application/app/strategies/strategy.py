@@ -1,13 +1,33 @@
+import numpy as np
+
+from lib.bar_store import BarStore
 from lib.environment import Environment
+from lib.gcp import GcpModule
+from lib.log import Lazy
+from lib.sizing import SizingEngine
+from lib.tracing import Tracer
 from lib.trading import Contract, Forex, Instrument, InstrumentSet
 
 
+class SimulatedEnvironment:
+    """
+    Stands in for the Environment of a strategy in backtests: logging only, without
+    IB gateway, Firestore or secrets.
+    """
+
+    config = {}
+    logging = GcpModule.get_logger()
+
+
 class Strategy:
 
-    _contracts = {}
+    _bar_source = None
+    _clock = None
+    _contracts = None
     _fx = {}
     _holdings = {}
     _instruments = {}
+    _params = {}
     _signals = {}
     _target_positions = {}
     _trades = {}
@@ -15,9 +35,12 @@ class Strategy:
     def __init__(self, _id=None, **kwargs):
         self._id = _id or self.__class__.__name__.lower()
         self._env = Environment()
+        self._contracts = InstrumentSet()
         self._base_currency = kwargs.get('base_currency', None)
         self._exposure = kwargs.get('exposure', 0)
+        self._params = {k: v for k, v in kwargs.items() if k not in ['base_currency', 'exposure']}
 
+        self._instruments = self._setup_instruments()
         self._setup()
 
         self._get_signals()
@@ -66,6 +89,43 @@ class Strategy:
     def trades(self):
         return self._trades
 
+    @classmethod
+    def simulate(cls, bar_source, instruments=None, _id=None, **params):
+        """
+        Creates a strategy for backtesting. Only the strategy is set up, holdings and
+        tickers aren't requested. Bars come from the bar source instead of the bar store,
+        up to the simulated time set by signals_at. With preset instruments, nothing is
+        requested from IB or GCP, so that backtests (e.g. sweep workers) run offline.
+
+        :param bar_source: bar source (e.g. strategies.backtest.SimulatedBars)
+        :param instruments: preset instruments, resolved through IB if None (dict)
+        :param _id: strategy ID (str)
+        :param params: strategy parameters
+        :return: strategy (Strategy)
+        """
+        strategy = cls.__new__(cls)
+        strategy._id = _id or cls.__name__.lower()
+        strategy._env = SimulatedEnvironment() if instruments is not None else Environment()
+        strategy._contracts = InstrumentSet()
+        strategy._base_currency = None
+        strategy._exposure = 0
+        strategy._params = params
+        strategy._bar_source = bar_source
+        strategy._instruments = instruments if instruments is not None else strategy._setup_instruments()
+        strategy._setup()
+        return strategy
+
+    def signals_at(self, timestamp):
+        """
+        Calculates the signals as of a simulated time, with the same code as live.
+
+        :param timestamp: simulated time (datetime)
+        :return: signals (dict)
+        """
+        self._clock = timestamp
+        self._get_signals()
+        return self._signals
+
     def _calculate_target_positions(self):
         """
         Converts signals into target positions (number of contracts).
@@ -73,17 +133,18 @@ class Strategy:
         if self._base_currency is not None and self._exposure:
             for k in self._signals.keys():
                 # make sure we have tickers for all contracts needed
-                if (c := self._contracts[k]).tickers is None:
+                if (c := self._contracts.get(k)).tickers is None:
                     c.get_tickers()
             self._get_currencies(self._base_currency)
 
-            self._target_positions = {
-                k: round(self._exposure * v
-                         / (self._contracts[k].tickers.close
-                            * int(self._contracts[k].contract.multiplier)
-                            * self._fx[self._contracts[k].contract.currency])) if v else 0
-                for k, v in self._signals.items()
-            }
+            engine = SizingEngine(self._signals.keys())
+            signals = engine.vector(self._signals)
+            contracts = [self._contracts.get(k) for k in engine.contract_ids]
+            # prices and FX rates are only needed (and possibly only available) for contracts with a signal
+            prices = np.array([c.tickers.close if s else np.nan for c, s in zip(contracts, signals)], dtype=float)
+            multipliers = np.array([int(c.contract.multiplier or 1) if s else np.nan for c, s in zip(contracts, signals)], dtype=float)
+            fx = np.array([self._fx[c.contract.currency] if s else np.nan for c, s in zip(contracts, signals)], dtype=float)
+            self._target_positions = engine.to_dict(engine.target_positions(self._exposure, signals, prices, multipliers, fx))
         else:
             # TODO: review
             self._target_positions = {k: 0 for k in self._signals.keys()}
@@ -92,12 +153,39 @@ class Strategy:
         """
         Converts target positions into trades (subtract current holdings)
         """
-        self._trades = {
-            k: v - self._holdings[k]
-            for k, v in self._target_positions.items()
-            if v - self._holdings[k]
-        }
-        self._env.logging.info(f"Trades for {self._id}: { {self._contracts[k].local_symbol: v for k, v in self._trades.items()} }")
+        engine = SizingEngine(self._target_positions.keys())
+        self._trades = engine.to_dict(engine.trades(engine.vector(self._target_positions), engine.vector(self._holdings)),
+                                      nonzero=True)
+        self._env.logging.info('Trades for %s: %s', self._id,
+                               Lazy(lambda local_symbols, trades: {local_symbols[k]: v for k, v in trades.items()},
+                                    self._contracts.local_symbols, self._trades))
+
+    def _get_bars(self, instrument, bar_size='1 day', start=None, end=None, column='close'):
+        """
+        Gets historical bars from the local bar store (zero-copy). If a BigQuery table is
+        configured, the store is synced first if it doesn't cover the requested range
+        (e.g. on a cold instance), otherwise it is topped up in the background so that the
+        next run has the latest bars without waiting for them now.
+
+        :param instrument: contract ID or local symbol (int or str)
+        :param bar_size: bar size (str)
+        :param start: first timestamp, inclusive (datetime)
+        :param end: last timestamp, exclusive (datetime)
+        :param column: bar column, all columns if None (str)
+        :return: timestamps (np.ndarray), values (np.ndarray)
+        """
+        if self._bar_source is not None:
+            # backtest: only the bars up to the simulated time are visible
+            return self._bar_source.bars(instrument, bar_size, start, end, column, until=self._clock)
+
+        store = BarStore()
+        key = store.key(instrument, bar_size)
+        if self._env.config.get('barStoreTable'):
+            if store.covers(key, start):
+                store.sync_in_background(key)
+            else:
+                store.sync(key)
+        return store.slice(key, start, end) if column is None else store.column(key, column, start, end)
 
     def _get_currencies(self, base_currency):
         """
@@ -105,7 +193,7 @@ class Strategy:
 
         :param base_currency: base currency of IB account in ISO format (str)
         """
-        currencies = {c.contract.currency for c in self._contracts.values()}
+        currencies = self._contracts.currencies
         forex = InstrumentSet(*[Forex(pair=c + base_currency) for c in currencies])
         forex.get_tickers()
         fx_rates = [f.tickers.midpoint() if f.tickers.midpoint() == f.tickers.midpoint() else f.tickers.close
@@ -119,7 +207,8 @@ class Strategy:
         """
         Gets current portfolio holdings from Firestore.
         """
-        doc = self._env.db.document(f'positions/{self._env.trading_mode}/holdings/{self._id}').get()
+        with Tracer.span('firestore.getHoldings'):
+            doc = self._env.db.document(f'positions/{self._env.trading_mode}/holdings/{self._id}').get()
         self._holdings = {
             int(k): v
             for k, v in doc.to_dict().items()
@@ -135,16 +224,18 @@ class Strategy:
         if not all(isinstance(c, (int, Instrument)) for c in contracts):
             raise TypeError('Not all contracts are of type int or Instrument')
 
-        # add to _contracts if not in it yet
-        to_add = {
-            k: v
-            for k, v in {
-                c if isinstance(c, int) else c.contract.conId: Contract(conId=c) if isinstance(c, int) else c
-                for c in contracts
-            }.items()
-            if k not in self._contracts.keys()
-        }
-        self._contracts = {**self._contracts, **to_add}
+        # add to _contracts if not in it yet (only contract IDs not in it yet are resolved)
+        self._contracts.add(*[Contract(conId=c) if isinstance(c, int) else c
+                              for c in contracts
+                              if c not in self._contracts])
 
     def _setup(self):
         pass
+
+    def _setup_instruments(self):
+        """
+        Resolves the instruments of the strategy through IB (preset in offline backtests).
+
+        :return: instruments (dict)
+        """
+        return {}